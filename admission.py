@@ -0,0 +1,218 @@
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future
+from course_registration import RetryingRegistration
+from enums import RegistrationStatus
+from logs import log
+
+"""
+Admission control in front of the registration chain, for the rush when a registration window opens.
+A student may register from the time ticket of their cohort (student type and degree program) on. Admitted
+requests wait in a bounded queue that keeps a line per cohort and is drained round robin over the lines, at the
+rate of a token bucket sized to what the database sustains. Requests that find the queue full are turned away
+at once instead of piling up on the connection pool.
+Everything reads the time from the clock it is given, so tests can drive it with a simulated one."""
+
+QUEUE_CAPACITY = 2000
+# Registrations per second the database sustains, and how many may start at once after a quiet spell
+RATE = 200
+BURST = 20
+# Waits kept for the percentiles in stats()
+WAIT_SAMPLES = 10000
+IDLE_INTERVAL = 0.05
+
+Cohort = namedtuple('Cohort', ['student_type', 'degree_program'])
+QueuedRequest = namedtuple('QueuedRequest', ['student_id', 'section_id', 'enqueued_at', 'future'])
+
+
+def cohort_of(student):
+    return Cohort(student.type, student.degree_program)
+
+
+def _cohort_label(cohort):
+    """ "full_time/mpcs", students without a type or degree program are in a None cohort """
+    return f"{getattr(cohort.student_type, 'name', None)}/{getattr(cohort.degree_program, 'name', None)}"
+
+
+class TokenBucket:
+    """ Hands out rate tokens a second, holding at most burst of them """
+    def __init__(self, rate=RATE, burst=BURST, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self):
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        """ Seconds until the next token """
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+
+class TimeTickets:
+    """ The clock time each cohort may start registering at, cohorts without a ticket get default (None is open) """
+    def __init__(self, tickets=None, default=None):
+        self._tickets = dict(tickets or {})
+        self.default = default
+
+    def set(self, student_type, degree_program, opens_at):
+        self._tickets[Cohort(student_type, degree_program)] = opens_at
+
+    def opens_at(self, cohort):
+        return self._tickets.get(cohort, self.default)
+
+    def is_open(self, cohort, now):
+        opens_at = self.opens_at(cohort)
+        return opens_at is None or now >= opens_at
+
+
+class FairQueue:
+    """ A bounded queue with a line per cohort, served round robin so that a large cohort can not starve a small one """
+    def __init__(self, capacity=QUEUE_CAPACITY):
+        self.capacity = capacity
+        self._lines = OrderedDict()
+        self._size = 0
+
+    def put(self, cohort, item):
+        """ Returns False when the queue is full """
+        if self._size >= self.capacity:
+            return False
+        self._lines.setdefault(cohort, deque()).append(item)
+        self._size += 1
+        return True
+
+    def get(self):
+        """ The first item of the next cohort's line, None when the queue is empty """
+        if not self._lines:
+            return None
+        cohort, line = next(iter(self._lines.items()))
+        item = line.popleft()
+        self._size -= 1
+        if line:
+            self._lines.move_to_end(cohort)
+        else:
+            del self._lines[cohort]
+        return item
+
+    def depths(self):
+        return {cohort: len(line) for cohort, line in self._lines.items()}
+
+    def __len__(self):
+        return self._size
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+class AdmissionController:
+    """
+    Takes registration requests with submit(), which answers with a Future of the RegistrationStatus.
+    drain() runs what the token bucket allows right now, start() runs it on worker threads until stop().
+    register(student_id, section_id) does the work, RetryingRegistration().register by default.
+    """
+    def __init__(self, register=None, tickets=None, rate=RATE, burst=BURST, capacity=QUEUE_CAPACITY,
+                 clock=time.monotonic):
+        self._register = register or RetryingRegistration().register
+        self.tickets = tickets or TimeTickets()
+        self._clock = clock
+        self._bucket = TokenBucket(rate, burst, clock)
+        self._queue = FairQueue(capacity)
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._counts = {'admitted': 0, 'not_open': 0, 'queue_full': 0, 'processed': 0, 'failed': 0}
+        self._max_depth = 0
+        self._stopping = threading.Event()
+        self._workers = []
+
+    def submit(self, student, section_id):
+        """
+        Queues a registration of the student, anything with an id, a type and a degree_program.
+        Students whose ticket has not come up get not_open and requests that find the queue full queue_full
+        right away.
+        """
+        future = Future()
+        cohort = cohort_of(student)
+        now = self._clock()
+        with self._lock:
+            if not self.tickets.is_open(cohort, now):
+                status = RegistrationStatus.not_open
+            elif not self._queue.put(cohort, QueuedRequest(student.id, section_id, now, future)):
+                status = RegistrationStatus.queue_full
+            else:
+                self._counts['admitted'] += 1
+                self._max_depth = max(self._max_depth, len(self._queue))
+                return future
+            self._counts[status.name] += 1
+        future.set_result(status)
+        return future
+
+    def drain(self, limit=None):
+        """ Runs the queued requests the token bucket allows at this moment, returns how many ran """
+        ran = 0
+        while limit is None or ran < limit:
+            with self._lock:
+                if not len(self._queue) or not self._bucket.try_take():
+                    break
+                request = self._queue.get()
+                self._waits.append(self._clock() - request.enqueued_at)
+            self._run(request)
+            ran += 1
+        return ran
+
+    def _run(self, request):
+        try:
+            request.future.set_result(self._register(request.student_id, request.section_id))
+            outcome = 'processed'
+        except Exception as error:
+            log.error(f"Admitted registration of student {request.student_id} failed: {error}")
+            request.future.set_exception(error)
+            outcome = 'failed'
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def start(self, workers=4):
+        """ Drains the queue on worker threads, as many as the connection pool can serve at once """
+        self._stopping.clear()
+        self._workers = [threading.Thread(target=self._work, name=f'admission-{number}', daemon=True)
+                         for number in range(workers)]
+        for worker in self._workers:
+            worker.start()
+        return self
+
+    def stop(self):
+        """ Stops the workers once they finish what they are running, queued requests stay queued """
+        self._stopping.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _work(self):
+        while not self._stopping.is_set():
+            if not self.drain(limit=1):
+                with self._lock:
+                    pause = self._bucket.wait_time() if len(self._queue) else IDLE_INTERVAL
+                self._stopping.wait(max(pause, 0.001))
+
+    def stats(self):
+        """ The queue depth now and at its highest, the counts of outcomes and the percentiles of queue waits """
+        with self._lock:
+            waits = sorted(self._waits)
+            return dict(self._counts, depth=len(self._queue), max_depth=self._max_depth,
+                        depths={_cohort_label(cohort): depth for cohort, depth in self._queue.depths().items()},
+                        wait_p50_ms=round(_percentile(waits, 0.50) * 1000, 2),
+                        wait_p95_ms=round(_percentile(waits, 0.95) * 1000, 2),
+                        wait_p99_ms=round(_percentile(waits, 0.99) * 1000, 2))
@@ -0,0 +1,200 @@
+import abc
+import asyncio
+import random
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload
+from courses import Course, CourseOffering, Section, student_roster
+from persons import Student, StudentTermLoad
+from database import Database
+from enums import RegistrationStatus
+from controllers import CATALOG_LOADS, catalog_filters
+from course_registration import STUDENT_COURSE_LIMIT, MAX_REGISTRATION_ATTEMPTS, contention_stats
+from enrollment_counters import apply_enrollment_changes, claim_seat
+from prereq_graph import prereq_graph
+from search_index import course_search_index
+from schedule import student_schedule
+from terms import term_states
+from instrumentation import instrument_async_handler, request_span
+from logs import log
+
+"""
+asyncio counterparts of the CourseViewer and the CourseRegChain on the async engine of the Database.
+The handlers make the same checks in the same order and with the same outcome as the sync ones, so that a
+front-end holding many idle connections does not tie up a worker thread for each of them.
+The counter updates are shared with the sync chain through AsyncSession.run_sync."""
+
+
+class AsyncCourseViewer:
+    """ Class to help in viewing courses without blocking the event loop """
+
+    async def view_courses(self, name=None, course_code=None, dept=None, quarter=None, instructor=None,
+                           section_type=None, keyword=None):
+        """ The rows of CourseViewer.view_courses, with the same relationships loaded for use after the session """
+        async with Database().async_session() as session:
+            if name or keyword:
+                await session.run_sync(course_search_index.refresh)
+            statement = select(Course, CourseOffering, Section). \
+                where(CourseOffering.id == Section.course_offering_id). \
+                where(Course.id == CourseOffering.course_id). \
+                where(*catalog_filters(name, course_code, dept, quarter, instructor, section_type, keyword)). \
+                options(*CATALOG_LOADS)
+            result = await session.execute(statement)
+            return result.all()
+
+
+class AsyncCourseRegChain:
+    """
+    The Chain of Responsibility Client
+    """
+
+    def __init__(self):
+        # Initializing the successors chain
+        self.chain1 = AsyncStudentCourseLimitHandler()
+        self.chain2 = AsyncSectionEnrolledLimitHandler()
+        self.chain3 = AsyncPrereqsCheckHandler()
+        self.chain4 = AsyncScheduleConflictHandler()
+        self.chain5 = AsyncStudentRestrictionHandler()
+        self.chain1.next_successor(self.chain2)
+        self.chain2.next_successor(self.chain3)
+        self.chain3.next_successor(self.chain4)
+        self.chain4.next_successor(self.chain5)
+
+
+class AsyncCourseRegHandler(metaclass=abc.ABCMeta):
+    """
+    Define an interface for handling requests in a caller provided AsyncSession transaction.
+    Implement the successor link.
+    The section must come with its offerings loaded, lazy loads are not available on an AsyncSession.
+    Instrumented like the CourseRegHandler.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'handle_request' in cls.__dict__:
+            cls.handle_request = instrument_async_handler(cls.handle_request)
+
+    def __init__(self, successor=None):
+        self._successor = successor
+
+    def next_successor(self, next_handler):
+        self._successor = next_handler
+
+    @abc.abstractmethod
+    async def handle_request(self, session, student, section):
+        pass
+
+
+class AsyncStudentCourseLimitHandler(AsyncCourseRegHandler):
+    """
+    Handler that Checks if Student is enrolled in more than the course_limit before passing it on successor.
+    Terms that are frozen take no registrations at all.
+    """
+
+    async def handle_request(self, session, student, section):
+        if not await session.run_sync(term_states.is_open, section.offerings.year, section.offerings.quarter):
+            log.debug(f"{section.offerings.quarter.name} {section.offerings.year} is frozen")
+            return RegistrationStatus.not_open
+        course_count = await session.scalar(select(StudentTermLoad.course_count).
+                                            where(StudentTermLoad.student_id == student.id).
+                                            where(StudentTermLoad.year == section.offerings.year).
+                                            where(StudentTermLoad.quarter == section.offerings.quarter))
+        if (course_count or 0) < STUDENT_COURSE_LIMIT:
+            return await self._successor.handle_request(session, student, section)
+        else:
+            log.debug("course limit exceed. ask for permission")
+            return RegistrationStatus.course_limit
+
+
+class AsyncSectionEnrolledLimitHandler(AsyncCourseRegHandler):
+    """
+    Handler that checks if the section is full before forwarding it to the successor.
+    """
+
+    async def handle_request(self, session, student, section):
+        enrolled_count = await session.scalar(select(Section.enrolled_count).where(Section.id == section.id))
+        if enrolled_count < section.size_limit:
+            return await self._successor.handle_request(session, student, section)
+        else:
+            log.debug("Section is full. The student can join its waitlist")
+            return RegistrationStatus.section_full
+
+
+class AsyncPrereqsCheckHandler(AsyncCourseRegHandler):
+    """
+    Handler that checks if the student has the necessary pre-reqs before it forwards it to the successor.
+    """
+
+    async def handle_request(self, session, student, section):
+        if not await session.run_sync(prereq_graph.has_prereqs, student.id, section.offerings.course_id):
+            log.debug("Student doesnt have the prereq. Ask for Consent")
+            return RegistrationStatus.missing_prereq
+        return await self._successor.handle_request(session, student, section)
+
+
+class AsyncScheduleConflictHandler(AsyncCourseRegHandler):
+    """
+    Handler that checks the section does not clash with the student's other sections of the term.
+    """
+
+    async def handle_request(self, session, student, section):
+        offering = section.offerings
+        if section.days and section.time is not None:
+            schedule = await session.run_sync(student_schedule, student.id, offering.year, offering.quarter)
+            conflict = schedule.conflict(section.days, section.time, section.end_time, section.id)
+            if conflict is not None:
+                log.debug(f"Section {section.id} meets at the same time as section {conflict}")
+                return RegistrationStatus.schedule_conflict
+        return await self._successor.handle_request(session, student, section)
+
+
+class AsyncStudentRestrictionHandler(AsyncCourseRegHandler):
+    """ Handler that checks if student account has any restrictions on it before enrolling the student"""
+
+    async def handle_request(self, session, student, section):
+        if student.restriction_hold:
+            log.debug("Student has a restriction hold. Do something")
+            return RegistrationStatus.restriction_hold
+        elif not await session.run_sync(claim_seat, section.id):
+            contention_stats.record_conflict()
+            log.debug("Section filled up while the request was being checked")
+            return RegistrationStatus.section_full
+        else:
+            await session.execute(student_roster.insert().values(student_id=student.id, section_id=section.id))
+            await session.run_sync(apply_enrollment_changes, [(student.id, section.id, 1)],
+                                   include_sections=False)
+            return RegistrationStatus.enrolled
+
+
+class AsyncRetryingRegistration:
+    """
+    asyncio counterpart of the RetryingRegistration. Every request walks the AsyncCourseRegChain in its own
+    transaction and conflicting transactions are retried up to max_attempts times with a jittered backoff.
+    """
+    def __init__(self, max_attempts=MAX_REGISTRATION_ATTEMPTS, backoff=0.005):
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._chain = AsyncCourseRegChain()
+
+    async def register(self, student_id, section_id):
+        with request_span('async_registration', student_id=student_id, section_id=section_id) as span:
+            for attempt in range(1, self._max_attempts + 1):
+                try:
+                    return await self._register(student_id, section_id)
+                except (OperationalError, IntegrityError):
+                    if attempt == self._max_attempts:
+                        log.error(f"Registration of student {student_id} gave up after {attempt} attempts")
+                        raise
+                    contention_stats.record_retry()
+                    if span is not None:
+                        span.attributes['retries'] = attempt
+                    await asyncio.sleep(random.uniform(0, self._backoff * 2 ** attempt))
+
+    async def _register(self, student_id, section_id):
+        async with Database().async_session() as session:
+            async with session.begin():
+                student = await session.get(Student, student_id)
+                section = await session.get(Section, section_id, options=[joinedload(Section.offerings)])
+                if student is None or section is None:
+                    return RegistrationStatus.not_found
+                return await self._chain.chain1.handle_request(session, student, section)
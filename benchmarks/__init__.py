@@ -0,0 +1,3 @@
+"""
+Benchmarks of the registration system. Each module runs standalone against a local stand-in database,
+for example `python -m benchmarks.async_vs_sync`, and prints its results as JSON."""
@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from datetime import time as time_of_day
+from courses import Course, CourseOffering, Section
+from persons import Student
+from database import Database
+from enums import Quarter, Department, StudentType, DegreeProgram, SectionType
+from controllers import CourseViewer
+from course_registration import RetryingRegistration
+from async_registration import AsyncCourseViewer, AsyncRetryingRegistration
+from benchmarks.harness import summarize, run_threads, stand_in_database
+
+"""
+Compares the sync and the asyncio paths under the same concurrency, for catalog browsing and for registration.
+Run it with `python -m benchmarks.async_vs_sync --concurrency 50 --requests 2000 [--url ...]`."""
+
+
+def seed(courses, sections_per_course, students):
+    """ Creates a fall catalog with roomy sections and the students who register for them """
+    db_session = Database().get_session()
+    for number in range(courses):
+        course = Course(name=f"Benchmark {number}", course_code=f"B{number}", description="Benchmark",
+                        department=random.choice(list(Department)))
+        offering = CourseOffering(year=2024, quarter=Quarter.fall)
+        offering.sections = [Section(location="Ryerson 251", type=SectionType.lecture, time=time_of_day(9, 30),
+                                     size_limit=students) for _ in range(sections_per_course)]
+        course.course_offerings.append(offering)
+        db_session.add(course)
+    db_session.flush()
+    section_ids = [section_id for section_id, in db_session.query(Section.id)]
+    student_rows = [Student(first_name=f"Student{number}", last_name="Benchmark", preferred_name=str(number),
+                            type=StudentType.full_time, degree_program=DegreeProgram.mpcs,
+                            department=Department.mpcs) for number in range(students)]
+    db_session.add_all(student_rows)
+    db_session.flush()
+    student_ids = [student.id for student in student_rows]
+    db_session.commit()
+    return section_ids, student_ids
+
+
+async def run_async(concurrency, requests, work):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(request):
+        async with semaphore:
+            started = time.perf_counter()
+            await work(request)
+            return time.perf_counter() - started
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(timed(request) for request in requests))
+    elapsed = time.perf_counter() - started
+    await Database().close_async_engine()
+    return summarize(latencies, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the sync and asyncio registration paths")
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--url', help="database url, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    db_file = stand_in_database(args.url, pool_size=args.concurrency)
+    random.seed(7)
+    section_ids, student_ids = seed(courses=50, sections_per_course=2, students=2 * args.requests)
+    departments = [random.choice(list(Department)) for _ in range(args.requests)]
+    sync_registrations = [(student_ids[i], random.choice(section_ids)) for i in range(args.requests)]
+    async_registrations = [(student_ids[args.requests + i], random.choice(section_ids))
+                           for i in range(args.requests)]
+
+    sync_registration = RetryingRegistration()
+    async_registration = AsyncRetryingRegistration()
+
+    @Database().unit_of_work()
+    def view_sync(dept):
+        CourseViewer().view_courses(dept=dept)
+
+    async def view_async(dept):
+        await AsyncCourseViewer().view_courses(dept=dept)
+
+    async def register_async(request):
+        await async_registration.register(*request)
+
+    results = {
+        'concurrency': args.concurrency,
+        'catalog': {
+            'sync': run_threads(args.concurrency, departments, view_sync),
+            'async': asyncio.run(run_async(args.concurrency, departments, view_async)),
+        },
+        'registration': {
+            'sync': run_threads(args.concurrency, sync_registrations,
+                             lambda request: sync_registration.register(*request)),
+            'async': asyncio.run(run_async(args.concurrency, async_registrations, register_async)),
+        },
+    }
+    print(json.dumps(results, indent=2))
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import time
+import tracemalloc
+from courses import Course, CourseOffering, Section
+from database import Database
+from controllers import CourseViewer, CATALOG_ORDER, encode_cursor
+from benchmarks.generator import CatalogGenerator
+from benchmarks.harness import stand_in_database, QueryCounter
+
+"""
+Queries, time and peak memory of reading and rendering one large catalog page four ways: the entity rows with
+lazy loaded relationships view_courses used to return, view_courses with its eager loads, the CatalogRow
+records of view_course_records and the stream of iter_courses. Then the time of a page at the end of the catalog,
+reached with a keyset cursor and with an OFFSET. Run it with `python -m benchmarks.catalog_page --courses 3400 [--url ...]`,
+about three sections per course, so the default page has some 10k rows."""
+
+unit_of_work = Database().unit_of_work()
+
+
+def render_entities(rows):
+    return [(course.name, [prereq.id for prereq in course.prereqs], offering.quarter, len(offering.sections),
+             section.location, [instructor.id for instructor in section.instructor])
+            for course, offering, section in rows]
+
+
+def render_records(rows):
+    return [(row.Course.name, row.Course.prereq_ids, row.CourseOffering.quarter, row.Section.location,
+             row.Section.instructor_ids) for row in rows]
+
+
+def lazy_page():
+    rows = Database().get_session().query(Course, CourseOffering, Section). \
+        filter(CourseOffering.id == Section.course_offering_id). \
+        filter(Course.id == CourseOffering.course_id).all()
+    return render_entities(rows)
+
+
+def eager_page():
+    return render_entities(CourseViewer().view_courses())
+
+
+def records_page():
+    return render_records(CourseViewer().view_course_records())
+
+
+def stream_page():
+    rendered = 0
+    for row in CourseViewer().iter_courses():
+        render_records([row])
+        rendered += 1
+    return [None] * rendered
+
+
+def deep_page(page_size=100):
+    """ Milliseconds for the last page of the catalog by keyset cursor and by offset """
+    with unit_of_work as session:
+        total = session.query(Section.id).count()
+        code, section_id = session.query(*CATALOG_ORDER).select_from(Course). \
+            join(CourseOffering, Course.id == CourseOffering.course_id). \
+            join(Section, CourseOffering.id == Section.course_offering_id).order_by(*CATALOG_ORDER).offset(total - page_size - 1).first()
+        started = time.perf_counter()
+        CourseViewer().view_courses_page(cursor=encode_cursor((code, section_id)), limit=page_size)
+        keyset = time.perf_counter() - started
+        started = time.perf_counter()
+        session.query(Course, CourseOffering, Section).join(CourseOffering, Course.id == CourseOffering.course_id). \
+            join(Section, CourseOffering.id == Section.course_offering_id). \
+            order_by(*CATALOG_ORDER).offset(total - page_size).limit(page_size).all()
+        offset = time.perf_counter() - started
+    return {'keyset_ms': round(keyset * 1000, 1), 'offset_ms': round(offset * 1000, 1)}
+
+
+def measure(page):
+    with unit_of_work:
+        tracemalloc.start()
+        started = time.perf_counter()
+        with QueryCounter(Database().get_engine()) as queries:
+            rendered = page()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'rows': len(rendered), 'queries': queries.count, 'ms': round(elapsed * 1000, 1),
+            'peak_kb': round(peak / 1024)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the ways of reading a large catalog page")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--courses', type=int, default=3400)
+    parser.add_argument('--url', help="database url, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    db_file = stand_in_database(args.url)
+    CatalogGenerator(seed=args.seed, courses=args.courses, students=10, sections_per_course=5). \
+        generate(Database().get_session())
+    Database().get_session().remove()
+    print(json.dumps({'lazy': measure(lazy_page), 'eager': measure(eager_page), 'records': measure(records_page),
+                      'stream': measure(stream_page), 'last_page': deep_page()}, indent=2))
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
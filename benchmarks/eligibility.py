@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import time
+from sqlalchemy import bindparam
+from courses import Section, student_roster
+from persons import Student
+from database import Database
+from enums import RegistrationStatus, Weekday
+from course_registration import CourseRegChain, RetryingRegistration
+from eligibility import eligible_sections
+from benchmarks.generator import CatalogGenerator
+from benchmarks.harness import stand_in_database, summarize, QueryCounter
+
+"""
+Time of the eligibility of a student for every section of a term, next to walking the CourseRegChain once per
+section, the way a student trying every section would. The chain walks also check that both agree.
+Students first register for a few sections, which get meeting days, so that the schedule checks have work to do.
+Run it with `python -m benchmarks.eligibility --courses 2500 --students 200 [--url ...]`, about two sections per
+course, so the term has some 5k sections."""
+
+MEETING_DAYS = [Weekday.monday | Weekday.wednesday | Weekday.friday, Weekday.tuesday | Weekday.thursday,
+                Weekday.monday | Weekday.wednesday, Weekday.friday]
+
+
+def walk_chain(student_id, section_ids):
+    """ What the CourseRegChain decides for each section the student is not enrolled in, rolled back """
+    decisions = {}
+    with Database().unit_of_work() as session:
+        student = session.get(Student, student_id)
+        enrolled = {section_id for section_id, in session.query(student_roster.c.section_id).
+                    filter(student_roster.c.student_id == student_id)}
+        for section_id in section_ids:
+            if section_id in enrolled:
+                continue
+            savepoint = session.begin_nested()
+            decisions[section_id] = CourseRegChain().chain1.handle_request(student, session.get(Section, section_id))
+            savepoint.rollback()
+    return decisions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the eligibility query against a chain walk per section")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--courses', type=int, default=2500)
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--chain-students', type=int, default=2)
+    parser.add_argument('--url', help="database url, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    db_file = stand_in_database(args.url)
+    generator = CatalogGenerator(seed=args.seed, courses=args.courses, students=args.students)
+    session = Database().get_session()
+    catalog = generator.generate(session)
+    session.execute(Section.__table__.update().where(Section.__table__.c.id == bindparam('section_key')).
+                    values(days=bindparam('days')),
+                    [{'section_key': section_id, 'days': int(generator.random.choice(MEETING_DAYS))}
+                     for section_id in catalog.section_ids])
+    session.commit()
+    session.remove()
+    registration = RetryingRegistration()
+    for student_id in catalog.student_ids:
+        for _ in range(2):
+            registration.register(student_id, generator.popular_section(catalog.section_ids))
+
+    year, quarter = catalog.term
+    started = time.perf_counter()
+    eligible_sections(catalog.student_ids[0], year, quarter)
+    cold = time.perf_counter() - started
+    latencies = []
+    with QueryCounter(Database().get_engine()) as queries:
+        for student_id in catalog.student_ids:
+            started = time.perf_counter()
+            eligible_sections(student_id, year, quarter)
+            latencies.append(time.perf_counter() - started)
+            session.remove()
+
+    chain_latencies, disagreements = [], 0
+    with QueryCounter(Database().get_engine()) as chain_queries:
+        for student_id in catalog.student_ids[:args.chain_students]:
+            started = time.perf_counter()
+            decisions = walk_chain(student_id, catalog.section_ids)
+            chain_latencies.append(time.perf_counter() - started)
+            eligibility = eligible_sections(student_id, year, quarter)
+            statuses = dict(eligibility.blocked)
+            statuses.update(dict.fromkeys(eligibility.eligible, RegistrationStatus.enrolled))
+            disagreements += sum(1 for section_id, status in decisions.items() if statuses[section_id] != status)
+    chain_calls = max(1, len(chain_latencies))
+    print(json.dumps({'sections': len(catalog.section_ids), 'cold_ms': round(cold * 1000, 2),
+                      'eligibility': dict(summarize(latencies, sum(latencies)),
+                                          queries_per_request=round(queries.count / len(latencies), 2)),
+                      'chain_walk_ms': round(sum(chain_latencies) / chain_calls * 1000, 1),
+                      'chain_walk_queries': round(chain_queries.count / chain_calls),
+                      'disagreements': disagreements}, indent=2))
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import time
+from sqlalchemy import func
+from courses import Course, CourseOffering, Section, student_roster
+from database import Database
+from bulk_registration import BulkCourseRegistration
+from enrollment_views import EnrollmentViewConsumer, department_totals, section_fill
+from benchmarks.generator import CatalogGenerator
+from benchmarks.harness import stand_in_database, summarize
+
+"""
+Time of the term's department totals and section fill read from the materialized views, next to the joins over
+the student_roster they replace, and of the consumer applying the event log of the registrations.
+Run it with `python -m benchmarks.enrollment_views --students 20000 [--url ...]`."""
+
+
+def _roster_reports(session, year, quarter, section_ids):
+    """ The same reports computed from the roster """
+    totals = dict(session.query(Course.department, func.count()).select_from(student_roster).
+                  join(Section, Section.id == student_roster.c.section_id).
+                  join(CourseOffering, Section.course_offering_id == CourseOffering.id).
+                  join(Course, CourseOffering.course_id == Course.id).
+                  filter(CourseOffering.year == year).filter(CourseOffering.quarter == quarter).
+                  group_by(Course.department))
+    fill = dict(session.query(student_roster.c.section_id, func.count()).
+                filter(student_roster.c.section_id.in_(section_ids)).group_by(student_roster.c.section_id))
+    return totals, fill
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time reports from the enrollment views against the roster")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--courses', type=int, default=400)
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--url', help="database url, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    db_file = stand_in_database(args.url)
+    generator = CatalogGenerator(seed=args.seed, courses=args.courses, students=args.students)
+    session = Database().get_session()
+    catalog = generator.generate(session)
+    requests = [(student_id, generator.popular_section(catalog.section_ids))
+                for student_id in catalog.student_ids for _ in range(2)]
+    for start in range(0, len(requests), 5000):
+        BulkCourseRegistration().register(requests[start:start + 5000])
+    session.remove()
+
+    started = time.perf_counter()
+    events = EnrollmentViewConsumer().catch_up()
+    consumed = time.perf_counter() - started
+    year, quarter = catalog.term
+    report_sections = catalog.section_ids[:100]
+    view_latencies, roster_latencies = [], []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        views = department_totals(year, quarter), section_fill(report_sections)
+        view_latencies.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        totals, fill = _roster_reports(session, year, quarter, report_sections)
+        roster_latencies.append(time.perf_counter() - started)
+    agree = views[0] == totals and all(views[1][section_id] == fill.get(section_id, 0)
+                                       for section_id in report_sections)
+    print(json.dumps({'events': events, 'consume_s': round(consumed, 3),
+                      'views': summarize(view_latencies, sum(view_latencies)),
+                      'roster': summarize(roster_latencies, sum(roster_latencies)), 'agree': agree}, indent=2))
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import random
+from collections import namedtuple
+from datetime import time as time_of_day
+from sqlalchemy import insert
+from courses import Course, CourseOffering, Section, prereqs, instructor_roster, student_roster
+from persons import Student, Instructor, Advisor
+from enrollment_counters import reconcile_counters
+from enums import Quarter, Department, StudentType, DegreeProgram, SectionType
+
+"""
+Seeded generator of synthetic but plausible registration data: departments with their instructors and advisors,
+courses whose prereqs form chains inside a department, a past term the students already took courses in and a
+current term to register for. The same seed and sizes always produce the same rows."""
+
+SyntheticCatalog = namedtuple('SyntheticCatalog', ['course_ids', 'section_ids', 'student_ids', 'instructor_ids',
+                                                   'past_term', 'term'])
+
+SUBJECTS = ["Algorithms", "Systems", "Programming", "Networks", "Databases", "Security", "Compilers", "Graphics",
+            "Learning", "Theory", "Design", "Analysis", "Policy", "Economics", "Statistics", "Finance"]
+LEVELS = ["Introduction to", "Topics in", "Advanced", "Applied", "Foundations of"]
+FIRST_NAMES = ["Ada", "Alan", "Barbara", "Edsger", "Grace", "John", "Ken", "Leslie", "Margaret", "Niklaus",
+               "Radia", "Shafi", "Tim", "Vint", "Whitfield", "Yukihiro"]
+LAST_NAMES = ["Hopper", "Turing", "Liskov", "Dijkstra", "Knuth", "Lamport", "Hamilton", "Wirth", "Perlman",
+              "Goldwasser", "Berners", "Cerf", "Diffie", "Matsumoto", "Ritchie", "Thompson"]
+BUILDINGS = ["Ryerson", "Crerar", "Harper", "Cobb", "Stuart"]
+BATCH = 5000
+
+
+class CatalogGenerator:
+    """
+    Writes a synthetic catalog through the given session with bulk inserts.
+    Each course gets up to two prereqs among the earlier courses of its department, and every student has taken
+    a few past term courses so that some prereq checks pass.
+    """
+    def __init__(self, seed=7, courses=200, students=2000, instructors=60, advisors=20, sections_per_course=3,
+                 past_courses_per_student=3, term=(2024, Quarter.fall), past_term=(2024, Quarter.spring)):
+        self.random = random.Random(seed)
+        self.courses = courses
+        self.students = students
+        self.instructors = instructors
+        self.advisors = advisors
+        self.sections_per_course = sections_per_course
+        self.past_courses_per_student = past_courses_per_student
+        self.term = term
+        self.past_term = past_term
+
+    def generate(self, session):
+        instructor_ids = self._people(session, Instructor, self.instructors, 'I')
+        advisor_ids = self._people(session, Advisor, self.advisors, 'A')
+        course_ids = self._courses(session)
+        past_sections = self._sections(session, course_ids, self.past_term, instructor_ids, sections_per_course=1)
+        section_ids = self._sections(session, course_ids, self.term, instructor_ids, self.sections_per_course)
+        student_ids = self._students(session, advisor_ids)
+        self._history(session, student_ids, past_sections)
+        session.commit()
+        reconcile_counters(session)
+        return SyntheticCatalog(course_ids, section_ids, student_ids, instructor_ids, self.past_term, self.term)
+
+    def generate_history(self, session, catalog, years):
+        """
+        Adds years of finished terms before the past term, every quarter with a section of each course that the
+        students took a few of. Returns the (year, quarter) of the terms, oldest first.
+        """
+        terms = [(year, quarter) for year in range(self.past_term[0] - years, self.past_term[0]) for quarter in Quarter]
+        for term in terms:
+            section_ids = self._sections(session, catalog.course_ids, term, catalog.instructor_ids, 1)
+            self._history(session, catalog.student_ids, section_ids)
+        session.commit()
+        reconcile_counters(session)
+        return terms
+
+    def _insert(self, session, model, rows):
+        for start in range(0, len(rows), BATCH):
+            session.execute(insert(model), rows[start:start + BATCH])
+
+    def _ids(self, session, model, count):
+        """ The ids of the last count rows inserted into the table of model """
+        return [model_id for model_id, in session.query(model.id).order_by(model.id.desc()).limit(count)][::-1]
+
+    def _people(self, session, model, count, tag):
+        rows = [{'first_name': self.random.choice(FIRST_NAMES), 'last_name': self.random.choice(LAST_NAMES),
+                 'preferred_name': f"{tag}{number}", 'department': self.random.choice(list(Department))}
+                for number in range(count)]
+        self._insert(session, model, rows)
+        return self._ids(session, model, count)
+
+    def _courses(self, session):
+        departments = list(Department)
+        rows = []
+        for number in range(self.courses):
+            department = departments[number % len(departments)]
+            rows.append({'name': f"{self.random.choice(LEVELS)} {self.random.choice(SUBJECTS)} {number}",
+                         'course_code': f"{department.name.upper()}{10000 + number}",
+                         'description': ' '.join(self.random.sample(SUBJECTS, 3)), 'department': department})
+        self._insert(session, Course, rows)
+        course_ids = self._ids(session, Course, self.courses)
+        links = []
+        for number, course_id in enumerate(course_ids):
+            earlier = course_ids[number % len(departments):number:len(departments)]
+            for prereq_id in self.random.sample(earlier, min(len(earlier), self.random.choice([0, 0, 1, 1, 2]))):
+                links.append({'course_id': course_id, 'prereq_id': prereq_id})
+        self._insert(session, prereqs, links)
+        return course_ids
+
+    def _sections(self, session, course_ids, term, instructor_ids, sections_per_course):
+        year, quarter = term
+        self._insert(session, CourseOffering, [{'course_id': course_id, 'year': year, 'quarter': quarter}
+                                               for course_id in course_ids])
+        offering_ids = self._ids(session, CourseOffering, len(course_ids))
+        rows = []
+        for offering_id in offering_ids:
+            for _ in range(self.random.randint(1, sections_per_course)):
+                section_type = self.random.choice([SectionType.lecture, SectionType.lecture, SectionType.lab])
+                rows.append({'course_offering_id': offering_id, 'type': section_type,
+                             'location': f"{self.random.choice(BUILDINGS)} {self.random.randint(100, 400)}",
+                             'time': time_of_day(self.random.randint(8, 18), self.random.choice([0, 30])),
+                             'size_limit': self.random.choice([20, 30, 30, 45, 60]) if section_type is
+                             SectionType.lecture else self.random.choice([15, 20, 25])})
+        self._insert(session, Section, rows)
+        section_ids = self._ids(session, Section, len(rows))
+        self._insert(session, instructor_roster, [{'instructor_id': self.random.choice(instructor_ids),
+                                                   'section_id': section_id} for section_id in section_ids])
+        return section_ids
+
+    def _students(self, session, advisor_ids):
+        rows = [{'first_name': self.random.choice(FIRST_NAMES), 'last_name': self.random.choice(LAST_NAMES),
+                 'preferred_name': f"S{number}", 'type': self.random.choice(list(StudentType)),
+                 'degree_program': self.random.choice(list(DegreeProgram)),
+                 'department': self.random.choice(list(Department)),
+                 'academic_advisor_id': self.random.choice(advisor_ids),
+                 'restriction_hold': self.random.random() < 0.02} for number in range(self.students)]
+        self._insert(session, Student, rows)
+        return self._ids(session, Student, self.students)
+
+    def _history(self, session, student_ids, past_sections):
+        rows = []
+        for student_id in student_ids:
+            for section_id in self.random.sample(past_sections, min(len(past_sections),
+                                                                    self.past_courses_per_student)):
+                rows.append({'student_id': student_id, 'section_id': section_id})
+        self._insert(session, student_roster, rows)
+
+    def popular_section(self, section_ids):
+        """ A section picked with a skew towards the first ones, the way demand piles up on a few courses """
+        return section_ids[int(len(section_ids) * self.random.random() ** 3)]
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event
+from database import Database
+
+"""
+What the benchmarks share: a stand-in database, a thread pool driver, latency summaries and a query counter."""
+
+
+def percentile(latencies, fraction):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, elapsed):
+    return {'requests': len(latencies),
+            'requests_per_second': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)}
+
+
+def run_threads(concurrency, requests, work):
+    """ Runs work(request) for every request on a pool of concurrency threads, returns the latency summary """
+    def timed(request):
+        started = time.perf_counter()
+        work(request)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(timed, requests))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def stand_in_database(url=None, pool_size=5, **settings):
+    """
+    Points the Database at url, or at a new temporary SQLite file, and creates the tables.
+    Returns the path of the temporary file, for the caller to remove, or None.
+    """
+    db_file = None
+    if url is None:
+        handle, db_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        url = 'sqlite:///' + db_file
+    Database().configure(url=url, echo=False, pool_size=pool_size, max_overflow=0, **settings)
+    Database().get_base().metadata.create_all(bind=Database().get_engine())
+    return db_file
+
+
+class QueryCounter:
+    """ Counts the statements an engine executes while it is attached """
+    def __init__(self, engine):
+        self._engine = engine
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def _count(self, *args):
+        with self._lock:
+            self.count += 1
+
+    def __enter__(self):
+        event.listen(self._engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self._engine, 'before_cursor_execute', self._count)
+        return False
@@ -0,0 +1,51 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+"""
+Cold start time of the entry points: every module is imported in a fresh interpreter, which reports how long the
+import took and whether it created a database engine or started the log shipper on the way.
+Run it with `python -m benchmarks.import_time --repeat 5`."""
+
+ENTRY_POINTS = ['logs', 'database', 'courses', 'persons', 'controllers', 'course_registration',
+                'bulk_registration', 'async_registration', 'catalog_import']
+
+PROBE = """
+import sys, time
+started = time.perf_counter()
+__import__(sys.argv[1])
+elapsed = time.perf_counter() - started
+from database import Database
+import logs
+shipper = getattr(logs, 'shipper', None)
+print(elapsed, Database()._engine is not None, shipper is not None and shipper._worker is not None)
+"""
+
+
+def probe(module):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    output = subprocess.run([sys.executable, '-c', PROBE, module], env=environment, capture_output=True, text=True,
+                            check=True).stdout.split()
+    return float(output[0]), output[1] == 'True', output[2] == 'True'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold import time of the entry points")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS)
+    args = parser.parse_args()
+    results = {}
+    for module in args.modules:
+        runs = [probe(module) for _ in range(args.repeat)]
+        results[module] = {'median_ms': round(statistics.median(run[0] for run in runs) * 1000, 1),
+                           'engine_created': any(run[1] for run in runs),
+                           'log_shipper_started': any(run[2] for run in runs)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import time
+from sqlalchemy import create_engine, text
+from database import Database
+from enums import RegistrationStatus
+from course_registration import RetryingRegistration
+from instrumentation import registry, tracer, instrument_engine, instrument_handler, request_span
+from benchmarks.generator import CatalogGenerator
+from benchmarks.harness import stand_in_database, summarize
+
+"""
+What the instrumentation costs. The wrapper of a chain handler and a request span are timed in a loop against the
+bare call, the query hooks against an engine without them, and the three add up to the cost per registration of
+the handlers entered and the queries run. Then registrations are sent through the CourseRegChain with the
+instrumentation switched on and off every other request, to compare the latencies.
+Run it with `python -m benchmarks.instrumentation_overhead --requests 2000 [--url ...]`."""
+
+
+class _Handler:
+    def handle_request(self, student, section):
+        return RegistrationStatus.enrolled
+
+
+_Handler.timed_request = instrument_handler(_Handler.handle_request)
+
+
+def _per_call(work, loops):
+    started = time.perf_counter()
+    for _ in range(loops):
+        work()
+    return (time.perf_counter() - started) / loops
+
+
+def wrapper_cost(loops):
+    """ Microseconds a handler wrapper and a request span add to a call """
+    handler = _Handler()
+
+    def spanned():
+        with request_span('overhead'):
+            pass
+
+    bare = _per_call(lambda: handler.handle_request(None, None), loops)
+    timed = _per_call(lambda: handler.timed_request(None, None), loops)
+    span = _per_call(spanned, loops)
+    tracer.reset()
+    return (timed - bare) * 1e6, span * 1e6
+
+
+def query_cost(loops):
+    """ Microseconds the query hooks add to a statement """
+    bare, hooked = create_engine('sqlite://'), instrument_engine(create_engine('sqlite://'))
+    costs = []
+    for engine in (bare, hooked):
+        with engine.connect() as connection:
+            statement = text('SELECT 1')
+            costs.append(_per_call(lambda: connection.execute(statement).scalar(), loops))
+    return (costs[1] - costs[0]) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cost of the instrumentation per registration")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--loops', type=int, default=100000)
+    parser.add_argument('--url', help="database url, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    handler_us, span_us = wrapper_cost(args.loops)
+    query_us = query_cost(args.loops // 5)
+
+    db_file = stand_in_database(args.url)
+    generator = CatalogGenerator(seed=args.seed)
+    catalog = generator.generate(Database().get_session())
+    Database().get_session().remove()
+    registration = RetryingRegistration()
+    latencies = {True: [], False: []}
+    registry.reset()
+    for index in range(args.requests):
+        registry.enabled = index % 2 == 0
+        request = (generator.random.choice(catalog.student_ids), generator.popular_section(catalog.section_ids))
+        started = time.perf_counter()
+        registration.register(*request)
+        latencies[registry.enabled].append(time.perf_counter() - started)
+    registry.enabled = True
+
+    spans = [span for span in tracer.finished_spans() if span['name'] == 'registration']
+    handlers = sum(1 for span in tracer.finished_spans() if span['name'] == 'handler') / max(1, len(spans))
+    queries = sum(span['queries'] for span in spans) / max(1, len(spans))
+    elapsed = {enabled: sum(values) for enabled, values in latencies.items()}
+    results = {'handler_wrapper_us': round(handler_us, 2), 'request_span_us': round(span_us, 2),
+               'query_hook_us': round(query_us, 2), 'handlers_per_request': round(handlers, 2),
+               'queries_per_request': round(queries, 2),
+               'estimated_overhead_us': round(span_us + handlers * handler_us + queries * query_us, 2),
+               'instrumented': summarize(latencies[True], elapsed[True]),
+               'bare': summarize(latencies[False], elapsed[False])}
+    print(json.dumps(results, indent=2))
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import json
+import logging
+import time
+from mongolog.handlers import MongoFormatter
+from benchmarks.harness import percentile
+from logs import LogShipper, log
+
+"""
+Measures what a log call costs the registration path with the synchronous per-record insert the logger used to
+make and with the queued LogShipper, both against a stand-in sink with a fixed round trip time.
+Run it with `python -m benchmarks.log_latency --records 2000 --sink-latency-ms 1`."""
+
+
+class SlowSink:
+    """ Stands in for the Mongo collection, every call takes one round trip """
+    def __init__(self, latency):
+        self.latency = latency
+
+    def insert_one(self, document):
+        time.sleep(self.latency)
+
+    def insert_many(self, documents):
+        time.sleep(self.latency)
+
+
+class SynchronousHandler(logging.Handler):
+    """ What the mongolog MongoHandler does, one insert per record on the calling thread """
+    def __init__(self, sink):
+        super().__init__()
+        self.sink = sink
+        self.formatter = MongoFormatter()
+
+    def emit(self, record):
+        self.sink.insert_one(self.format(record))
+
+
+def measure(handler, records):
+    """ Per call latencies of log.debug with only this handler attached """
+    previous = log.handlers[:]
+    log.handlers = [handler]
+    latencies = []
+    try:
+        for number in range(records):
+            started = time.perf_counter()
+            log.debug("Student %d doesnt have the prereq. Ask for Consent", number)
+            latencies.append(time.perf_counter() - started)
+        handler.flush()
+    finally:
+        log.handlers = previous
+        handler.close()
+    return {'records': records,
+            'p50_us': round(percentile(latencies, 0.50) * 1e6, 1),
+            'p99_us': round(percentile(latencies, 0.99) * 1e6, 1),
+            'total_ms': round(sum(latencies) * 1000, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the latency of synchronous and queued log shipping")
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--sink-latency-ms', type=float, default=1.0)
+    args = parser.parse_args()
+    sink = SlowSink(args.sink_latency_ms / 1000)
+    results = {
+        'sink_latency_ms': args.sink_latency_ms,
+        'synchronous': measure(SynchronousHandler(sink), args.records),
+        'queued': measure(LogShipper(sink), args.records),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import time
+from sqlalchemy import insert
+from courses import SectionPreference
+from database import Database
+from enums import RegistrationStatus
+from lottery import SeatLottery, allocate_seats
+from benchmarks.generator import CatalogGenerator
+from benchmarks.harness import stand_in_database
+
+"""
+Time of a seat lottery over a whole term: reading the demand, allocating the seats and writing the rosters.
+Every student ranks a few sections picked with the skew of popular_section, so the popular ones are
+oversubscribed. Run it with `python -m benchmarks.lottery --students 50000 --preferences 5 [--url ...]`."""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a seat lottery over a synthetic term")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--courses', type=int, default=400)
+    parser.add_argument('--students', type=int, default=50000)
+    parser.add_argument('--preferences', type=int, default=5)
+    parser.add_argument('--url', help="database url, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    db_file = stand_in_database(args.url)
+    generator = CatalogGenerator(seed=args.seed, courses=args.courses, students=args.students)
+    session = Database().get_session()
+    catalog = generator.generate(session)
+    rows = []
+    for student_id in catalog.student_ids:
+        picked = []
+        while len(picked) < args.preferences:
+            section_id = generator.popular_section(catalog.section_ids)
+            if section_id not in picked:
+                picked.append(section_id)
+        rows.extend({'student_id': student_id, 'section_id': section_id, 'rank': rank}
+                    for rank, section_id in enumerate(picked, start=1))
+    for start in range(0, len(rows), 10000):
+        session.execute(insert(SectionPreference), rows[start:start + 10000])
+    session.commit()
+
+    year, quarter = catalog.term
+    lottery = SeatLottery(seed=args.seed)
+    started = time.perf_counter()
+    demand = lottery.load_demand(year, quarter)
+    loaded = time.perf_counter()
+    status = allocate_seats(demand, lottery._random.permutation(len(demand.student_ids)))
+    allocated = time.perf_counter()
+    session.rollback()
+    results = lottery.allocate(year, quarter)
+    finished = time.perf_counter()
+
+    outcomes = {}
+    for result in results:
+        outcomes[result.status.name] = outcomes.get(result.status.name, 0) + 1
+    print(json.dumps({'students': args.students, 'sections': len(catalog.section_ids), 'preferences': len(rows),
+                      'load_s': round(loaded - started, 3), 'allocate_s': round(allocated - loaded, 3),
+                      'allocate_and_write_s': round(finished - allocated, 3),
+                      'enrolled': int((status == RegistrationStatus.enrolled.value).sum()), 'outcomes': outcomes},
+                     indent=2))
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
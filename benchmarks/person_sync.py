@@ -0,0 +1,58 @@
+import argparse
+import json
+import os
+import time
+from persons import Student
+from controllers import bulk_get_or_create, get_or_create, person_ids, UPSERT_BATCH_SIZE
+from database import Database
+from enums import Department, DegreeProgram, StudentType
+from benchmarks.harness import stand_in_database, QueryCounter
+
+"""
+Time of a sync of students from the registrar, get_or_create row by row next to bulk_get_or_create in batches.
+Half of the rows exist already, and the bulk sync runs a second time to show the identity cache.
+Run it with `python -m benchmarks.person_sync --students 20000 [--url ...]`."""
+
+
+def _rows(count, first_name):
+    return [{'first_name': first_name, 'last_name': f"Sync{i}", 'preferred_name': None,
+             'department': Department.mpcs, 'type': StudentType.full_time, 'degree_program': DegreeProgram.mpcs}
+            for i in range(count)]
+
+
+def _bulk_sync(session, rows):
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        bulk_get_or_create(session, Student, rows[start:start + UPSERT_BATCH_SIZE])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time get_or_create against bulk_get_or_create")
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--url', help="database url, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    db_file = stand_in_database(args.url)
+    session = Database().get_session()
+    results = {'students': args.students}
+    for name in ('get_or_create', 'bulk', 'bulk_cached'):
+        first_name = 'bulk' if name.startswith('bulk') else name
+        rows = _rows(args.students, first_name)
+        if name != 'bulk_cached':
+            _bulk_sync(session, rows[::2])
+            person_ids.clear()
+        started = time.perf_counter()
+        with QueryCounter(Database().get_engine()) as queries:
+            if name == 'get_or_create':
+                for row in rows:
+                    get_or_create(session, Student, **row)
+            else:
+                _bulk_sync(session, rows)
+        results[name] = {'seconds': round(time.perf_counter() - started, 3), 'queries': queries.count}
+        session.remove()
+    print(json.dumps(results, indent=2))
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+from sqlalchemy.exc import OperationalError
+from courses import Section
+from persons import Student
+from database import Database
+from enums import Department, Quarter, SectionType
+from controllers import CourseViewer
+from course_registration import RetryingRegistration, CourseRegModification, contention_stats
+from benchmarks.generator import CatalogGenerator
+from benchmarks.harness import run_threads, stand_in_database, QueryCounter
+
+"""
+Registration load scenarios over a seeded synthetic catalog:
+browse runs CourseViewer lookups, rush sends registrations skewed towards popular sections through the
+CourseRegChain, and churn has the registered students drop and swap sections with CourseRegModification.
+Run it with `python -m benchmarks.registration_load --seed 7 --requests 2000 --concurrency 8 [--url mysql+...]`,
+the JSON it prints can be compared between runs with the same seed and sizes."""
+
+SCENARIOS = ('browse', 'rush', 'churn')
+unit_of_work = Database().unit_of_work()
+
+
+def browse_requests(generator, count):
+    filters = []
+    for _ in range(count):
+        choice = generator.random.random()
+        if choice < 0.4:
+            filters.append({'dept': generator.random.choice(list(Department)), 'quarter': Quarter.fall})
+        elif choice < 0.7:
+            filters.append({'name': generator.random.choice(["Algorithms", "Systems", "Learning", "Policy"])})
+        elif choice < 0.9:
+            filters.append({'dept': generator.random.choice(list(Department)), 'section_type': SectionType.lab})
+        else:
+            filters.append({'keyword': generator.random.choice(["Design", "Theory", "Finance"])})
+    return filters
+
+
+@unit_of_work
+def browse(filters):
+    CourseViewer().view_courses(**filters)
+
+
+def churn_requests(generator, catalog, enrolled, count):
+    """ Drops of an enrolled section, and swaps of one for another section of the term """
+    requests = []
+    for _ in range(count):
+        student_id, section_id = generator.random.choice(enrolled)
+        if generator.random.random() < 0.5:
+            requests.append((student_id, section_id, None))
+        else:
+            requests.append((student_id, section_id, generator.popular_section(catalog.section_ids)))
+    return requests
+
+
+def churn(request):
+    student_id, drop_id, add_id = request
+    try:
+        with unit_of_work as session:
+            modification = CourseRegModification(session.query(Student).get(student_id))
+            if add_id is None:
+                modification.drop_course(session.query(Section).get(drop_id))
+            else:
+                modification.swap_course(session.query(Section).get(add_id), session.query(Section).get(drop_id))
+    except OperationalError:
+        contention_stats.record_conflict()
+
+
+def run_scenario(name, concurrency, requests, work):
+    contention_stats.reset()
+    with QueryCounter(Database().get_engine()) as queries:
+        result = run_threads(concurrency, requests, work)
+    result['queries'] = queries.count
+    result['queries_per_request'] = round(queries.count / max(1, len(requests)), 2)
+    result.update(contention_stats.snapshot())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the registration load scenarios on a synthetic catalog")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--courses', type=int, default=200)
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--url', help="database url, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    db_file = stand_in_database(args.url, pool_size=args.concurrency)
+    generator = CatalogGenerator(seed=args.seed, courses=args.courses, students=args.students)
+    catalog = generator.generate(Database().get_session())
+    Database().get_session().remove()
+    results = {'seed': args.seed, 'courses': args.courses, 'sections': len(catalog.section_ids),
+               'students': args.students, 'concurrency': args.concurrency, 'scenarios': {}}
+
+    registration = RetryingRegistration()
+    registrations = [(generator.random.choice(catalog.student_ids), generator.popular_section(catalog.section_ids))
+                     for _ in range(args.requests)]
+    statuses = {}
+
+    def register(request):
+        status = registration.register(*request)
+        statuses[request] = status
+
+    for scenario in args.scenarios:
+        if scenario == 'browse':
+            result = run_scenario(scenario, args.concurrency, browse_requests(generator, args.requests), browse)
+        elif scenario == 'rush':
+            result = run_scenario(scenario, args.concurrency, registrations, register)
+            outcomes = {}
+            for status in statuses.values():
+                outcomes[status.name] = outcomes.get(status.name, 0) + 1
+            result['outcomes'] = outcomes
+        else:
+            enrolled = [request for request, status in statuses.items() if status.name == 'enrolled']
+            if not enrolled:
+                continue
+            result = run_scenario(scenario, args.concurrency,
+                                  churn_requests(generator, catalog, enrolled, args.requests // 2), churn)
+        results['scenarios'][scenario] = result
+    print(json.dumps(results, indent=2))
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
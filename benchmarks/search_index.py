@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import random
+import string
+import tempfile
+import time
+from sqlalchemy import insert
+from courses import Course
+import persons  # noqa: F401, registers the tables the courses refer to
+from database import Database
+from enums import Department
+from search_index import CourseSearchIndex
+
+"""
+Compares name lookups through the course search index with the LIKE '%text%' scan they replace, at growing
+catalog sizes. Run it with `python -m benchmarks.search_index --sizes 10000 100000 1000000 [--url ...]`."""
+
+WORDS = ["Algorithms", "Systems", "Programming", "Networks", "Databases", "Security", "Compilers", "Graphics",
+         "Learning", "Theory", "Design", "Analysis", "Distributed", "Functional", "Mobile", "Web"]
+
+
+def seed(session, count, offset):
+    """ Inserts count synthetic courses with three word names and a random code """
+    rows = [{'name': ' '.join(random.sample(WORDS, 3)) + f" {offset + number}",
+             'course_code': ''.join(random.choices(string.ascii_uppercase, k=4)) + str(offset + number),
+             'description': ' '.join(random.sample(WORDS, 6)),
+             'department': random.choice(list(Department))} for number in range(count)]
+    for start in range(0, len(rows), 10000):
+        session.execute(insert(Course), rows[start:start + 10000])
+    session.commit()
+
+
+def time_queries(queries, lookup):
+    started = time.perf_counter()
+    for query in queries:
+        lookup(query)
+    return round((time.perf_counter() - started) / len(queries) * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the course search index with LIKE scans")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--url', help="database url, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    db_file = None
+    url = args.url
+    if url is None:
+        handle, db_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        url = 'sqlite:///' + db_file
+    Database().configure(url=url, echo=False)
+    Database().get_base().metadata.create_all(bind=Database().get_engine())
+    session = Database().get_session()
+    random.seed(7)
+    queries = [random.choice(WORDS)[1:6].lower() for _ in range(args.queries // 2)] + \
+        [str(random.randrange(min(args.sizes))) for _ in range(args.queries - args.queries // 2)]
+
+    results = []
+    seeded = 0
+    for size in sorted(args.sizes):
+        seed(session, size - seeded, seeded)
+        seeded = size
+        index = CourseSearchIndex()
+        started = time.perf_counter()
+        index.refresh(session)
+        build_seconds = time.perf_counter() - started
+        results.append({
+            'courses': size,
+            'index_build_s': round(build_seconds, 2),
+            'index_query_ms': time_queries(queries, lambda query: index.search(query, ('name',))),
+            'like_query_ms': time_queries(queries, lambda query: session.query(Course.id).
+                                          filter(Course.name.like('%' + query + '%')).all()),
+        })
+    session.close()
+    print(json.dumps(results, indent=2))
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
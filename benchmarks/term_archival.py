@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import time
+from courses import Section
+from persons import Student
+from controllers import CourseViewer
+from database import Database
+from course_registration import CourseRegChain
+from eligibility import eligible_sections
+from prereq_graph import prereq_graph
+from schedule import student_schedule
+from terms import archive_term, freeze_term, term_states
+from benchmarks.generator import CatalogGenerator
+from benchmarks.harness import stand_in_database, summarize
+
+"""
+Latency of the queries of the current term with years of finished terms in the live tables, and again once they
+are archived: a walk of the CourseRegChain, the prereq check and schedule of a student, the eligibility of a
+student and the roster view. Times the archival of every term as well.
+Run it with `python -m benchmarks.term_archival --years 10 --students 2000 [--url ...]`."""
+
+
+def walk_chain(student_id, section_id):
+    """ What the CourseRegChain decides for the student and section, rolled back """
+    with Database().unit_of_work() as session:
+        savepoint = session.begin_nested()
+        status = CourseRegChain().chain1.handle_request(session.get(Student, student_id),
+                                                        session.get(Section, section_id))
+        savepoint.rollback()
+    return status
+
+
+def uncached_prereq_check(session, student_id, course_id):
+    """ has_prereqs reading the student's history, which the chain walk before left cached """
+    prereq_graph.forget_students([student_id])
+    return prereq_graph.has_prereqs(session, student_id, course_id)
+
+
+def hot_term_latencies(catalog, course_ids, students):
+    """ Summaries of the latencies of the current term's queries for the first students of the catalog """
+    session = Database().get_session()
+    year, quarter = catalog.term
+    queries = {
+        'chain_walk': lambda student_id, index: walk_chain(student_id,
+                                                           catalog.section_ids[index % len(catalog.section_ids)]),
+        'has_prereqs': lambda student_id, index: uncached_prereq_check(session, student_id,
+                                                                       course_ids[index % len(course_ids)]),
+        'schedule': lambda student_id, index: student_schedule(session, student_id, year, quarter),
+        'eligibility': lambda student_id, index: eligible_sections(student_id, year, quarter),
+        'view_roster': lambda student_id, index: CourseViewer().view_roster(session.get(Student, student_id)),
+    }
+    results = {}
+    for name, query in queries.items():
+        latencies = []
+        for index, student_id in enumerate(catalog.student_ids[:students]):
+            started = time.perf_counter()
+            query(student_id, index)
+            latencies.append(time.perf_counter() - started)
+            session.remove()
+        results[name] = summarize(latencies, sum(latencies))['p50_ms']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the current term's queries before and after archival")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--courses', type=int, default=400)
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--years', type=int, default=10)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--url', help="database url, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    db_file = stand_in_database(args.url)
+    generator = CatalogGenerator(seed=args.seed, courses=args.courses, students=args.students)
+    session = Database().get_session()
+    catalog = generator.generate(session)
+    terms = generator.generate_history(session, catalog, args.years)
+    # Courses with prereqs, so that the prereq checks read the students' history
+    prereq_graph.ensure_courses(session, catalog.course_ids)
+    session.remove()
+    course_ids = [course_id for course_id in catalog.course_ids if prereq_graph.required_mask(course_id)] or \
+        catalog.course_ids
+    hot_term_latencies(catalog, course_ids, 10)
+
+    before = hot_term_latencies(catalog, course_ids, args.samples)
+    started = time.perf_counter()
+    for term in terms:
+        freeze_term(*term)
+        archive_term(*term)
+    archived = time.perf_counter() - started
+    term_states.clear()
+    hot_term_latencies(catalog, course_ids, 10)
+    after = hot_term_latencies(catalog, course_ids, args.samples)
+    print(json.dumps({'history_terms': len(terms), 'archive_s_per_term': round(archived / len(terms), 3),
+                      'p50_ms': {name: {'before': before[name], 'after': after[name]} for name in before}},
+                     indent=2))
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main()
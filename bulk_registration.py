@@ -0,0 +1,207 @@
+from collections import namedtuple, defaultdict
+from courses import CourseOffering, Section, student_roster
+from persons import Student, StudentTermLoad
+from database import Database
+from enums import RegistrationStatus
+from course_registration import STUDENT_COURSE_LIMIT, MAX_REGISTRATION_ATTEMPTS, contention_stats
+from enrollment_counters import apply_enrollment_changes, overfilled_sections
+from prereq_graph import prereq_graph, archived_courses
+from schedule import ScheduleIndex
+from terms import term_states
+from instrumentation import registration_outcomes, request_span
+from logs import log
+
+db_session = Database().get_session()
+# Keeps the IN (...) lists under the bound parameter limits of MySQL and SQLite
+ID_CHUNK_SIZE = 500
+
+"""
+Set-based counterpart of the CourseRegChain for registration rushes.
+Instead of walking the chain once per request, the whole batch is checked against a handful of
+grouped queries and the accepted rows are written to the student_roster, together with the enrollment
+counters, in one transaction."""
+
+RegistrationRequest = namedtuple('RegistrationRequest', ['student_id', 'section_id'])
+RegistrationResult = namedtuple('RegistrationResult', ['student_id', 'section_id', 'status'])
+# meeting is the (days, start, end) of the section's meetings
+SectionState = namedtuple('SectionState', ['course_id', 'term', 'size_limit', 'enrolled_count', 'meeting'])
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        yield ids[start:start + ID_CHUNK_SIZE]
+
+
+def _as_id(obj):
+    return getattr(obj, 'id', obj)
+
+
+class BulkCourseRegistration:
+    """
+    Registers a batch of (student, section) requests at once.
+    Requests are decided in the order given, applying the same checks and the same precedence as the
+    CourseRegChain (course limit, section capacity, prereqs, schedule conflicts, restriction hold), so every
+    request gets the status the chain would have returned had the requests been walked one after the other.
+    A student who is in the section already and passes every check gets already_enrolled, where the chain fails
+    on the duplicate roster row.
+    """
+
+    def __init__(self, session=None):
+        self._session = session or db_session
+
+    def register(self, requests):
+        """
+        Takes an iterable of (student, section) pairs, given either as model instances or ids,
+        and returns a list of RegistrationResult in the same order.
+        Should concurrent registrations take the seats the batch counted on, the batch is rolled back and
+        decided again from the new counts, up to MAX_REGISTRATION_ATTEMPTS times.
+        """
+        requests = [RegistrationRequest(_as_id(student), _as_id(section)) for student, section in requests]
+        with request_span('bulk_registration', requests=len(requests)):
+            for attempt in range(1, MAX_REGISTRATION_ATTEMPTS + 1):
+                results, accepted_rows, sections = self._decide_batch(requests)
+                if not accepted_rows or self._write(accepted_rows, sections):
+                    log.debug(f"Bulk registration enrolled {len(accepted_rows)} of {len(results)} requests")
+                    for result in results:
+                        registration_outcomes.inc(result.status.name)
+                    return results
+                contention_stats.record_conflict()
+                contention_stats.record_retry()
+        log.error(f"Bulk registration gave up after {MAX_REGISTRATION_ATTEMPTS} seat conflicts")
+        raise RuntimeError("Bulk registration kept conflicting with concurrent registrations")
+
+    def _decide_batch(self, requests):
+        student_ids = {request.student_id for request in requests}
+        section_ids = {request.section_id for request in requests}
+
+        holds = self._load_holds(student_ids)
+        sections = self._load_sections(section_ids)
+        term_load = self._load_term_loads(student_ids)
+        prereq_graph.ensure_courses(self._session, {section.course_id for section in sections.values()})
+        enrolled_in, taken_courses = self._load_enrollments(student_ids)
+        schedules = self._load_schedules(student_ids)
+        closed_terms = {section.term for section in sections.values()
+                        if not term_states.is_open(self._session, *section.term)}
+
+        results = []
+        accepted_rows = []
+        for request in requests:
+            status = self._decide(request, holds, sections, term_load, enrolled_in, taken_courses, schedules,
+                                  closed_terms)
+            if status is RegistrationStatus.enrolled:
+                section = sections[request.section_id]
+                sections[request.section_id] = section._replace(enrolled_count=section.enrolled_count + 1)
+                term_load[(request.student_id,) + section.term] += 1
+                schedules[(request.student_id,) + section.term].add(request.section_id, *section.meeting)
+                enrolled_in[request.student_id].add(request.section_id)
+                taken_courses[request.student_id] |= prereq_graph.bit(section.course_id)
+                accepted_rows.append({'student_id': request.student_id, 'section_id': request.section_id})
+            results.append(RegistrationResult(request.student_id, request.section_id, status))
+        return results, accepted_rows, sections
+
+    def _write(self, accepted_rows, sections):
+        """ Writes the accepted rows and their counters, returns False if that would oversell a section """
+        try:
+            self._session.execute(student_roster.insert(), accepted_rows)
+            apply_enrollment_changes(self._session,
+                                     [(row['student_id'], row['section_id'], 1) for row in accepted_rows],
+                                     terms={section_id: section.term for section_id, section in sections.items()})
+            # The counter updates hold the section rows until commit, so this sees every concurrent enrolment
+            if overfilled_sections(self._session, {row['section_id'] for row in accepted_rows}):
+                self._session.rollback()
+                return False
+            self._session.commit()
+        except Exception:
+            self._session.rollback()
+            log.error("Bulk registration failed, no enrollments were written")
+            raise
+        finally:
+            # Relationship collections loaded before the insert would otherwise still show the old rosters
+            self._session.expire_all()
+        return True
+
+    @staticmethod
+    def _decide(request, holds, sections, term_load, enrolled_in, taken_courses, schedules, closed_terms):
+        if request.student_id not in holds or request.section_id not in sections:
+            return RegistrationStatus.not_found
+        if sections[request.section_id].term in closed_terms:
+            return RegistrationStatus.not_open
+        section = sections[request.section_id]
+        if term_load[(request.student_id,) + section.term] >= STUDENT_COURSE_LIMIT:
+            return RegistrationStatus.course_limit
+        if section.enrolled_count >= section.size_limit:
+            return RegistrationStatus.section_full
+        if not prereq_graph.satisfied(section.course_id, taken_courses[request.student_id]):
+            return RegistrationStatus.missing_prereq
+        if section.meeting[0] and schedules[(request.student_id,) + section.term]. \
+                conflict(*section.meeting, section_id=request.section_id) is not None:
+            return RegistrationStatus.schedule_conflict
+        if holds[request.student_id]:
+            return RegistrationStatus.restriction_hold
+        if request.section_id in enrolled_in[request.student_id]:
+            return RegistrationStatus.already_enrolled
+        return RegistrationStatus.enrolled
+
+    def _load_holds(self, student_ids):
+        holds = {}
+        for chunk in _chunks(student_ids):
+            rows = self._session.query(Student.id, Student.restriction_hold).filter(Student.id.in_(chunk))
+            holds.update((student_id, bool(hold)) for student_id, hold in rows)
+        return holds
+
+    def _load_sections(self, section_ids):
+        """ Maps section id to its SectionState """
+        sections = {}
+        for chunk in _chunks(section_ids):
+            rows = self._session.query(Section.id, CourseOffering.course_id, CourseOffering.year,
+                                       CourseOffering.quarter, Section.size_limit, Section.enrolled_count,
+                                       Section.days, Section.time, Section.end_time). \
+                join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+                filter(Section.id.in_(chunk))
+            sections.update((section_id, SectionState(course_id, (year, quarter), size_limit, enrolled,
+                                                      (days, start, end)))
+                            for section_id, course_id, year, quarter, size_limit, enrolled, days, start, end in rows)
+        return sections
+
+    def _load_term_loads(self, student_ids):
+        """ Maps (student id, year, quarter) to the number of sections the student is enrolled in """
+        term_load = defaultdict(int)
+        for chunk in _chunks(student_ids):
+            rows = self._session.query(StudentTermLoad.student_id, StudentTermLoad.year, StudentTermLoad.quarter,
+                                       StudentTermLoad.course_count). \
+                filter(StudentTermLoad.student_id.in_(chunk))
+            term_load.update(((student_id, year, quarter), course_count)
+                             for student_id, year, quarter, course_count in rows)
+        return term_load
+
+    def _load_schedules(self, student_ids):
+        """ Maps (student id, year, quarter) to the ScheduleIndex of the student's sections in that term """
+        schedules = defaultdict(ScheduleIndex)
+        for chunk in _chunks(student_ids):
+            rows = self._session.query(student_roster.c.student_id, CourseOffering.year, CourseOffering.quarter,
+                                       Section.id, Section.days, Section.time, Section.end_time). \
+                join(Section, Section.id == student_roster.c.section_id). \
+                join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+                filter(student_roster.c.student_id.in_(chunk)).filter(Section.days != 0)
+            for student_id, year, quarter, section_id, days, start, end in rows:
+                schedules[(student_id, year, quarter)].add(section_id, days, start, end)
+        return schedules
+
+    def _load_enrollments(self, student_ids):
+        """ Returns the enrolled section ids and the prereq_graph bitset of the taken courses of each student """
+        enrolled_in = defaultdict(set)
+        taken_courses = defaultdict(int)
+        for chunk in _chunks(student_ids):
+            rows = self._session.query(student_roster.c.student_id, student_roster.c.section_id,
+                                       CourseOffering.course_id). \
+                outerjoin(Section, Section.id == student_roster.c.section_id). \
+                outerjoin(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+                filter(student_roster.c.student_id.in_(chunk))
+            for student_id, section_id, course_id in rows:
+                enrolled_in[student_id].add(section_id)
+                if course_id is not None:
+                    taken_courses[student_id] |= prereq_graph.bit(course_id)
+            for student_id, course_id in archived_courses(self._session, chunk):
+                taken_courses[student_id] |= prereq_graph.bit(course_id)
+        return enrolled_in, taken_courses
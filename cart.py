@@ -0,0 +1,179 @@
+from collections import namedtuple, defaultdict
+from sqlalchemy import and_
+from courses import CourseOffering, Section, WaitlistEntry, student_roster
+from persons import Student
+from database import Database
+from enums import RegistrationStatus
+from course_registration import STUDENT_COURSE_LIMIT, contention_stats, promote_waitlisted
+from enrollment_counters import apply_enrollment_changes, overfilled_sections
+from prereq_graph import prereq_graph, archived_courses
+from schedule import ScheduleIndex
+from terms import term_states
+from instrumentation import request_span
+from logs import log
+
+db_session = Database().get_session()
+unit_of_work = Database().unit_of_work()
+
+"""
+Carts of section adds and drops that are checked out together or not at all.
+A checkout reads the student, the sections of the cart and the student's roster with three queries, decides every
+line against the same checks as the CourseRegChain, and writes the whole cart inside a savepoint with one statement
+per table. The number of round trips does not depend on how many lines the cart has."""
+
+# committed tells whether the cart was applied, rejected maps the lines that kept it from being applied to a status
+CheckoutResult = namedtuple('CheckoutResult', ['committed', 'added', 'dropped', 'rejected'])
+CartSection = namedtuple('CartSection', ['course_id', 'term', 'size_limit', 'enrolled_count', 'meeting'])
+
+
+def _as_id(obj):
+    return getattr(obj, 'id', obj)
+
+
+class Cart:
+    """
+    The adds and drops of one student. Drops are applied before adds, so a cart can give up a seat, a slot in
+    the schedule or a place under the course limit to a section it adds.
+    """
+    def __init__(self, student):
+        self.student_id = _as_id(student)
+        self.adds = []
+        self.drops = []
+
+    def add(self, section):
+        section_id = _as_id(section)
+        if section_id not in self.adds:
+            self.adds.append(section_id)
+        return self
+
+    def drop(self, section):
+        section_id = _as_id(section)
+        if section_id not in self.drops:
+            self.drops.append(section_id)
+        return self
+
+    @request_span('checkout')
+    @unit_of_work
+    def checkout(self):
+        """
+        Applies the cart in the current unit of work and returns a CheckoutResult.
+        Nothing is written when any line is rejected, or when a section the cart adds filled up while the cart
+        was being decided. Seats given up go to the waitlists afterwards.
+        """
+        student = db_session.query(Student.id, Student.restriction_hold).filter(Student.id == self.student_id).first()
+        sections = self._load_sections()
+        enrolled, taken_courses, schedule, term_load = self._load_roster(sections)
+        rejected = self._decide(student, sections, enrolled, taken_courses, schedule, term_load)
+        if not rejected:
+            rejected = self._write(sections)
+        if rejected:
+            log.debug(f"Cart of student {self.student_id} was not checked out: "
+                      f"{ {section_id: status.name for section_id, status in rejected.items()} }")
+            return CheckoutResult(False, [], [], rejected)
+        self._promote_waitlisted()
+        return CheckoutResult(True, list(self.adds), list(self.drops), {})
+
+    def _load_sections(self):
+        rows = db_session.query(Section.id, CourseOffering.course_id, CourseOffering.year, CourseOffering.quarter,
+                                Section.size_limit, Section.enrolled_count, Section.days, Section.time,
+                                Section.end_time). \
+            join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+            filter(Section.id.in_(set(self.adds) | set(self.drops)))
+        sections = {section_id: CartSection(course_id, (year, quarter), size_limit, enrolled, (days, start, end))
+                    for section_id, course_id, year, quarter, size_limit, enrolled, days, start, end in rows}
+        prereq_graph.ensure_courses(db_session, {section.course_id for section in sections.values()})
+        return sections
+
+    def _load_roster(self, sections):
+        """ The student's roster as it will be once the drops are applied """
+        rows = db_session.query(student_roster.c.section_id, CourseOffering.course_id, CourseOffering.year,
+                                CourseOffering.quarter, Section.days, Section.time, Section.end_time). \
+            join(Section, Section.id == student_roster.c.section_id). \
+            join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+            filter(student_roster.c.student_id == self.student_id)
+        enrolled = set()
+        taken_courses = 0
+        schedule = defaultdict(ScheduleIndex)
+        term_load = defaultdict(int)
+        for section_id, course_id, year, quarter, days, start, end in rows:
+            enrolled.add(section_id)
+            if section_id in self.drops:
+                continue
+            taken_courses |= prereq_graph.bit(course_id)
+            schedule[(year, quarter)].add(section_id, days, start, end)
+            term_load[(year, quarter)] += 1
+        for _, course_id in archived_courses(db_session, [self.student_id]):
+            taken_courses |= prereq_graph.bit(course_id)
+        return enrolled, taken_courses, schedule, term_load
+
+    def _decide(self, student, sections, enrolled, taken_courses, schedule, term_load):
+        """ The status of every line that keeps the cart from being applied, in the CourseRegChain's order """
+        rejected = {}
+        for section_id in self.drops:
+            if section_id not in enrolled:
+                rejected[section_id] = RegistrationStatus.not_enrolled
+            elif section_id in sections and not term_states.is_open(db_session, *sections[section_id].term):
+                rejected[section_id] = RegistrationStatus.not_open
+        for section_id in self.adds:
+            section = sections.get(section_id)
+            if student is None or section is None:
+                status = RegistrationStatus.not_found
+            elif not term_states.is_open(db_session, *section.term):
+                status = RegistrationStatus.not_open
+            elif term_load[section.term] >= STUDENT_COURSE_LIMIT:
+                status = RegistrationStatus.course_limit
+            elif section.enrolled_count - (section_id in self.drops) >= section.size_limit:
+                status = RegistrationStatus.section_full
+            elif not prereq_graph.satisfied(section.course_id, taken_courses):
+                status = RegistrationStatus.missing_prereq
+            elif section.meeting[0] and schedule[section.term].conflict(*section.meeting, section_id=section_id) \
+                    is not None:
+                status = RegistrationStatus.schedule_conflict
+            elif student.restriction_hold:
+                status = RegistrationStatus.restriction_hold
+            elif section_id in enrolled and section_id not in self.drops:
+                status = RegistrationStatus.already_enrolled
+            else:
+                term_load[section.term] += 1
+                taken_courses |= prereq_graph.bit(section.course_id)
+                schedule[section.term].add(section_id, *section.meeting)
+                continue
+            rejected[section_id] = status
+        return rejected
+
+    def _write(self, sections):
+        """ Writes the cart in a savepoint, returns the sections that were oversold by concurrent registrations """
+        # A section both dropped and added stays as it is
+        drops = [section_id for section_id in self.drops if section_id not in self.adds]
+        adds = [section_id for section_id in self.adds if section_id not in self.drops]
+        changes = [(self.student_id, section_id, -1) for section_id in drops] + \
+                  [(self.student_id, section_id, 1) for section_id in adds]
+        if not changes:
+            return {}
+        savepoint = db_session.begin_nested()
+        if drops:
+            db_session.execute(student_roster.delete().where(and_(student_roster.c.student_id == self.student_id,
+                                                                  student_roster.c.section_id.in_(drops))))
+        if adds:
+            db_session.execute(student_roster.insert(), [{'student_id': self.student_id, 'section_id': section_id}
+                                                         for section_id in adds])
+        apply_enrollment_changes(db_session, changes,
+                                 terms={section_id: section.term for section_id, section in sections.items()})
+        # The counter updates hold the section rows until commit, so this sees every concurrent enrolment
+        overfilled = overfilled_sections(db_session, adds) if adds else []
+        if overfilled:
+            savepoint.rollback()
+            contention_stats.record_conflict()
+            return {section_id: RegistrationStatus.section_full for section_id in overfilled}
+        savepoint.commit()
+        # Relationship collections loaded before the writes would otherwise still show the old roster
+        db_session.expire_all()
+        return {}
+
+    def _promote_waitlisted(self):
+        dropped = [section_id for section_id in self.drops if section_id not in self.adds]
+        if dropped:
+            waiting = [section_id for section_id, in db_session.query(WaitlistEntry.section_id).
+                       filter(WaitlistEntry.section_id.in_(dropped)).distinct()]
+            if waiting:
+                promote_waitlisted(waiting)
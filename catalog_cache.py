@@ -0,0 +1,207 @@
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from database import Database
+from logs import log
+
+"""
+Bounded LRU cache of catalog query results, keyed by the normalized filters of the query.
+Results are stored as immutable records detached from any session, so a hit never hands out ORM state.
+CourseBuilder invalidates the entries whose filters match the course, offering or section it writes once its
+transaction ends, so a reader can not cache the rows of a write that has not committed yet."""
+
+CourseRecord = namedtuple('CourseRecord', ['id', 'name', 'course_code', 'description', 'department', 'prereq_ids'])
+OfferingRecord = namedtuple('OfferingRecord', ['id', 'course_id', 'year', 'quarter'])
+# The seat counts change with every registration and are left out, they are read from the Section itself
+SectionRecord = namedtuple('SectionRecord', ['id', 'course_offering_id', 'location', 'type', 'time', 'size_limit',
+                                             'instructor_ids'])
+CatalogRow = namedtuple('CatalogRow', ['Course', 'CourseOffering', 'Section'])
+CatalogKey = namedtuple('CatalogKey', ['name', 'course_code', 'dept', 'quarter', 'instructor_id', 'section_type',
+                                       'keyword'])
+# What is known of a catalog write, None standing for unknown, which matches any filter
+CatalogChange = namedtuple('CatalogChange', ['name', 'course_code', 'description', 'dept', 'quarter',
+                                             'section_type', 'instructor_ids'],
+                           defaults=[None] * 7)
+
+# The replica_reads key of catalog reads, written to by every invalidation
+CATALOG_KEY = ('catalog',)
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 300
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# The session.info entry holding the CatalogChanges of the session's transaction
+PENDING_CHANGES = 'catalog_changes'
+
+
+def catalog_key(name=None, course_code=None, dept=None, quarter=None, instructor=None, section_type=None,
+                keyword=None):
+    """ The cache key of a view_courses call, equal for filters that select the same rows """
+    return CatalogKey(name.lower() if name else None,
+                      str(course_code) if course_code else None,
+                      dept or None,
+                      quarter or None,
+                      instructor.id if instructor else None,
+                      section_type or None,
+                      keyword.lower() if keyword else None)
+
+
+def affects(key, change):
+    """ Whether a write described by change can add, drop or alter a row of the query with this key """
+    if key.name is not None and change.name is not None and key.name not in change.name.lower():
+        return False
+    texts = (change.name, change.course_code, change.description)
+    if key.keyword is not None and None not in texts and not any(key.keyword in str(text).lower() for text in texts):
+        return False
+    if key.course_code is not None and change.course_code is not None and key.course_code != str(change.course_code):
+        return False
+    for filtered, changed in ((key.dept, change.dept), (key.quarter, change.quarter),
+                              (key.section_type, change.section_type)):
+        if filtered is not None and changed is not None and filtered != changed:
+            return False
+    if key.instructor_id is not None and change.instructor_ids is not None and \
+            key.instructor_id not in change.instructor_ids:
+        return False
+    return True
+
+
+def _size_of(value):
+    """ Rough size in bytes of cached rows, counting the nested tuples and their fields """
+    size = sys.getsizeof(value)
+    if isinstance(value, tuple):
+        size += sum(_size_of(item) for item in value)
+    return size
+
+
+class CatalogCache:
+    """
+    Thread-safe LRU cache of catalog results with a time to live and a ceiling on the entry count and on their
+    estimated size. A load that overlaps an invalidation is not stored, so a result read before a write
+    committed can not outlive it.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generation = 0
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._invalidate_listeners = []
+
+    def on_invalidate(self, listener):
+        """ Registers a callable to call with the CatalogChange of every invalidation, for caches of catalog data """
+        self._invalidate_listeners.append(listener)
+
+    def configure(self, max_entries=None, ttl=None, max_bytes=None):
+        """ Changes the limits, entries over the new ones are evicted on the next store """
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if ttl is not None:
+                self.ttl = ttl
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+
+    def get_or_load(self, key, load):
+        """ The cached rows for key, calling load() for them on a miss or when they expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            generation = self._generation
+        rows = load()
+        self._store(key, rows, generation)
+        return rows
+
+    def invalidate(self, change=CatalogChange()):
+        """
+        Drops the entries whose results the described write can change, all of them by default.
+        Catalog reads stay on the primary for a while, so that a replica that lags does not load the old rows again.
+        """
+        Database().note_write(CATALOG_KEY)
+        with self._lock:
+            self._generation += 1
+            stale = [key for key in self._entries if affects(key, change)]
+            for key in stale:
+                self._drop(key)
+            self.invalidations += len(stale)
+        for listener in self._invalidate_listeners:
+            listener(change)
+        if stale:
+            log.debug(f"Catalog cache dropped {len(stale)} entries")
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def reset(self):
+        """ Clears the entries and the counters """
+        self.clear()
+        with self._lock:
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _store(self, key, rows, generation):
+        size = _size_of(rows)
+        with self._lock:
+            if generation != self._generation or size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, rows, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+
+def invalidate_on_commit(session, change):
+    """
+    Invalidates the change when the session's transaction ends. A rollback invalidates it too, since reads made
+    inside the transaction may have cached its rows.
+    """
+    session.info.setdefault(PENDING_CHANGES, []).append(change)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    # Also called when a savepoint is released, the outer transaction has not committed yet then
+    if session.in_nested_transaction():
+        return
+    for change in session.info.pop(PENDING_CHANGES, ()):
+        catalog_cache.invalidate(change)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _invalidate_rolled_back(session, previous_transaction):
+    # A savepoint's rollback leaves the changes of the outer transaction for its end
+    if not previous_transaction.nested:
+        for change in session.info.pop(PENDING_CHANGES, ()):
+            catalog_cache.invalidate(change)
+
+
+catalog_cache = CatalogCache()
+Database().on_configure(catalog_cache.clear)
@@ -0,0 +1,263 @@
+import argparse
+import csv
+import json
+from collections import namedtuple
+from itertools import islice
+from sqlalchemy import insert
+from courses import Course, CourseOffering, Section, prereqs, instructor_roster
+from persons import Instructor
+from database import Database
+from enums import Department, Quarter, SectionType
+from prereq_graph import prereq_graph
+from search_index import course_search_index
+from catalog_cache import catalog_cache
+from schedule import parse_days, parse_time
+from logs import log
+
+unit_of_work = Database().unit_of_work()
+
+"""
+Streaming import of a term's catalog from CSV or JSONL files, one section per row:
+course_code, name, description, department, prereqs, year, quarter, location, type, time, size_limit, instructors,
+and optionally end_time and days (letters like "MWF").
+prereqs are course codes and instructors "First Last" names, several of them separated by ';' (or JSON lists).
+Rows are read lazily and written in chunks with one executemany per table, committing every commit_interval rows.
+Courses and offerings that exist already are reused, duplicate courses and sections are reported and skipped.
+Run it with `python catalog_import.py fall.csv [winter.jsonl ...] [--chunk-size 1000] [--commit-interval 10000]`."""
+
+CHUNK_SIZE = 1000
+COMMIT_INTERVAL = 10000
+
+ImportReport = namedtuple('ImportReport', ['rows', 'courses', 'offerings', 'sections', 'duplicates', 'errors'])
+CatalogRecord = namedtuple('CatalogRecord', ['number', 'course_code', 'name', 'description', 'department',
+                                             'prereq_codes', 'year', 'quarter', 'location', 'type', 'time',
+                                             'size_limit', 'instructors', 'end_time', 'days'])
+
+
+def read_rows(path):
+    """ Yields the rows of a .jsonl or .csv file as dicts, one at a time """
+    with open(path, newline='') as handle:
+        if path.endswith('.jsonl'):
+            for line in handle:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(handle)
+
+
+def _split(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [part.strip() for part in value.split(';') if part.strip()]
+    return list(value)
+
+
+def parse_row(number, row):
+    """ The CatalogRecord of a raw row, raises KeyError or ValueError for rows that can not be imported """
+    return CatalogRecord(number, str(row['course_code']), row['name'], row.get('description') or None,
+                         Department[row['department']], _split(row.get('prereqs')), int(row['year']),
+                         Quarter[row['quarter']], row['location'], SectionType[row['type']],
+                         parse_time(row.get('time') or None), int(row.get('size_limit') or 30),
+                         _split(row.get('instructors')),
+                         parse_time(row.get('end_time') or None), int(parse_days(row.get('days'))))
+
+
+class CatalogImporter:
+    """
+    Imports catalog rows in chunks of chunk_size. The ids of the courses, offerings and instructors seen are kept
+    to resolve later rows, so memory grows with the size of the catalog but not with the length of the files.
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE, commit_interval=COMMIT_INTERVAL):
+        self._chunk_size = chunk_size
+        self._commit_interval = commit_interval
+        self._course_ids = {}
+        self._offering_ids = {}
+        self._instructor_ids = None
+        self._new_courses = []
+        self._counts = dict.fromkeys(ImportReport._fields, 0)
+
+    def import_files(self, paths):
+        for path in paths:
+            log.debug(f"Importing the catalog in {path}")
+            self.import_rows(read_rows(path))
+        return self.report()
+
+    def import_rows(self, rows):
+        """ Imports an iterable of row dicts, committing every commit_interval rows """
+        rows = iter(rows)
+        chunks = iter(lambda: list(islice(rows, self._chunk_size)), [])
+        more = True
+        while more:
+            more = False
+            imported = 0
+            with unit_of_work as session:
+                for chunk in chunks:
+                    self._import_chunk(session, chunk)
+                    imported += len(chunk)
+                    if imported >= self._commit_interval:
+                        more = True
+                        break
+            self._publish()
+        return self.report()
+
+    def report(self):
+        return ImportReport(**self._counts)
+
+    def _import_chunk(self, session, chunk):
+        records = []
+        for row in chunk:
+            self._counts['rows'] += 1
+            try:
+                records.append(parse_row(self._counts['rows'], row))
+            except (KeyError, ValueError) as error:
+                log.error(f"Skipping catalog row {self._counts['rows']}, bad or missing value {error}")
+                self._counts['errors'] += 1
+        records = self._insert_courses(session, records)
+        self._insert_offerings(session, records)
+        self._insert_sections(session, records)
+
+    def _load_course_ids(self, session, codes):
+        codes = [code for code in codes if code not in self._course_ids]
+        if codes:
+            self._course_ids.update((code, course_id) for course_id, code in
+                                    session.query(Course.id, Course.course_code).filter(Course.course_code.in_(codes)))
+
+    def _insert_courses(self, session, records):
+        """ Inserts the courses seen for the first time with their prereqs, returns the records left to import """
+        self._load_course_ids(session, {record.course_code for record in records} |
+                              {code for record in records for code in record.prereq_codes})
+        new = {}
+        for record in records:
+            if record.course_code not in self._course_ids:
+                new.setdefault(record.course_code, record)
+        taken = {name for name, in session.query(Course.name).
+                 filter(Course.name.in_([record.name for record in new.values()]))}
+        rejected = set()
+        for code, record in list(new.items()):
+            if record.name in taken:
+                log.error("Error due to attempted insertion of duplicate new course")
+                self._counts['duplicates'] += 1
+                rejected.add(code)
+                del new[code]
+            taken.add(record.name)
+        if new:
+            session.execute(insert(Course), [{'course_code': code, 'name': record.name,
+                                              'description': record.description,
+                                              'department': record.department} for code, record in new.items()])
+            self._load_course_ids(session, new)
+            self._counts['courses'] += len(new)
+            self._insert_prereqs(session, new)
+        return [record for record in records if record.course_code not in rejected]
+
+    def _insert_prereqs(self, session, new):
+        # Only courses defined before a course can be its prereqs, which rules out cycles
+        defined = set(self._course_ids).difference(new)
+        links = []
+        for code, record in new.items():
+            prereq_ids = []
+            for prereq_code in record.prereq_codes:
+                if prereq_code in defined:
+                    prereq_ids.append(self._course_ids[prereq_code])
+                else:
+                    log.error(f"Unknown prerequisite {prereq_code} of course {code} in catalog row {record.number}")
+                    self._counts['errors'] += 1
+            defined.add(code)
+            course_id = self._course_ids[code]
+            links.extend({'course_id': course_id, 'prereq_id': prereq_id} for prereq_id in prereq_ids)
+            self._new_courses.append((course_id, prereq_ids, record))
+        if links:
+            session.execute(prereqs.insert(), links)
+
+    def _offering_key(self, record):
+        return self._course_ids[record.course_code], record.year, record.quarter
+
+    def _insert_offerings(self, session, records):
+        keys = {self._offering_key(record) for record in records} - set(self._offering_ids)
+        if not keys:
+            return
+        self._load_offering_ids(session, keys)
+        missing = [key for key in keys if key not in self._offering_ids]
+        if missing:
+            session.execute(insert(CourseOffering), [{'course_id': course_id, 'year': year, 'quarter': quarter}
+                                                     for course_id, year, quarter in missing])
+            self._load_offering_ids(session, set(missing))
+            self._counts['offerings'] += len(missing)
+
+    def _load_offering_ids(self, session, keys):
+        rows = session.query(CourseOffering.id, CourseOffering.course_id, CourseOffering.year,
+                             CourseOffering.quarter). \
+            filter(CourseOffering.course_id.in_({course_id for course_id, _, _ in keys})).order_by(CourseOffering.id)
+        for offering_id, *key in rows:
+            if tuple(key) in keys:
+                self._offering_ids.setdefault(tuple(key), offering_id)
+
+    def _insert_sections(self, session, records):
+        offering_ids = {self._offering_ids[self._offering_key(record)] for record in records}
+        existing = set(self._section_ids(session, offering_ids))
+        new = {}
+        for record in records:
+            key = (self._offering_ids[self._offering_key(record)], record.location, record.type, record.time)
+            if key in existing or key in new:
+                log.error("Error due to attempted insertion of duplicate new course section")
+                self._counts['duplicates'] += 1
+            else:
+                new[key] = record
+        if not new:
+            return
+        session.execute(insert(Section), [{'course_offering_id': offering_id, 'location': location, 'type': type_,
+                                           'time': time_, 'end_time': record.end_time, 'days': record.days,
+                                           'size_limit': record.size_limit}
+                                          for (offering_id, location, type_, time_), record in new.items()])
+        self._counts['sections'] += len(new)
+        assignments = []
+        for key, section_id in self._section_ids(session, offering_ids).items():
+            if key in new:
+                assignments.extend({'instructor_id': instructor_id, 'section_id': section_id}
+                                   for instructor_id in self._resolve_instructors(session, new[key]))
+        if assignments:
+            session.execute(instructor_roster.insert(), assignments)
+
+    @staticmethod
+    def _section_ids(session, offering_ids):
+        return {(offering_id, location, type_, time_): section_id for section_id, offering_id, location, type_, time_
+                in session.query(Section.id, Section.course_offering_id, Section.location, Section.type,
+                                 Section.time).filter(Section.course_offering_id.in_(offering_ids))}
+
+    def _resolve_instructors(self, session, record):
+        if self._instructor_ids is None:
+            self._instructor_ids = {}
+            for instructor_id, first_name, last_name in session.query(Instructor.id, Instructor.first_name,
+                                                                      Instructor.last_name).order_by(Instructor.id):
+                self._instructor_ids.setdefault(f"{first_name} {last_name}".lower(), instructor_id)
+        instructor_ids = []
+        for name in record.instructors:
+            instructor_id = self._instructor_ids.get(name.lower())
+            if instructor_id is None:
+                log.error(f"Unknown instructor {name} in catalog row {record.number}")
+                self._counts['errors'] += 1
+            else:
+                instructor_ids.append(instructor_id)
+        return instructor_ids
+
+    def _publish(self):
+        """ Hands the committed courses to the in-process catalog structures """
+        for course_id, prereq_ids, record in self._new_courses:
+            prereq_graph.add_course(course_id, prereq_ids)
+            course_search_index.add_course(course_id, record.name, record.course_code, record.description)
+        self._new_courses = []
+        catalog_cache.invalidate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import courses, offerings and sections from CSV or JSONL files")
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--commit-interval', type=int, default=COMMIT_INTERVAL)
+    args = parser.parse_args()
+    report = CatalogImporter(args.chunk_size, args.commit_interval).import_files(args.paths)
+    print(json.dumps(report._asdict()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,88 +1,390 @@
+import base64
+import binascii
+import json
+import threading
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from sqlalchemy import UniqueConstraint, and_, event, func, or_, select, tuple_
+from sqlalchemy.dialects import mysql, postgresql
 from sqlalchemy.exc import IntegrityError, InterfaceError
-from courses import Course, CourseOffering, Section
-from persons import Student, Instructor, Advisor
+from sqlalchemy.orm import selectinload
+from courses import Course, CourseOffering, Section, prereqs, instructor_roster
+from persons import Student, Instructor, Advisor, student_key
 from database import Database
+from prereq_graph import prereq_graph, PrereqCycleError
+from search_index import course_search_index, text_filter
+from catalog_cache import catalog_cache, catalog_key, CatalogChange, CatalogRow, CourseRecord, OfferingRecord, \
+    SectionRecord, CATALOG_KEY, invalidate_on_commit
+from schedule import parse_days, parse_time
 from logs import log
 
 db_session = Database().get_session()
+unit_of_work = Database().unit_of_work()
 STUDENT_COURSE_LIMIT = 3
+PAGE_SIZE = 100
+STREAM_CHUNK_SIZE = 1000
+# The sort key of catalog pages and streams, unique per row so that a cursor points between two rows.
+# Courses without a code sort as the empty code, a NULL would compare as unknown and end the pages early
+CATALOG_ORDER = (func.coalesce(Course.course_code, ''), Section.id)
+# The relationships loaded along with the rows of view_courses, so rendering them runs no further queries
+CATALOG_LOADS = (selectinload(Course.prereqs), selectinload(CourseOffering.sections),
+                 selectinload(Section.instructor))
+# Distinct keys bulk_get_or_create resolves with one round of statements, well under the bound parameter limits
+UPSERT_BATCH_SIZE = 500
+
+CatalogPage = namedtuple('CatalogPage', ['rows', 'next_cursor'])
 
 
 class CourseBuilder:
     """
     Class to build courses in a chained manner. Will only add components if the composite is present.
     For example, will only add section if the course offering is present.
+    Every step runs in its own unit of work, or joins the caller's one, and invalidates the cached catalog
+    results it can change when that unit of work ends. A step that fails is logged and rolled back to a
+    savepoint, which leaves the caller's unit of work usable.
     """
     def __init__(self, course_id=None, course_offering_id=None):
         self.course_id = course_id
         self.course_offering_id = course_offering_id
 
     def create_new_course(self, name, description, course_code, department, prereqs):
+        prereq_ids = [prereq.id for prereq in prereqs]
         try:
-            new_course = Course(name=name, course_code=course_code, description=description, department=department)
-            for prereq in prereqs:
-                new_course.prereqs.append(prereq)
-            db_session.add(new_course)
-            db_session.flush()
-            self.course_id = new_course.id
+            with unit_of_work as session, session.begin_nested():
+                new_course = Course(name=name, course_code=course_code, description=description,
+                                    department=department)
+                for prereq in prereqs:
+                    new_course.prereqs.append(prereq)
+                session.add(new_course)
+                session.flush()
+                prereq_graph.ensure_courses(session, prereq_ids)
+                prereq_graph.check_acyclic(new_course.id, prereq_ids)
+                course_id = new_course.id
+                invalidate_on_commit(session, CatalogChange(name, course_code, description, department))
+            prereq_graph.add_course(course_id, prereq_ids)
+            course_search_index.add_course(course_id, name, course_code, description)
+            self.course_id = course_id
         except IntegrityError:
-            db_session.rollback()
             log.error("Error due to attempted insertion of duplicate new course")
-        finally:
-            db_session.commit()
-            return self
+        except PrereqCycleError:
+            log.error("Error due to attempted insertion of a course that is its own prerequisite")
+        return self
 
     def create_new_course_offering(self, year, quarter):
         if self.course_id:
             try:
-                new_offering = CourseOffering(course_id=self.course_id, year=year, quarter=quarter)
-                db_session.add(new_offering)
-                db_session.flush()
-                self.course_offering_id = new_offering.id
+                with unit_of_work as session, session.begin_nested():
+                    new_offering = CourseOffering(course_id=self.course_id, year=year, quarter=quarter)
+                    session.add(new_offering)
+                    session.flush()
+                    self.course_offering_id = new_offering.id
+                    invalidate_on_commit(session, _catalog_change(session.get(Course, self.course_id),
+                                                                  quarter=quarter))
             except (IntegrityError, TypeError):
-                db_session.rollback()
                 log.error("Error due to attempted insertion of duplicate new course offering")
-        db_session.commit()
         return self
 
-    def create_new_section(self, location, instructor, section_type, time_):
+    def create_new_section(self, location, instructor, section_type, time_, end_time=None, days=0):
+        """ time_ and end_time are times or "HH:MM" strings, days are Weekday flags or letters like "MWF" """
         if self.course_offering_id:
             try:
-                new_section = Section(course_offering_id=self.course_offering_id, type=section_type,
-                                      location=location, time=time_)
-                new_section.instructor = instructor
-                db_session.add(new_section)
+                with unit_of_work as session, session.begin_nested():
+                    new_section = Section(course_offering_id=self.course_offering_id, type=section_type,
+                                          location=location, time=parse_time(time_), end_time=parse_time(end_time),
+                                          days=int(parse_days(days)))
+                    new_section.instructor = instructor
+                    session.add(new_section)
+                    session.flush()
+                    offering = session.get(CourseOffering, self.course_offering_id)
+                    invalidate_on_commit(session, _catalog_change(offering.course, offering.quarter, section_type,
+                                                                  [person.id for person in instructor]))
             except IntegrityError:
-                db_session.rollback()
                 log.error("Error due to attempted insertion of duplicate new course section")
-        db_session.commit()
         return self
 
+    @staticmethod
+    def assign_instructors(section_id, instructors):
+        """ Replaces the instructors of a section """
+        with unit_of_work as session:
+            section = session.get(Section, section_id)
+            instructor_ids = {person.id for person in section.instructor} | {person.id for person in instructors}
+            section.instructor = list(instructors)
+            offering = section.offerings
+            invalidate_on_commit(session, _catalog_change(offering.course, offering.quarter, section.type,
+                                                          instructor_ids))
+
+
+def _catalog_change(course, quarter=None, section_type=None, instructor_ids=None):
+    return CatalogChange(course.name, course.course_code, course.description, course.department, quarter,
+                         section_type, instructor_ids)
+
+
+def catalog_filters(name=None, course_code=None, dept=None, quarter=None, instructor=None, section_type=None,
+                    keyword=None):
+    """
+    The filter criteria of a view_courses call, shared by the sync and the async viewers.
+    Text filters are turned into course ids by the course_search_index, which has to be refreshed first.
+    """
+    criteria = []
+    if name:
+        criteria.append(text_filter(name, fields=('name',)))
+    if keyword:
+        criteria.append(text_filter(keyword))
+    if course_code:
+        criteria.append(Course.course_code == course_code)
+    if dept:
+        criteria.append(Course.department == dept)
+    if quarter:
+        criteria.append(CourseOffering.quarter == quarter)
+    if instructor:
+        criteria.append(Section.instructor.contains(instructor))
+    if section_type:
+        criteria.append(Section.type == section_type)
+    return criteria
+
+
+def _catalog_columns(session, *extra):
+    """ The columns of the catalog records, one row per section """
+    return session.query(Course.id, Course.name, Course.course_code, Course.description, Course.department,
+                         CourseOffering.id, CourseOffering.year, CourseOffering.quarter, Section.id,
+                         Section.location, Section.type, Section.time, Section.size_limit, *extra). \
+        select_from(Course).join(CourseOffering, Course.id == CourseOffering.course_id). \
+        join(Section, CourseOffering.id == Section.course_offering_id)
+
+
+def _catalog_row(columns, prereq_ids, instructor_ids, course=None):
+    """ The CatalogRow of the columns of _catalog_columns, reusing course when it is the record of the course """
+    course_id, name, code, description, department, offering_id, year, quarter, section_id, location, \
+        section_type, time_, size_limit = columns
+    if course is None or course.id != course_id:
+        course = CourseRecord(course_id, name, code, description, department, tuple(sorted(set(prereq_ids))))
+    return CatalogRow(course, OfferingRecord(offering_id, course_id, year, quarter),
+                      SectionRecord(section_id, offering_id, location, section_type, time_, size_limit,
+                                    tuple(sorted(set(instructor_ids)))))
+
+
+def _catalog_rows(session, rows, course_ids, section_ids):
+    """ The records of rows, with the prereqs of course_ids and the instructors of section_ids """
+    prereq_ids = defaultdict(list)
+    for course_id, prereq_id in session.execute(select(prereqs.c.course_id, prereqs.c.prereq_id).
+                                                where(prereqs.c.course_id.in_(course_ids))):
+        prereq_ids[course_id].append(prereq_id)
+    instructor_ids = defaultdict(list)
+    for section_id, instructor_id in session.execute(
+            select(instructor_roster.c.section_id, instructor_roster.c.instructor_id).
+            where(instructor_roster.c.section_id.in_(section_ids))):
+        instructor_ids[section_id].append(instructor_id)
+    # Rows of the same course share its record
+    courses = {}
+    records = []
+    for columns in rows:
+        record = _catalog_row(columns, prereq_ids[columns[0]], instructor_ids[columns[8]], courses.get(columns[0]))
+        courses[columns[0]] = record.Course
+        records.append(record)
+    return tuple(records)
+
+
+def catalog_records(session, criteria):
+    """
+    CatalogRow records of the catalog rows matching criteria, read as plain columns with three queries however
+    many rows match: the rows, the prereqs of their courses and the instructors of their sections.
+    """
+    matching = _catalog_columns(session).filter(*criteria)
+    rows = matching.all()
+    if not rows:
+        return ()
+    # As subqueries the matching ids are never correlated with the association tables read with them
+    course_ids = matching.with_entities(Course.id.label('course_id')).subquery()
+    section_ids = matching.with_entities(Section.id.label('section_id')).subquery()
+    return _catalog_rows(session, rows, select(course_ids.c.course_id), select(section_ids.c.section_id))
+
+
+def encode_cursor(key):
+    """ The opaque cursor of a page that ends at the row with the sort key key """
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ The sort key of an encode_cursor cursor, raises ValueError for anything else """
+    try:
+        course_code, section_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, binascii.Error) as error:
+        raise ValueError(f"Invalid page cursor {cursor!r}") from error
+    return course_code, section_id
+
+
+def catalog_page(session, criteria, cursor=None, limit=PAGE_SIZE):
+    """
+    The CatalogPage of at most limit records matching criteria after cursor, in CATALOG_ORDER.
+    The page starts with an index seek past the last key of the previous one, so deep pages cost the same as
+    the first. The cursor of the last page is None.
+    """
+    query = _catalog_columns(session).filter(*criteria)
+    if cursor is not None:
+        query = query.filter(tuple_(*CATALOG_ORDER) > tuple_(*decode_cursor(cursor)))
+    rows = query.order_by(*CATALOG_ORDER).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return CatalogPage((), None)
+    records = _catalog_rows(session, rows, {columns[0] for columns in rows}, {columns[8] for columns in rows})
+    last = records[-1]
+    return CatalogPage(records, encode_cursor((last.Course.course_code or '', last.Section.id)) if more else None)
+
+
+def stream_catalog_records(session, criteria, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Runs the query and returns a generator of the CatalogRow records matching criteria in CATALOG_ORDER, which
+    fetches chunk_size rows at a time from a server-side cursor where the driver has them. The prereqs and
+    instructors are outer joined into the same statement, so the session runs nothing else while the rows stream
+    in; finish or close the generator before using the session again.
+    """
+    course_prereqs = prereqs.alias()
+    section_instructors = instructor_roster.alias()
+    statement = _catalog_columns(session, course_prereqs.c.prereq_id, section_instructors.c.instructor_id). \
+        outerjoin(course_prereqs, course_prereqs.c.course_id == Course.id). \
+        outerjoin(section_instructors, section_instructors.c.section_id == Section.id). \
+        filter(*criteria).order_by(*CATALOG_ORDER).statement
+    # Without yield_per the ORM would fetch every row before handing out the first
+    result = session.execute(statement.execution_options(stream_results=True, yield_per=chunk_size))
+    return _streamed_records(result, chunk_size)
+
+
+def _streamed_records(result, chunk_size):
+    columns, prereq_ids, instructor_ids, course = None, [], [], None
+    try:
+        for rows in result.partitions(chunk_size):
+            for row in rows:
+                # Rows of a section are adjacent, one for each of its prereq and instructor pairs
+                if columns is not None and row[8] != columns[8]:
+                    record = _catalog_row(columns, prereq_ids, instructor_ids, course)
+                    course = record.Course
+                    yield record
+                    prereq_ids, instructor_ids = [], []
+                columns = tuple(row[:13])
+                if row[13] is not None:
+                    prereq_ids.append(row[13])
+                if row[14] is not None:
+                    instructor_ids.append(row[14])
+        if columns is not None:
+            yield _catalog_row(columns, prereq_ids, instructor_ids, course)
+    finally:
+        result.close()
+
+
+@contextmanager
+def _counting_statements(session, counts):
+    """ Counts the statements the session's connection runs inside the block in counts['statements'] """
+    connection = session.connection()
+
+    def count(*args):
+        counts['statements'] += 1
+
+    counts['statements'] = 0
+    event.listen(connection, 'before_cursor_execute', count)
+    try:
+        yield counts
+    finally:
+        event.remove(connection, 'before_cursor_execute', count)
+
 
 class CourseViewer:
-    """ Class to help in viewing courses """
+    """
+    Class to help in viewing courses.
+    Catalog reads go to a replica, unless the catalog was written to within the sticky window, and reads of a
+    student's roster unless the student registered within it.
+    query_count is the number of statements the last view_course_records call ran.
+    """
     def __init__(self):
         self.queried_courses = db_session.query(Course, CourseOffering, Section). \
             filter(CourseOffering.id == Section.course_offering_id). \
-            filter(Course.id == CourseOffering.course_id)
-
-    def view_courses(self, name=None, course_code=None, dept=None, quarter=None, instructor=None, section_type=None):
-        if name:
-            self.queried_courses = self.queried_courses.filter(Course.name.like('%' + name + '%'))
-        if course_code:
-            self.queried_courses = self.queried_courses.filter(Course.course_code == course_code)
-        if dept:
-            self.queried_courses = self.queried_courses.filter(Course.department == dept)
-        if quarter:
-            self.queried_courses = self.queried_courses.filter(CourseOffering.quarter == quarter)
-        if instructor:
-            self.queried_courses = self.queried_courses.filter(Section.instructor.contains(instructor))
-        if section_type:
-            self.queried_courses = self.queried_courses.filter(Section.type == section_type)
-        return self.queried_courses.all()
+            filter(Course.id == CourseOffering.course_id). \
+            options(*CATALOG_LOADS)
+        self.query_count = None
+
+    def view_courses(self, name=None, course_code=None, dept=None, quarter=None, instructor=None, section_type=None,
+                     keyword=None):
+        """
+        keyword matches the course names, codes and descriptions, name only the names.
+        The prereqs of the courses, the sections of the offerings and the instructors of the sections are loaded
+        along with the rows, so rendering them runs no further queries.
+        """
+        with Database().replica_reads(CATALOG_KEY):
+            if name or keyword:
+                course_search_index.refresh(db_session)
+            self.queried_courses = self.queried_courses.filter(*catalog_filters(name, course_code, dept, quarter,
+                                                                                 instructor, section_type, keyword))
+            return self.queried_courses.all()
+
+    def view_course_records(self, name=None, course_code=None, dept=None, quarter=None, instructor=None,
+                            section_type=None, keyword=None):
+        """
+        view_courses for pages that only render the rows: CatalogRow records read as columns with a fixed
+        number of queries, no entities enter the session.
+        """
+        with Database().replica_reads(CATALOG_KEY), _counting_statements(db_session, {}) as counts:
+            if name or keyword:
+                course_search_index.refresh(db_session)
+            records = catalog_records(db_session, catalog_filters(name, course_code, dept, quarter, instructor,
+                                                                  section_type, keyword))
+        self.query_count = counts['statements']
+        log.debug(f"Read {len(records)} catalog records with {self.query_count} queries")
+        return records
+
+    def view_catalog(self, name=None, course_code=None, dept=None, quarter=None, instructor=None,
+                     section_type=None, keyword=None):
+        """
+        view_courses for read-mostly callers: the rows come from the catalog_cache as CatalogRow records
+        detached from the session, the seat counts are not part of them.
+        """
+        def load():
+            with Database().replica_reads(CATALOG_KEY):
+                if name or keyword:
+                    course_search_index.refresh(db_session)
+                return catalog_records(db_session, catalog_filters(name, course_code, dept, quarter, instructor,
+                                                                   section_type, keyword))
+        return catalog_cache.get_or_load(catalog_key(name, course_code, dept, quarter, instructor, section_type,
+                                                     keyword), load)
 
     def view_roster(self, student):
-        return self.queried_courses.filter(Section.enrolled_students.contains(student)).all()
+        with Database().replica_reads(student_key(student.id)):
+            return self.queried_courses.filter(Section.enrolled_students.contains(student)).all()
+
+    def view_courses_page(self, cursor=None, limit=PAGE_SIZE, name=None, course_code=None, dept=None, quarter=None,
+                          instructor=None, section_type=None, keyword=None):
+        """ A CatalogPage of view_course_records, pass the next_cursor of a page to get the one after it """
+        with Database().replica_reads(CATALOG_KEY):
+            if name or keyword:
+                course_search_index.refresh(db_session)
+            return catalog_page(db_session, catalog_filters(name, course_code, dept, quarter, instructor,
+                                                            section_type, keyword), cursor, limit)
+
+    def view_roster_page(self, student, cursor=None, limit=PAGE_SIZE):
+        with Database().replica_reads(student_key(student.id)):
+            return catalog_page(db_session, [Section.enrolled_students.contains(student)], cursor, limit)
+
+    def iter_courses(self, chunk_size=STREAM_CHUNK_SIZE, name=None, course_code=None, dept=None, quarter=None,
+                     instructor=None, section_type=None, keyword=None):
+        """ Streams the records of view_course_records for exports, in constant memory """
+        with Database().replica_reads(CATALOG_KEY):
+            if name or keyword:
+                course_search_index.refresh(db_session)
+            return stream_catalog_records(db_session, catalog_filters(name, course_code, dept, quarter, instructor,
+                                                                      section_type, keyword), chunk_size)
+
+    def iter_roster(self, student, chunk_size=STREAM_CHUNK_SIZE):
+        with Database().replica_reads(student_key(student.id)):
+            return stream_catalog_records(db_session, [Section.enrolled_students.contains(student)], chunk_size)
+
+    def view_eligible_sections(self, student, year, quarter):
+        """ The Eligibility of the student for the term's sections, what registering for each of them would return """
+        from eligibility import eligible_sections
+        return eligible_sections(student.id, year, quarter, db_session)
+
+    def view_archived_roster(self, student):
+        """ The ArchivedEnrollments of the student in archived terms, which view_roster no longer shows """
+        from terms import archived_roster
+        return archived_roster(student.id, db_session)
 
 
 def get_or_create(session, model, **kwargs):
@@ -98,3 +400,128 @@ def get_or_create(session, model, **kwargs):
         session.add(instance)
         session.commit()
         return instance
+
+
+class IdentityCache:
+    """ The ids of the rows bulk_get_or_create resolved, by model and unique key, dropped when the database changes """
+    MAX_ENTRIES = 1000000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+
+    def clear(self):
+        with self._lock:
+            self._ids = {}
+
+    def get(self, model, key):
+        return self._ids.get((model, key))
+
+    def add(self, model, ids):
+        with self._lock:
+            if len(self._ids) + len(ids) > self.MAX_ENTRIES:
+                self._ids = {}
+            self._ids.update(((model, key), id_) for key, id_ in ids.items())
+
+    def discard(self, model, keys):
+        with self._lock:
+            for key in keys:
+                self._ids.pop((model, key), None)
+
+
+person_ids = IdentityCache()
+Database().on_configure(person_ids.clear)
+
+
+def _unique_columns(model):
+    """ The names of the columns of the model's unique constraint """
+    for constraint in model.__table__.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            return [column.name for column in constraint.columns]
+    raise ValueError(f"{model.__name__} has no unique constraint to resolve rows against")
+
+
+def _key_filter(model, columns, keys):
+    """ Matches the rows of the keys, NULL values included, which IN and = never match """
+    complete = [key for key in keys if None not in key]
+    clauses = [tuple_(*[getattr(model, column) for column in columns]).in_(complete)] if complete else []
+    clauses += [and_(*[getattr(model, column).is_(None) if value is None else getattr(model, column) == value
+                       for column, value in zip(columns, key)]) for key in keys if None in key]
+    return or_(*clauses)
+
+
+def _insert_ignoring_duplicates(session, model):
+    """ An INSERT of the model's table that leaves rows already there alone, in the dialect of the session """
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+    if dialect == 'mysql':
+        return mysql.insert(table).on_duplicate_key_update(id=table.c.id)
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        # OR IGNORE rather than ON CONFLICT, which needs SQLite 3.24
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert()
+
+
+def _resolve_keys(session, model, columns, keys, values):
+    """ The ids of the rows of the keys, inserting the missing ones with one statement """
+    key_columns = [getattr(model, column) for column in columns]
+
+    def select_ids(keys):
+        return {tuple(row[1:]): row[0] for row in
+                session.query(model.id, *key_columns).filter(_key_filter(model, columns, keys))}
+
+    ids = select_ids(keys)
+    missing = [key for key in keys if key not in ids]
+    if missing:
+        # Rows of a batch are inserted together when they set the same columns, the defaults fill in the rest
+        by_columns = defaultdict(list)
+        for key in missing:
+            by_columns[tuple(sorted(values[key]))].append(values[key])
+        statement = _insert_ignoring_duplicates(session, model)
+        for rows in by_columns.values():
+            session.execute(statement, rows)
+        ids.update(select_ids(missing))
+    return ids
+
+
+def bulk_get_or_create(session, model, rows):
+    """
+    get_or_create for a batch of Student, Instructor or Advisor rows given as dicts of column values, matched on
+    the columns of the model's unique constraint. Returns their instances in the order of rows, inserting the
+    ones that do not exist yet with all of their values; a key repeated in rows gets its first row's values.
+    Keys resolved before come from the person_ids cache, the others take a select, an insert that skips
+    duplicates and a select of what it inserted per UPSERT_BATCH_SIZE keys, then one select loads the instances.
+    Commits, like get_or_create.
+    """
+    columns = _unique_columns(model)
+    keys = [tuple(row.get(column) for column in columns) for row in rows]
+    values = {}
+    for key, row in zip(keys, rows):
+        values.setdefault(key, row)
+    instances = {}
+    for _ in range(2):
+        ids, missing = {}, []
+        for key in [key for key in values if key not in instances]:
+            id_ = person_ids.get(model, key)
+            if id_ is None:
+                missing.append(key)
+            else:
+                ids[key] = id_
+        for start in range(0, len(missing), UPSERT_BATCH_SIZE):
+            ids.update(_resolve_keys(session, model, columns, missing[start:start + UPSERT_BATCH_SIZE], values))
+        if missing:
+            session.commit()
+        keys_by_id = {id_: key for key, id_ in ids.items()}
+        id_list = list(keys_by_id)
+        for start in range(0, len(id_list), UPSERT_BATCH_SIZE):
+            for instance in session.query(model).filter(model.id.in_(id_list[start:start + UPSERT_BATCH_SIZE])):
+                instances[keys_by_id[instance.id]] = instance
+        person_ids.add(model, {key: ids[key] for key in ids if key in instances})
+        # A cached id whose row is gone is dropped and its key resolved again
+        stale = [key for key in ids if key not in instances]
+        if not stale:
+            break
+        person_ids.discard(model, stale)
+    return [instances[key] for key in keys]
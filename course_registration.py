@@ -1,11 +1,24 @@
 import abc
-from courses import Course, CourseOffering, Section
-from persons import Student
+import random
+import threading
+import time
+from sqlalchemy.exc import IntegrityError, OperationalError
+from courses import Section
+from persons import Student, StudentTermLoad, student_key
 from database import Database
+from enums import RegistrationStatus
+from enrollment_counters import apply_enrollment_changes, claim_seat
+from prereq_graph import prereq_graph
+from waitlist import waitlists
+from schedule import student_schedule
+from terms import term_states
+from instrumentation import instrument_handler, request_span
 from logs import log
 
 db_session = Database().get_session()
+unit_of_work = Database().unit_of_work()
 STUDENT_COURSE_LIMIT = 3
+MAX_REGISTRATION_ATTEMPTS = 5
 
 """
 We use the chain of responsibility pattern to create a CourseRegistrationClass.
@@ -21,18 +34,29 @@ class CourseRegChain:
         self.chain1 = StudentCourseLimitHandler()
         self.chain2 = SectionEnrolledLimitHandler()
         self.chain3 = PrereqsCheckHandler()
-        self.chain4 = StudentRestrictionHandler()
+        self.chain4 = ScheduleConflictHandler()
+        self.chain5 = StudentRestrictionHandler()
         self.chain1.next_successor(self.chain2)
         self.chain2.next_successor(self.chain3)
         self.chain3.next_successor(self.chain4)
+        self.chain4.next_successor(self.chain5)
 
 
 class CourseRegHandler(metaclass=abc.ABCMeta):
     """
     Define an interface for handling requests.
     Implement the successor link.
+    Every handler returns the RegistrationStatus that the chain decided on and runs in a unit of work,
+    so the handler a request enters the chain at commits the enrolment.
+    The handle_request of every subclass is timed, and the status of the handler entered counted, by the
+    instrumentation.
     """
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'handle_request' in cls.__dict__:
+            cls.handle_request = instrument_handler(cls.handle_request)
+
     def __init__(self, successor=None):
         self._successor = successor
 
@@ -47,71 +71,224 @@ class CourseRegHandler(metaclass=abc.ABCMeta):
 class StudentCourseLimitHandler(CourseRegHandler):
     """
     Handler that Checks if Student is enrolled in more than the course_limit before passing it on successor.
+    The limit applies per term and is read from the student's StudentTermLoad counter, on a replica unless the
+    student registered within the sticky window. Terms that are frozen take no registrations at all.
     """
 
+    @unit_of_work
     def handle_request(self, student, section):
-        student_enrolled_in = db_session.query(Student.enrolled_courses).filter(Student.id == student.id).all()
-        if len(student_enrolled_in) < STUDENT_COURSE_LIMIT:
-            self._successor.handle_request(student, section)
+        offering = section.offerings
+        if not term_states.is_open(db_session, offering.year, offering.quarter):
+            log.debug(f"{offering.quarter.name} {offering.year} is frozen")
+            return RegistrationStatus.not_open
+        with Database().replica_reads(student_key(student.id)):
+            course_count = db_session.query(StudentTermLoad.course_count). \
+                filter(StudentTermLoad.student_id == student.id). \
+                filter(StudentTermLoad.year == offering.year). \
+                filter(StudentTermLoad.quarter == offering.quarter).scalar()
+        if (course_count or 0) < STUDENT_COURSE_LIMIT:
+            return self._successor.handle_request(student, section)
         else:
             log.debug("course limit exceed. ask for permission")
+            return RegistrationStatus.course_limit
 
 
 class SectionEnrolledLimitHandler(CourseRegHandler):
     """
     Handler that checks if the section is full before forwardinf it to the successor.
+    The enrolment is read from the section's enrolled_count counter.
     """
 
+    @unit_of_work
     def handle_request(self, student, section):
-        section_enrolment = db_session.query(Section.enrolled_students).filter(Section.id == section.id).all()
-        if len(section_enrolment) < section.size_limit:
-            self._successor.handle_request(student, section)
+        enrolled_count = db_session.query(Section.enrolled_count).filter(Section.id == section.id).scalar()
+        if enrolled_count < section.size_limit:
+            return self._successor.handle_request(student, section)
         else:
-            log.debug("course limit exceed. ask for permission")
+            log.debug("Section is full. The student can join its waitlist")
+            return RegistrationStatus.section_full
 
 
 class PrereqsCheckHandler(CourseRegHandler):
     """
     Handler that checks if the student has the necessary pre-reqs before it forwards it to the successor.
+    Every transitive prereq of the course has to be taken, which the prereq_graph decides with one subset test.
+    The student's courses are read like the course limit.
     """
 
+    @unit_of_work
     def handle_request(self, student, section):
-        row = db_session.query(Section, CourseOffering, Course). \
-            filter(Section.id == section.id).\
-            filter(Section.course_offering_id == CourseOffering.id).\
-            filter(CourseOffering.id == Course.id).one()
-        for prereq in row.Course.prereqs:
-            if prereq not in student.enrolled_courses:
-                log.debug("Student doesnt have the prereq. Ask for Consent")
-                return None
-        self._successor.handle_request(student, section)
+        with Database().replica_reads(student_key(student.id)):
+            satisfied = prereq_graph.has_prereqs(db_session, student.id, section.offerings.course_id)
+        if not satisfied:
+            log.debug("Student doesnt have the prereq. Ask for Consent")
+            return RegistrationStatus.missing_prereq
+        return self._successor.handle_request(student, section)
+
+
+class ScheduleConflictHandler(CourseRegHandler):
+    """
+    Handler that checks the section does not meet at the same time as a section the student is enrolled in
+    for the same term, before forwarding it to the successor. The schedule is read like the course limit.
+    """
+
+    @unit_of_work
+    def handle_request(self, student, section):
+        offering = section.offerings
+        if section.days and section.time is not None:
+            with Database().replica_reads(student_key(student.id)):
+                schedule = student_schedule(db_session, student.id, offering.year, offering.quarter)
+            conflict = schedule.conflict(section.days, section.time, section.end_time, section.id)
+            if conflict is not None:
+                log.debug(f"Section {section.id} meets at the same time as section {conflict}")
+                return RegistrationStatus.schedule_conflict
+        return self._successor.handle_request(student, section)
 
 
 class StudentRestrictionHandler(CourseRegHandler):
-    """ Handler that checks if student account has any restrictions on it before adding enrolling the student"""
+    """
+    Handler that checks if student account has any restrictions on it before adding enrolling the student.
+    The seat is taken with a conditional update, so a section that filled up since SectionEnrolledLimitHandler
+    looked at it is never oversold.
+    """
+    @unit_of_work
     def handle_request(self, student, section):
         if student.restriction_hold:
             log.debug("Student has a restriction hold. Do something")
+            return RegistrationStatus.restriction_hold
+        elif not claim_seat(db_session, section.id):
+            contention_stats.record_conflict()
+            log.debug("Section filled up while the request was being checked")
+            return RegistrationStatus.section_full
         else:
             student.enrolled_courses.append(section)
-            db_session.commit()
+            apply_enrollment_changes(db_session, [(student.id, section.id, 1)], include_sections=False)
+            return RegistrationStatus.enrolled
+
+
+class ContentionStats:
+    """ Thread-safe counts of the seat conflicts and the retried transactions seen while registering """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.conflicts = 0
+        self.retries = 0
+
+    def record_conflict(self):
+        with self._lock:
+            self.conflicts += 1
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def reset(self):
+        with self._lock:
+            self.conflicts = 0
+            self.retries = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {'conflicts': self.conflicts, 'retries': self.retries}
+
+
+contention_stats = ContentionStats()
+
+
+class RetryingRegistration:
+    """
+    Registration entry point for thread pools and servers.
+    Every request walks the CourseRegChain in its own unit of work, loading the student and the section by id.
+    Transactions that fail on lock conflicts (deadlocks, lock wait timeouts, a busy SQLite file or a racing
+    insert of the same counter row) are rolled back and retried up to max_attempts times with a jittered backoff.
+    Must be called outside of any open unit of work, since a retry starts the whole transaction over.
+    """
+    def __init__(self, max_attempts=MAX_REGISTRATION_ATTEMPTS, backoff=0.005):
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+
+    def register(self, student_id, section_id, waitlist=False, priority=0):
+        """ With waitlist, a student who finds the section full is put on its waitlist with the given priority """
+        with request_span('registration', student_id=student_id, section_id=section_id) as span:
+            for attempt in range(1, self._max_attempts + 1):
+                try:
+                    return self._register(student_id, section_id, waitlist, priority)
+                except (OperationalError, IntegrityError):
+                    if attempt == self._max_attempts:
+                        log.error(f"Registration of student {student_id} gave up after {attempt} attempts")
+                        raise
+                    contention_stats.record_retry()
+                    if span is not None:
+                        span.attributes['retries'] = attempt
+                    time.sleep(random.uniform(0, self._backoff * 2 ** attempt))
+
+    @unit_of_work
+    def _register(self, student_id, section_id, waitlist=False, priority=0):
+        student = db_session.query(Student).get(student_id)
+        section = db_session.query(Section).get(section_id)
+        if student is None or section is None:
+            return RegistrationStatus.not_found
+        status = CourseRegChain().chain1.handle_request(student, section)
+        if status is RegistrationStatus.section_full and waitlist:
+            waitlists.join(db_session, student_id, section_id, priority)
+            return RegistrationStatus.waitlisted
+        return status
+
+
+@unit_of_work
+def promote_waitlisted(section_ids):
+    """
+    Fills the free seats of the sections with the students next in line on their waitlists.
+    Every promotion walks the whole CourseRegChain again, students who no longer pass it lose their place.
+    Returns the (student id, section id) of the promoted students.
+    """
+    chain = CourseRegChain()
+    promoted = []
+    for section in db_session.query(Section).filter(Section.id.in_(list(section_ids))):
+        free_seats = section.size_limit - db_session.query(Section.enrolled_count). \
+            filter(Section.id == section.id).scalar()
+        while free_seats > 0:
+            student_id = waitlists.next_student(db_session, section.id)
+            if student_id is None:
+                break
+            student = db_session.query(Student).get(student_id)
+            if student is None or section in student.enrolled_courses:
+                continue
+            status = chain.chain1.handle_request(student, section)
+            if status is RegistrationStatus.enrolled:
+                promoted.append((student_id, section.id))
+                free_seats -= 1
+            else:
+                log.debug(f"Waitlisted student {student_id} was not promoted to section {section.id}: {status.name}")
+    return promoted
 
 
 class CourseRegModification:
-    """ Student can drop or swap courses"""
+    """ Student can drop or swap courses. A seat given up goes to the section's waitlist."""
     def __init__(self, student):
         self._student = student
 
+    @unit_of_work
     def drop_course(self, section):
-        if section not in self._student.enrolled_courses:
-            log.debug("Attempted to drop a course that student was not enrolled in.")
-        else:
-            self._student.enrolled_courses.remove(section)
+        if self._drop(section):
+            promote_waitlisted([section.id])
+
+    @unit_of_work
+    def drop_courses(self, sections):
+        """ Drops several sections and then fills the seats from the waitlists in one go """
+        promote_waitlisted([section.id for section in sections if self._drop(section)])
 
     def swap_course(self, course_to_add, course_to_drop):
-        self.drop_course(course_to_drop)
-        crc = CourseRegChain()
-        crc.chain1.handle_request(self._student, course_to_add)
-        if course_to_add not in self._student.enrolled_courses:
-            crc.chain1.handle_request(self._student, course_to_drop)
+        """ Checks out a cart of the two, the student keeps the dropped seat unless the add goes through """
+        from cart import Cart
+        return Cart(self._student).drop(course_to_drop).add(course_to_add).checkout()
 
+    def _drop(self, section):
+        if section not in self._student.enrolled_courses:
+            log.debug("Attempted to drop a course that student was not enrolled in.")
+            return False
+        if not term_states.is_open(db_session, section.offerings.year, section.offerings.quarter):
+            log.debug("Attempted to drop a course of a frozen term.")
+            return False
+        self._student.enrolled_courses.remove(section)
+        apply_enrollment_changes(db_session, [(self._student.id, section.id, -1)])
+        return True
@@ -1,7 +1,9 @@
-from sqlalchemy import Column, Integer, String, Table, Boolean, ForeignKey, create_engine, Time, Enum
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, Table, Boolean, ForeignKey, create_engine, Time, Enum, DateTime, \
+    UniqueConstraint, Index, func
 from sqlalchemy.orm import relationship, backref
 from database import Database
-from enums import Quarter, Department, SectionType
+from enums import Quarter, Department, SectionType, TermStatus
 
 
 Base = Database().get_base()
@@ -28,6 +30,61 @@ instructor_roster = Table(
     Column('section_id', Integer, ForeignKey('section.id'), primary_key=True)
 )
 
+# The offerings, sections and rosters of archived terms, moved out of the live tables by terms.archive_term and
+# only read after that. Ids are kept, the archived student_roster carries the course and term of its section.
+archived_course_offering = Table(
+    'archived_course_offering', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('course_id', Integer, ForeignKey('course.id')),
+    Column('year', Integer, nullable=False),
+    Column('quarter', Enum(Quarter), nullable=False),
+    Index('ix_archived_course_offering_term', 'year', 'quarter')
+)
+
+archived_section = Table(
+    'archived_section', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('course_offering_id', Integer, nullable=False, index=True),
+    Column('location', String(50)),
+    Column('type', Enum(SectionType)),
+    Column('time', Time),
+    Column('end_time', Time),
+    Column('days', Integer, default=0, nullable=False),
+    Column('size_limit', Integer),
+    Column('enrolled_count', Integer, default=0, nullable=False)
+)
+
+archived_student_roster = Table(
+    'archived_student_roster', Base.metadata,
+    Column('student_id', Integer, ForeignKey('student.id'), primary_key=True),
+    Column('section_id', Integer, primary_key=True),
+    Column('course_id', Integer, nullable=False),
+    Column('year', Integer, nullable=False),
+    Column('quarter', Enum(Quarter), nullable=False)
+)
+
+archived_instructor_roster = Table(
+    'archived_instructor_roster', Base.metadata,
+    Column('instructor_id', Integer, ForeignKey('instructor.id'), primary_key=True),
+    Column('section_id', Integer, primary_key=True)
+)
+
+
+class Term(Base):
+    """
+    The lifecycle of a term: a frozen term takes no more roster changes, an archived one has its offerings,
+    sections and rosters in the archive tables. Terms without a row are open.
+    """
+    __tablename__ = 'term'
+    year = Column(Integer, primary_key=True)
+    quarter = Column(Enum(Quarter), primary_key=True)
+    status = Column(Enum(TermStatus), nullable=False)
+    changed_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"year: {self.year}, quarter: {self.quarter}, status: {self.status}"
+
+
 class Section(Base):
     """
     The section class that creates a section which can persisted in the db.
@@ -40,13 +97,114 @@ class Section(Base):
     location = Column(String(50))
     instructor = relationship("Instructor", secondary=instructor_roster, back_populates ="taught_courses")
     type = Column(Enum(SectionType))
+    # Start time, end time and the Weekday flags of the meetings, sections without days are never in conflict
     time = Column(Time)
+    end_time = Column(Time)
+    days = Column(Integer, default=0, nullable=False)
     size_limit = Column(Integer, default=30)
+    # Denormalized count of the student_roster rows of this section, kept up to date by enrollment_counters
+    enrolled_count = Column(Integer, default=0, nullable=False)
     enrolled_students = relationship("Student", secondary=student_roster, back_populates ="enrolled_courses")
 
+    # Archived sections keep their ids, so SQLite must not hand out the ids of deleted rows again
+    __table_args__ = {'sqlite_autoincrement': True}
+
     def __repr__(self):
         return f"id: {self.id}, course_offering_id: {self.course_offering_id}, location: {self.location}, " \
-               f"time: {self.time}, type: {self.type}, instructor: {self.instructor}"
+               f"time: {self.time}, end_time: {self.end_time}, days: {self.days}, type: {self.type}, " \
+               f"instructor: {self.instructor}"
+
+
+class WaitlistEntry(Base):
+    """
+    A student waiting for a seat in a full section.
+    Entries with a higher priority come first, entries of the same priority in the order they joined.
+    """
+    __tablename__ = 'waitlist_entry'
+    id = Column(Integer, primary_key=True)
+    section_id = Column(Integer, ForeignKey('section.id'), nullable=False, index=True)
+    student_id = Column(Integer, ForeignKey('student.id'), nullable=False)
+    priority = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint(section_id, student_id),
+    )
+
+    def __repr__(self):
+        return f"id: {self.id}, section_id: {self.section_id}, student_id: {self.student_id}, " \
+               f"priority: {self.priority}"
+
+
+class SectionPreference(Base):
+    """
+    A section a student asks for in a term's seat lottery, rank 1 is the student's first choice.
+    Sections of the same course offering and type are alternatives, a student gets at most one of them.
+    """
+    __tablename__ = 'section_preference'
+    student_id = Column(Integer, ForeignKey('student.id'), primary_key=True)
+    section_id = Column(Integer, ForeignKey('section.id'), primary_key=True, index=True)
+    rank = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f"student_id: {self.student_id}, section_id: {self.section_id}, rank: {self.rank}"
+
+
+class EnrollmentEvent(Base):
+    """
+    An entry of the append-only log of roster changes, written by enrollment_counters in the transaction of the
+    change: delta is 1 for an enrolment and -1 for a drop, a swap is one of each. The ids order the entries.
+    There are no foreign keys to the roster's rows, the log outlives them.
+    """
+    __tablename__ = 'enrollment_event'
+    id = Column(Integer, primary_key=True)
+    student_id = Column(Integer, nullable=False)
+    section_id = Column(Integer, nullable=False)
+    year = Column(Integer)
+    quarter = Column(Enum(Quarter))
+    delta = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"id: {self.id}, student_id: {self.student_id}, section_id: {self.section_id}, delta: {self.delta}"
+
+
+class EventCheckpoint(Base):
+    """ The id of the last EnrollmentEvent a consumer of the log applied, saved with what it applied """
+    __tablename__ = 'event_checkpoint'
+    name = Column(String(50), primary_key=True)
+    position = Column(Integer, default=0, nullable=False)
+
+
+class EventGap(Base):
+    """
+    A range of EnrollmentEvent ids missing behind a consumer's checkpoint, taken by transactions that had not
+    committed yet or that rolled back. noted_at is the database's time when the consumer passed the range.
+    """
+    __tablename__ = 'event_gap'
+    name = Column(String(50), primary_key=True)
+    first_id = Column(Integer, primary_key=True)
+    last_id = Column(Integer, nullable=False)
+    noted_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+
+class SectionFill(Base):
+    """
+    Materialized view of the enrolled students per live section, kept by enrollment_views from the event log.
+    The rows of a section go when its term is archived, its archived_section row keeps the enrolled count.
+    """
+    __tablename__ = 'section_fill'
+    section_id = Column(Integer, primary_key=True)
+    enrolled = Column(Integer, default=0, nullable=False)
+
+
+class DepartmentTotal(Base):
+    """ Materialized view of the enrolments in the courses of a department per term, see SectionFill """
+    __tablename__ = 'department_total'
+    department = Column(Enum(Department), primary_key=True)
+    year = Column(Integer, primary_key=True)
+    quarter = Column(Enum(Quarter), primary_key=True)
+    enrolled = Column(Integer, default=0, nullable=False)
 
 
 class CourseOffering(Base):
@@ -61,6 +219,8 @@ class CourseOffering(Base):
     year = Column(Integer())
     quarter = Column(Enum(Quarter))
     sections = relationship("Section", backref="offerings")
+    # See Section
+    __table_args__ = {'sqlite_autoincrement': True}
 
     def __repr__(self):
         return f"id: {self.id}, course_id: {self.course_id}, year: {self.year}, quarter: {self.quarter}"
@@ -0,0 +1,165 @@
+import threading
+from collections import namedtuple
+import numpy as np
+from courses import CourseOffering, Section, student_roster
+from persons import Student, StudentTermLoad, student_key
+from database import Database
+from enums import RegistrationStatus
+from course_registration import STUDENT_COURSE_LIMIT
+from catalog_cache import catalog_cache, CATALOG_KEY
+from prereq_graph import prereq_graph, archived_courses
+from schedule import DAY_MINUTES, DEFAULT_MEETING_MINUTES
+from terms import term_states
+
+db_session = Database().get_session()
+
+"""
+Which sections of a term a student can register for, and why not for the rest, decided for every section at
+once instead of walking the CourseRegChain section by section.
+The parts of a term's sections that only change with the catalog, their meetings and the prereqs of their
+courses packed into bit words, are kept as arrays per term and dropped by catalog invalidations. Seats, the
+student's hold, course load, roster, archived courses and schedule are read fresh with five queries, and the
+checks are array operations in the chain's order, so every section gets the status the chain would return.
+Every section of a frozen term is not_open."""
+
+Eligibility = namedtuple('Eligibility', ['eligible', 'blocked'])
+# meets tells whether the section has meeting times the ScheduleIndex would index, required holds the
+# prereq_graph masks of the courses as rows of 64 bit words
+TermSections = namedtuple('TermSections', ['section_ids', 'days', 'start', 'end', 'meets', 'required'])
+ALL_DAYS = 0x7f
+
+
+def _words(mask, width):
+    """ The lowest width 64 bit words of a bitset, least significant first """
+    return np.frombuffer((mask & ((1 << 64 * width) - 1)).to_bytes(8 * width, 'little'), dtype='<u8')
+
+
+def _meeting_minutes(days, start, end):
+    """ (days, start, end) in minutes of the day as the ScheduleIndex sees them, days are 0 without meetings """
+    if not days or start is None:
+        return 0, 0, 0
+    start_minute = start.hour * 60 + start.minute
+    end_minute = end.hour * 60 + end.minute if end is not None else start_minute + DEFAULT_MEETING_MINUTES
+    return days, start_minute, end_minute
+
+
+def _overlap(days, start, end, other_days, other_start, other_end):
+    """
+    Whether meetings overlap on the minutes of the week: on a day both meet, or where a meeting running past
+    midnight reaches into the next day of the other
+    """
+    return ((((days & other_days) != 0) & (start < other_end) & (other_start < end)) |
+            ((((days << 1) & ALL_DAYS & other_days) != 0) & (start - DAY_MINUTES < other_end) &
+             (other_start < end - DAY_MINUTES)) |
+            ((((other_days << 1) & ALL_DAYS & days) != 0) & (other_start - DAY_MINUTES < end) &
+             (start < other_end - DAY_MINUTES)))
+
+
+class TermSectionCache:
+    """ The TermSections of every term asked for, loaded on first use and dropped with the catalog """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._terms = {}
+
+    def clear(self):
+        with self._lock:
+            self._terms = {}
+
+    def invalidate(self, change):
+        with self._lock:
+            if change.quarter is None:
+                self._terms = {}
+            else:
+                self._terms = {term: sections for term, sections in self._terms.items() if term[1] != change.quarter}
+
+    def get(self, session, year, quarter, section_ids):
+        """ The arrays of the term, loaded again when its sections are not the given ids """
+        sections = self._terms.get((year, quarter))
+        if sections is None or not np.array_equal(sections.section_ids, section_ids):
+            sections = self._load(session, year, quarter)
+            with self._lock:
+                self._terms[(year, quarter)] = sections
+        return sections
+
+    @staticmethod
+    def _load(session, year, quarter):
+        with Database().replica_reads(CATALOG_KEY):
+            rows = session.query(Section.id, CourseOffering.course_id, Section.days, Section.time,
+                                 Section.end_time). \
+                join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+                filter(CourseOffering.year == year).filter(CourseOffering.quarter == quarter). \
+                order_by(Section.id).all()
+            prereq_graph.ensure_courses(session, {course_id for _, course_id, _, _, _ in rows})
+        meetings = np.array([_meeting_minutes(days, start, end) for _, _, days, start, end in rows],
+                            dtype=np.int64).reshape(-1, 3)
+        masks = [prereq_graph.required_mask(course_id) for _, course_id, _, _, _ in rows]
+        width = max(1, (max(masks, default=0).bit_length() + 63) // 64)
+        required = np.frombuffer(b''.join(mask.to_bytes(8 * width, 'little') for mask in masks),
+                                 dtype='<u8').reshape(-1, width)
+        return TermSections(np.array([row[0] for row in rows], dtype=np.int64), meetings[:, 0], meetings[:, 1],
+                            meetings[:, 2], meetings[:, 0] != 0, required)
+
+
+term_sections = TermSectionCache()
+catalog_cache.on_invalidate(term_sections.invalidate)
+Database().on_configure(term_sections.clear)
+
+
+def eligible_sections(student_id, year, quarter, session=None):
+    """
+    The Eligibility of the student for the sections of the term: the ids of the sections the CourseRegChain
+    would enrol the student in, and the status it would return for each of the others. Sections the student is
+    enrolled in already and passes every check for are blocked as already_enrolled, and every section as not_found
+    for an unknown student.
+    Like the chain, the student's side is read on a replica unless the student registered within the sticky window.
+    """
+    session = session or db_session
+    with Database().replica_reads(student_key(student_id)):
+        student = session.query(Student.restriction_hold).filter(Student.id == student_id).first()
+        course_count = session.query(StudentTermLoad.course_count). \
+            filter(StudentTermLoad.student_id == student_id). \
+            filter(StudentTermLoad.year == year).filter(StudentTermLoad.quarter == quarter).scalar()
+        roster = session.query(student_roster.c.section_id, CourseOffering.course_id, CourseOffering.year,
+                               CourseOffering.quarter, Section.days, Section.time, Section.end_time). \
+            join(Section, Section.id == student_roster.c.section_id). \
+            join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+            filter(student_roster.c.student_id == student_id).all()
+        archived = [course_id for _, course_id in archived_courses(session, [student_id])]
+    seats = np.array([(section_id, size_limit or 0, enrolled_count) for section_id, size_limit, enrolled_count
+                      in session.query(Section.id, Section.size_limit, Section.enrolled_count).
+                      join(CourseOffering, Section.course_offering_id == CourseOffering.id).
+                      filter(CourseOffering.year == year).filter(CourseOffering.quarter == quarter).
+                      order_by(Section.id)], dtype=np.int64).reshape(-1, 3)
+    sections = term_sections.get(session, year, quarter, seats[:, 0])
+    if student is None:
+        return Eligibility([], dict.fromkeys(sections.section_ids.tolist(), RegistrationStatus.not_found))
+    if not term_states.is_open(session, year, quarter):
+        return Eligibility([], dict.fromkeys(sections.section_ids.tolist(), RegistrationStatus.not_open))
+
+    held = [(section_id,) + _meeting_minutes(days, start, end)
+            for section_id, _, held_year, held_quarter, days, start, end in roster
+            if (held_year, held_quarter) == (year, quarter) and days and start is not None]
+    held = np.array(held, dtype=np.int64).reshape(-1, 4)
+    taken = prereq_graph.completed_mask([course_id for _, course_id, _, _, _, _, _ in roster if course_id is not None] +
+                                        archived)
+
+    status = np.full(len(sections.section_ids), RegistrationStatus.enrolled.value, dtype=np.int8)
+    # The chain's checks from last to first, so that the first one failing decides
+    if student.restriction_hold:
+        status[:] = RegistrationStatus.restriction_hold.value
+    conflicts = _overlap(sections.days[:, None], sections.start[:, None], sections.end[:, None],
+                         held[None, :, 1], held[None, :, 2], held[None, :, 3]) & \
+        (sections.section_ids[:, None] != held[None, :, 0])
+    status[sections.meets & conflicts.any(axis=1)] = RegistrationStatus.schedule_conflict.value
+    missing = (sections.required & ~_words(taken, sections.required.shape[1])).any(axis=1)
+    status[missing] = RegistrationStatus.missing_prereq.value
+    status[seats[:, 2] >= seats[:, 1]] = RegistrationStatus.section_full.value
+    if (course_count or 0) >= STUDENT_COURSE_LIMIT:
+        status[:] = RegistrationStatus.course_limit.value
+    registered = np.isin(sections.section_ids, [row[0] for row in roster])
+    status[registered & (status == RegistrationStatus.enrolled.value)] = RegistrationStatus.already_enrolled.value
+
+    eligible = status == RegistrationStatus.enrolled.value
+    return Eligibility(sections.section_ids[eligible].tolist(),
+                       {section_id: RegistrationStatus(code) for section_id, code
+                        in zip(sections.section_ids[~eligible].tolist(), status[~eligible].tolist())})
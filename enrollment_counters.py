@@ -0,0 +1,127 @@
+from collections import defaultdict
+from sqlalchemy import func, select, bindparam
+from courses import CourseOffering, EnrollmentEvent, Section, student_roster
+from persons import StudentTermLoad, student_key
+from database import Database
+from prereq_graph import changed_students
+from logs import log
+
+db_session = Database().get_session()
+
+"""
+Maintenance of the denormalized enrollment counters: Section.enrolled_count and StudentTermLoad.course_count.
+Every change to the student_roster goes through apply_enrollment_changes in the same transaction as the
+roster change itself, so the counters, and the EnrollmentEvent it appends to the log, commit or roll back
+together with it.
+Running this module recomputes every counter from the student_roster."""
+
+section_table = Section.__table__
+section_count_update = section_table.update(). \
+    where(section_table.c.id == bindparam('section_key')). \
+    values(enrolled_count=section_table.c.enrolled_count + bindparam('delta'))
+
+event_table = EnrollmentEvent.__table__
+term_load_table = StudentTermLoad.__table__
+term_load_update = term_load_table.update(). \
+    where(term_load_table.c.student_id == bindparam('student_key')). \
+    where(term_load_table.c.year == bindparam('year_key')). \
+    where(term_load_table.c.quarter == bindparam('quarter_key')). \
+    values(course_count=term_load_table.c.course_count + bindparam('delta'))
+
+
+def section_terms(session, section_ids):
+    """ Maps each section id to the (year, quarter) of its course offering """
+    rows = session.query(Section.id, CourseOffering.year, CourseOffering.quarter). \
+        join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+        filter(Section.id.in_(list(section_ids)))
+    return {section_id: (year, quarter) for section_id, year, quarter in rows}
+
+
+def claim_seat(session, section_id):
+    """
+    Takes a seat in the section with a conditional update, which the database applies atomically.
+    Returns False when the section filled up since it was last checked.
+    """
+    result = session.execute(section_table.update().
+                             where(section_table.c.id == section_id).
+                             where(section_table.c.enrolled_count < section_table.c.size_limit).
+                             values(enrolled_count=section_table.c.enrolled_count + 1))
+    return result.rowcount == 1
+
+
+def overfilled_sections(session, section_ids):
+    """ Returns the ids of the given sections whose enrolled_count went over their size_limit """
+    return [section_id for section_id, in session.query(Section.id).
+            filter(Section.id.in_(list(section_ids))).
+            filter(Section.enrolled_count > Section.size_limit)]
+
+
+def apply_enrollment_changes(session, changes, terms=None, include_sections=True):
+    """
+    Applies an iterable of (student_id, section_id, delta) roster changes to the counters with relative
+    updates, so concurrent transactions never overwrite each others counts.
+    Leave out the section counters with include_sections=False when the seat was taken with claim_seat.
+    Every change is appended to the EnrollmentEvent log. Does not commit, the caller commits together with the
+    roster change. The students' reads stick to the primary for a while after, and their cached taken courses are
+    dropped when the transaction ends.
+    """
+    changes = list(changes)
+    section_deltas = defaultdict(int)
+    for _, section_id, delta in changes:
+        section_deltas[section_id] += delta
+    if not section_deltas:
+        return
+    student_ids = {student_id for student_id, _, _ in changes}
+    for student_id in student_ids:
+        Database().note_write(student_key(student_id))
+    changed_students(session, student_ids)
+    if terms is None:
+        terms = section_terms(session, section_deltas)
+
+    session.execute(event_table.insert(), [{'student_id': student_id, 'section_id': section_id, 'delta': delta,
+                                            'year': terms.get(section_id, (None, None))[0],
+                                            'quarter': terms.get(section_id, (None, None))[1]}
+                                           for student_id, section_id, delta in changes])
+    term_deltas = defaultdict(int)
+    for student_id, section_id, delta in changes:
+        if section_id in terms:
+            term_deltas[(student_id,) + terms[section_id]] += delta
+
+    if include_sections:
+        session.execute(section_count_update,
+                        [{'section_key': section_id, 'delta': delta} for section_id, delta in section_deltas.items()])
+    if term_deltas:
+        existing = set(session.query(StudentTermLoad.student_id, StudentTermLoad.year, StudentTermLoad.quarter).
+                       filter(StudentTermLoad.student_id.in_({key[0] for key in term_deltas})))
+        updates = [{'student_key': student_id, 'year_key': year, 'quarter_key': quarter, 'delta': delta}
+                   for (student_id, year, quarter), delta in term_deltas.items()
+                   if (student_id, year, quarter) in existing]
+        inserts = [{'student_id': student_id, 'year': year, 'quarter': quarter, 'course_count': delta}
+                   for (student_id, year, quarter), delta in term_deltas.items()
+                   if (student_id, year, quarter) not in existing]
+        if updates:
+            session.execute(term_load_update, updates)
+        if inserts:
+            session.execute(term_load_table.insert(), inserts)
+
+
+def reconcile_counters(session=None):
+    """ Recomputes every enrollment counter from the student_roster """
+    session = session or db_session
+    roster_count = select(func.count()).where(student_roster.c.section_id == section_table.c.id). \
+        scalar_subquery()
+    session.execute(section_table.update().values(enrolled_count=roster_count))
+    session.execute(term_load_table.delete())
+    term_counts = select(student_roster.c.student_id, CourseOffering.year, CourseOffering.quarter, func.count()). \
+        select_from(student_roster). \
+        join(section_table, section_table.c.id == student_roster.c.section_id). \
+        join(CourseOffering.__table__, CourseOffering.__table__.c.id == section_table.c.course_offering_id). \
+        group_by(student_roster.c.student_id, CourseOffering.year, CourseOffering.quarter)
+    session.execute(term_load_table.insert().from_select(['student_id', 'year', 'quarter', 'course_count'],
+                                                         term_counts))
+    session.commit()
+    log.debug("Enrollment counters reconciled with the student roster")
+
+
+if __name__ == '__main__':
+    reconcile_counters()
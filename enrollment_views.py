@@ -0,0 +1,297 @@
+import threading
+from collections import defaultdict, namedtuple
+from sqlalchemy import bindparam, func, or_, select, tuple_
+from courses import Course, CourseOffering, Section, EnrollmentEvent, EventCheckpoint, EventGap, SectionFill, \
+    DepartmentTotal, student_roster, instructor_roster, archived_course_offering, archived_section, \
+    archived_instructor_roster
+from persons import InstructorLoad
+from database import Database, missing_ranges
+from logs import log
+
+db_session = Database().get_session()
+unit_of_work = Database().unit_of_work()
+
+"""
+Materialized views of the enrollment kept from the EnrollmentEvent log: the enrolled students per live section
+(SectionFill), per instructor and term (InstructorLoad) and per department and term (DepartmentTotal).
+The EnrollmentViewConsumer applies the events in id order and saves its position in an EventCheckpoint in the
+same transaction as the view rows, so after a restart it catches up from where it stopped and never applies an
+event twice. Ids missing behind the checkpoint are kept as EventGaps, whose events are applied when their
+transactions commit, until the database shows that every transaction open when a gap was noted has ended.
+replay computes the same views as of any point of the log, without touching the stored ones.
+The instructors and the department of a section are the ones it has when its events are applied, archived
+sections count towards the terms they were archived with."""
+
+CHECKPOINT = 'enrollment_views'
+EVENT_BATCH_SIZE = 1000
+IDLE_INTERVAL = 1.0
+EVENT_COLUMNS = (EnrollmentEvent.id, EnrollmentEvent.section_id, EnrollmentEvent.year, EnrollmentEvent.quarter,
+                 EnrollmentEvent.delta)
+
+EnrollmentViews = namedtuple('EnrollmentViews', ['section_fill', 'instructor_load', 'department_totals'])
+# The views' tables with their key columns
+VIEW_KEYS = ((SectionFill, ('section_id',)), (InstructorLoad, ('instructor_id', 'year', 'quarter')),
+             (DepartmentTotal, ('department', 'year', 'quarter')))
+
+
+def _view_deltas(session, events):
+    """
+    The changes to every view's rows that the (section_id, year, quarter, delta) events make. The department and
+    instructors of a section that was archived meanwhile are read from the archive tables.
+    """
+    sections = defaultdict(int)
+    for section_id, year, quarter, delta in events:
+        sections[(section_id, year, quarter)] += delta
+    section_ids = list({section_id for section_id, _, _ in sections})
+    departments = dict(session.query(Section.id, Course.department).
+                       join(CourseOffering, Section.course_offering_id == CourseOffering.id).
+                       join(Course, CourseOffering.course_id == Course.id).filter(Section.id.in_(section_ids)))
+    live_ids = set(departments)
+    instructor_rows = session.query(instructor_roster.c.instructor_id, instructor_roster.c.section_id). \
+        filter(instructor_roster.c.section_id.in_(section_ids)).all()
+    archived_ids = [section_id for section_id in section_ids if section_id not in live_ids]
+    if archived_ids:
+        departments.update(session.query(archived_section.c.id, Course.department).select_from(archived_section).
+                           join(archived_course_offering,
+                                archived_section.c.course_offering_id == archived_course_offering.c.id).
+                           join(Course, archived_course_offering.c.course_id == Course.id).
+                           filter(archived_section.c.id.in_(archived_ids)))
+        instructor_rows += session.query(archived_instructor_roster.c.instructor_id,
+                                         archived_instructor_roster.c.section_id). \
+            filter(archived_instructor_roster.c.section_id.in_(archived_ids)).all()
+    instructors = defaultdict(list)
+    for instructor_id, section_id in instructor_rows:
+        instructors[section_id].append(instructor_id)
+
+    deltas = EnrollmentViews(defaultdict(int), defaultdict(int), defaultdict(int))
+    for (section_id, year, quarter), delta in sections.items():
+        # Only live sections are filled, archived ones have their count in archived_section
+        if section_id in live_ids:
+            deltas.section_fill[(section_id,)] += delta
+        if year is None:
+            continue
+        for instructor_id in instructors[section_id]:
+            deltas.instructor_load[(instructor_id, year, quarter)] += delta
+        if section_id in departments:
+            deltas.department_totals[(departments[section_id], year, quarter)] += delta
+    return deltas
+
+
+def _apply_deltas(session, model, key_columns, deltas):
+    """ Adds the deltas to the enrolled counts of the view's rows with relative updates, inserting missing rows """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    table = model.__table__
+    columns = [table.c[column] for column in key_columns]
+    if len(columns) == 1:
+        found = select(*columns).where(columns[0].in_([key[0] for key in deltas]))
+    else:
+        found = select(*columns).where(tuple_(*columns).in_(list(deltas)))
+    existing = {tuple(row) for row in session.execute(found)}
+    updates = [dict({f'{column}_key': value for column, value in zip(key_columns, key)}, delta=delta)
+               for key, delta in deltas.items() if key in existing]
+    if updates:
+        statement = table.update().values(enrolled=table.c.enrolled + bindparam('delta'))
+        for column in columns:
+            statement = statement.where(column == bindparam(f'{column.name}_key'))
+        session.execute(statement, updates)
+    inserts = [dict(zip(key_columns, key), enrolled=delta) for key, delta in deltas.items() if key not in existing]
+    if inserts:
+        session.execute(table.insert(), inserts)
+
+
+class EnrollmentViewConsumer:
+    """
+    Applies the EnrollmentEvent log to the views batch by batch, every batch in a unit of work on the calling
+    thread's session. One consumer at a time should run, on MySQL the checkpoint row is locked while a batch is
+    applied.
+    """
+    def __init__(self, batch_size=EVENT_BATCH_SIZE):
+        self._batch_size = batch_size
+        self._stopping = threading.Event()
+        self._worker = None
+
+    def consume(self):
+        """ Applies the next batch of events and the ones that turned up in the gaps, returns how many it applied """
+        settled_before = self._settled_before()
+        with unit_of_work as session:
+            checkpoint = session.query(EventCheckpoint).filter(EventCheckpoint.name == CHECKPOINT). \
+                with_for_update().first()
+            if checkpoint is None:
+                checkpoint = EventCheckpoint(name=CHECKPOINT, position=0)
+                session.add(checkpoint)
+            gaps = session.query(EventGap.first_id, EventGap.last_id, EventGap.noted_at). \
+                filter(EventGap.name == CHECKPOINT).all()
+            late = session.query(*EVENT_COLUMNS).filter(or_(*[EnrollmentEvent.id.between(first_id, last_id)
+                                                               for first_id, last_id, _ in gaps])).all() \
+                if gaps else []
+            events = session.query(*EVENT_COLUMNS).filter(EnrollmentEvent.id > checkpoint.position). \
+                order_by(EnrollmentEvent.id).limit(self._batch_size).all()
+            if late or events:
+                deltas = _view_deltas(session, [event[1:] for event in late + events])
+                for (model, key_columns), view_deltas in zip(VIEW_KEYS, deltas):
+                    _apply_deltas(session, model, key_columns, view_deltas)
+            self._note_gaps(session, checkpoint.position, gaps, late, events, settled_before)
+            if events:
+                checkpoint.position = events[-1][0]
+        return len(late) + len(events)
+
+    @staticmethod
+    def _note_gaps(session, position, gaps, late, events, settled_before):
+        """ Saves what is still missing of the gaps and the ranges of ids the events skip """
+        found = {event[0] for event in late}
+        remaining = [{'name': CHECKPOINT, 'first_id': first, 'last_id': last, 'noted_at': noted_at}
+                     for first_id, last_id, noted_at in gaps
+                     if settled_before is None or noted_at >= settled_before
+                     for first, last in missing_ranges(first_id, last_id, found)]
+        skipped = []
+        for event_id, *_ in events:
+            if event_id > position + 1:
+                skipped.append({'name': CHECKPOINT, 'first_id': position + 1, 'last_id': event_id - 1})
+            position = event_id
+        if {(gap['first_id'], gap['last_id']) for gap in remaining} != {gap[:2] for gap in gaps}:
+            session.execute(EventGap.__table__.delete().where(EventGap.__table__.c.name == CHECKPOINT))
+            if remaining:
+                session.execute(EventGap.__table__.insert(), remaining)
+        if skipped:
+            session.execute(EventGap.__table__.insert(), skipped)
+
+    @staticmethod
+    def _settled_before():
+        """
+        A time of the database's clock by which every transaction open before it has ended, so the ids still
+        missing in the gaps noted before it were rolled back, or None when the database cannot tell. It is read
+        before the batch's transaction starts, which then sees all that those transactions committed.
+        """
+        return Database().settled_before()[0]
+
+    def catch_up(self):
+        """ Applies every event logged so far, returns how many """
+        applied = 0
+        while True:
+            consumed = self.consume()
+            if not consumed:
+                return applied
+            applied += consumed
+
+    def start(self, poll_seconds=IDLE_INTERVAL):
+        """ Keeps the views caught up from a daemon thread, polling the log when it has nothing to apply """
+        self._stopping.clear()
+        self._worker = threading.Thread(target=self._work, args=(poll_seconds,), name='enrollment-views',
+                                        daemon=True)
+        self._worker.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def _work(self, poll_seconds):
+        while not self._stopping.is_set():
+            try:
+                consumed = self.consume()
+            except Exception as error:
+                log.error(f"Applying enrollment events to the views failed: {error}")
+                consumed = 0
+            if consumed < self._batch_size:
+                self._stopping.wait(poll_seconds)
+
+
+@unit_of_work
+def rebuild_views():
+    """ Empties the views and rewinds their checkpoint, the next consume starts over from the first event """
+    for model, _ in VIEW_KEYS:
+        db_session.query(model).delete(synchronize_session=False)
+    db_session.query(EventCheckpoint).filter(EventCheckpoint.name == CHECKPOINT).delete(synchronize_session=False)
+    db_session.query(EventGap).filter(EventGap.name == CHECKPOINT).delete(synchronize_session=False)
+    log.debug("Enrollment views emptied for a replay of the event log")
+
+
+@unit_of_work
+def backfill_events():
+    """
+    Logs an enrolment event for every student_roster row, for a database whose roster predates the log.
+    Does nothing once there are events. Returns the number of events logged.
+    """
+    if db_session.query(EnrollmentEvent.id).first() is not None:
+        return 0
+    rows = db_session.query(student_roster.c.student_id, student_roster.c.section_id, CourseOffering.year,
+                            CourseOffering.quarter). \
+        join(Section, Section.id == student_roster.c.section_id). \
+        join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+        order_by(student_roster.c.section_id, student_roster.c.student_id).all()
+    if rows:
+        db_session.execute(EnrollmentEvent.__table__.insert(),
+                           [{'student_id': student_id, 'section_id': section_id, 'year': year, 'quarter': quarter,
+                             'delta': 1} for student_id, section_id, year, quarter in rows])
+    return len(rows)
+
+
+def replay(session=None, through_event=None, as_of=None):
+    """
+    The EnrollmentViews as of a point of the log, the event with id through_event or the time as_of (UTC),
+    as dicts from the views' keys to the enrolled counts. Sums the log in the database, the views stay as they are.
+    """
+    session = session or db_session
+    events = session.query(EnrollmentEvent.section_id, EnrollmentEvent.year, EnrollmentEvent.quarter,
+                           func.sum(EnrollmentEvent.delta))
+    if through_event is not None:
+        events = events.filter(EnrollmentEvent.id <= through_event)
+    if as_of is not None:
+        events = events.filter(EnrollmentEvent.created_at <= as_of)
+    events = events.group_by(EnrollmentEvent.section_id, EnrollmentEvent.year, EnrollmentEvent.quarter).all()
+    return EnrollmentViews(*({key: int(delta) for key, delta in view.items() if delta}
+                             for view in _view_deltas(session, events)))
+
+
+def read_views(session=None):
+    """ The stored EnrollmentViews in the shape of replay, read on a replica """
+    session = session or db_session
+    with Database().replica_reads():
+        return EnrollmentViews(*({tuple(row[:-1]): row[-1] for row in session.query(
+            *[getattr(model, column) for column in key_columns], model.enrolled).filter(model.enrolled != 0)}
+            for model, key_columns in VIEW_KEYS))
+
+
+def section_fill(section_ids, session=None):
+    """ The enrolled students of the sections as of the last event the views applied """
+    session = session or db_session
+    with Database().replica_reads():
+        fill = dict(session.query(SectionFill.section_id, SectionFill.enrolled).
+                    filter(SectionFill.section_id.in_(list(section_ids))))
+    return {section_id: fill.get(section_id, 0) for section_id in section_ids}
+
+
+def instructor_load(year, quarter, session=None):
+    """ The enrolled students per instructor id in the term, instructors without students left out """
+    session = session or db_session
+    with Database().replica_reads():
+        return dict(session.query(InstructorLoad.instructor_id, InstructorLoad.enrolled).
+                    filter(InstructorLoad.year == year).filter(InstructorLoad.quarter == quarter).
+                    filter(InstructorLoad.enrolled != 0))
+
+
+def department_totals(year, quarter, session=None):
+    """ The enrolments per Department in the term """
+    session = session or db_session
+    with Database().replica_reads():
+        return dict(session.query(DepartmentTotal.department, DepartmentTotal.enrolled).
+                    filter(DepartmentTotal.year == year).filter(DepartmentTotal.quarter == quarter).
+                    filter(DepartmentTotal.enrolled != 0))
+
+
+def lag(session=None):
+    """ The number of logged events the views have not applied yet """
+    session = session or db_session
+    position = session.query(EventCheckpoint.position).filter(EventCheckpoint.name == CHECKPOINT).scalar() or 0
+    gaps = session.query(EventGap.first_id, EventGap.last_id).filter(EventGap.name == CHECKPOINT).all()
+    return session.query(func.count(EnrollmentEvent.id)).filter(or_(
+        EnrollmentEvent.id > position, *[EnrollmentEvent.id.between(first_id, last_id)
+                                         for first_id, last_id in gaps])).scalar()
+
+
+if __name__ == '__main__':
+    log.debug(f"Applied {EnrollmentViewConsumer().catch_up()} enrollment events to the views")
@@ -24,6 +24,13 @@ class Quarter(enum.Enum):
     summer = 4
 
 
+class TermStatus(enum.Enum):
+    """ Enum class that denotes where a term is in its lifecycle, terms are open until frozen"""
+    open = 1
+    frozen = 2
+    archived = 3
+
+
 class Department(enum.Enum):
     """ Enum class that denotes a department"""
     mpcs = 1
@@ -37,3 +44,30 @@ class SectionType(enum.Enum):
     """ Enum class that denotes the type of section"""
     lecture = 1
     lab = 2
+
+
+class RegistrationStatus(enum.Enum):
+    """ Enum class that denotes the outcome of a registration request"""
+    enrolled = 1
+    course_limit = 2
+    section_full = 3
+    missing_prereq = 4
+    restriction_hold = 5
+    already_enrolled = 6
+    not_found = 7
+    waitlisted = 8
+    schedule_conflict = 9
+    not_open = 10
+    queue_full = 11
+    not_enrolled = 12
+
+
+class Weekday(enum.IntFlag):
+    """ Flags for the days of the week a section meets on"""
+    monday = 1
+    tuesday = 2
+    wednesday = 4
+    thursday = 8
+    friday = 16
+    saturday = 32
+    sunday = 64
@@ -0,0 +1,362 @@
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import event
+from logs import log
+
+"""
+Low overhead instrumentation of the hot paths: the time of every registration handler, the count and time of the
+queries of every request, and the registration outcomes by status.
+Metrics are plain counters and fixed bucket histograms behind a lock, rendered in the Prometheus text format by
+registry.render(). Requests and handlers are also recorded as spans, kept in a ring buffer and handed to the
+exporters added to the tracer. serve_metrics(port) exposes /metrics and /spans over HTTP.
+Queries slower than SLOW_QUERY_SECONDS are logged with their statement, which replaces running with echo=True.
+Set REGIE_INSTRUMENTATION=off to turn it all off."""
+
+# Seconds, from half a millisecond up, the bounds of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+SLOW_QUERY_SECONDS = 0.25
+MAX_SPANS = 2048
+HANDLER_SPAN = 'handler'
+# The endpoints have no authentication, serving them beyond this machine takes an explicit host
+METRICS_HOST = '127.0.0.1'
+# Statements with expanded IN lists are all different, so the cache of their kinds is cleared when it fills up
+MAX_STATEMENT_KINDS = 4096
+QUERY_KINDS = {'select', 'insert', 'update', 'delete', 'begin', 'commit', 'rollback', 'savepoint', 'release'}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """ A monotonically increasing count for every combination of label values """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def lines(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labels, label_values)} {value}" for label_values, value in values]
+
+
+class Histogram:
+    """ Counts of observations in fixed buckets, with their sum, for every combination of label values """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def count(self, *label_values):
+        state = self._values.get(label_values)
+        return sum(state[0]) if state else 0
+
+    def total(self, *label_values):
+        state = self._values.get(label_values)
+        return state[1] if state else 0.0
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def lines(self):
+        with self._lock:
+            values = sorted((label_values, (list(counts), total)) for label_values, (counts, total)
+                            in self._values.items())
+        lines = []
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """ The metrics of the process, by name """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict()
+
+    def _get(self, cls, name, documentation, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._get(Counter, name, documentation, labels=labels)
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, documentation, labels=labels, buckets=buckets)
+
+    def reset(self):
+        """ Zeroes every metric, keeping them registered """
+        for metric in list(self._metrics.values()):
+            metric.reset()
+
+    def render(self):
+        """ Every metric in the Prometheus text exposition format """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+
+class Span:
+    """ A timed piece of work, the queries it ran are added to it and to its parents when it ends """
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent', 'attributes', 'started_at', 'duration', 'child_seconds',
+                 'queries', 'query_seconds')
+
+    def __init__(self, name, trace_id, span_id, parent, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent = parent
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.child_seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def as_dict(self):
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id,
+                'parent_id': self.parent.span_id if self.parent is not None else None,
+                'started_at': self.started_at, 'duration_ms': round(self.duration * 1000, 3),
+                'self_ms': round((self.duration - self.child_seconds) * 1000, 3), 'queries': self.queries,
+                'query_ms': round(self.query_seconds * 1000, 3), 'attributes': self.attributes}
+
+
+# The innermost open span, per thread and per asyncio task
+_current_span = contextvars.ContextVar('regie_span', default=None)
+
+
+class Tracer:
+    """ Opens spans, keeps the last max_spans finished ones and hands each of them to the exporters """
+    def __init__(self, max_spans=MAX_SPANS):
+        self._finished = deque(maxlen=max_spans)
+        self._ids = itertools.count(1)
+        self.exporters = []
+
+    def add_exporter(self, exporter):
+        """ exporter(span_dict) is called with every finished span, on the thread that finished it """
+        self.exporters.append(exporter)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """ Times the block as a child of the open span, yields None when instrumentation is off """
+        if not registry.enabled:
+            yield None
+            return
+        parent = _current_span.get()
+        span_id = next(self._ids)
+        span = Span(name, parent.trace_id if parent is not None else span_id, span_id, parent, attributes)
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - started
+            _current_span.reset(token)
+            if parent is not None:
+                parent.child_seconds += span.duration
+                parent.queries += span.queries
+                parent.query_seconds += span.query_seconds
+            self._finished.append(span)
+            if self.exporters:
+                finished = span.as_dict()
+                for exporter in self.exporters:
+                    exporter(finished)
+
+    def finished_spans(self):
+        return [span.as_dict() for span in list(self._finished)]
+
+    def reset(self):
+        self._finished.clear()
+
+
+registry = Registry(enabled=os.environ.get('REGIE_INSTRUMENTATION', 'on') != 'off')
+tracer = Tracer()
+
+handler_seconds = registry.histogram('regie_handler_seconds', "Time spent in a registration handler, without its "
+                                     "successors", labels=('handler',))
+registration_outcomes = registry.counter('regie_registration_outcomes_total', "Registration decisions by status",
+                                         labels=('status',))
+request_seconds = registry.histogram('regie_request_seconds', "Time of a request", labels=('request',))
+request_queries = registry.histogram('regie_request_queries', "Queries run by a request", labels=('request',),
+                                     buckets=QUERY_COUNT_BUCKETS)
+query_seconds = registry.histogram('regie_query_seconds', "Time of a database query", labels=('engine', 'kind'))
+slow_queries = registry.counter('regie_slow_queries_total', "Queries slower than SLOW_QUERY_SECONDS",
+                                labels=('engine',))
+
+
+@contextmanager
+def request_span(name, **attributes):
+    """ A span for a whole request, whose time and query count go to the request histograms """
+    with tracer.span(name, **attributes) as span:
+        yield span
+    if span is not None:
+        request_seconds.observe(span.duration, name)
+        request_queries.observe(span.queries, name)
+
+
+def _entered_chain(span):
+    """ Whether the span is the handler the request entered the chain at """
+    return span.parent is None or span.parent.name != HANDLER_SPAN
+
+
+def _finished_handler(name, span, status):
+    handler_seconds.observe(span.duration - span.child_seconds, name)
+    span.attributes['status'] = status.name
+    if _entered_chain(span):
+        registration_outcomes.inc(status.name)
+
+
+def instrument_handler(handle_request):
+    """ Wraps the handle_request of a chain handler class to time it and count the outcome of the chain """
+    name = handle_request.__qualname__.split('.')[0]
+
+    @functools.wraps(handle_request)
+    def timed(handler, *args):
+        if not registry.enabled:
+            return handle_request(handler, *args)
+        with tracer.span(HANDLER_SPAN, handler=name) as span:
+            status = handle_request(handler, *args)
+        _finished_handler(name, span, status)
+        return status
+    return timed
+
+
+def instrument_async_handler(handle_request):
+    """ instrument_handler for the coroutine handlers of the async chain """
+    name = handle_request.__qualname__.split('.')[0]
+
+    @functools.wraps(handle_request)
+    async def timed(handler, *args):
+        if not registry.enabled:
+            return await handle_request(handler, *args)
+        with tracer.span(HANDLER_SPAN, handler=name) as span:
+            status = await handle_request(handler, *args)
+        _finished_handler(name, span, status)
+        return status
+    return timed
+
+
+_statement_kinds = {}
+
+
+def _statement_kind(statement):
+    kind = _statement_kinds.get(statement)
+    if kind is None:
+        words = statement.split(None, 1)
+        kind = words[0].lower() if words else ''
+        kind = kind if kind in QUERY_KINDS else 'other'
+        if len(_statement_kinds) >= MAX_STATEMENT_KINDS:
+            _statement_kinds.clear()
+        _statement_kinds[statement] = kind
+    return kind
+
+
+def instrument_engine(engine, role='primary'):
+    """ Times the queries of the engine, adds them to the open span and logs the slow ones """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def started(connection, cursor, statement, parameters, context, executemany):
+        if registry.enabled and context is not None:
+            context.regie_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def finished(connection, cursor, statement, parameters, context, executemany):
+        started_at = getattr(context, 'regie_started', None)
+        if started_at is None:
+            return
+        elapsed = time.perf_counter() - started_at
+        query_seconds.observe(elapsed, role, _statement_kind(statement))
+        span = _current_span.get()
+        if span is not None:
+            span.queries += 1
+            span.query_seconds += elapsed
+        if elapsed >= SLOW_QUERY_SECONDS:
+            slow_queries.inc(role)
+            log.warning(f"Slow query on the {role} engine took {elapsed * 1000:.1f} ms: {statement}")
+    return engine
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = registry.render().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/spans':
+            body, content_type = json.dumps(tracer.finished_spans(), default=str).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port=9464, host=METRICS_HOST):
+    """
+    Serves /metrics and /spans from a daemon thread, returns the server to shut it down.
+    Only local clients can connect unless host names an interface to expose them on, like '0.0.0.0' for all.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -1,12 +1,219 @@
+import atexit
+import json
 import logging
-from mongolog.handlers import MongoHandler
+import os
+import queue
+import tempfile
+import threading
+import time
+from itertools import islice
 
 """
-A Mongodb based logger used for logging
+A Mongodb based logger used for logging.
+Records are queued by the logging call and shipped to the collection in batches by a background thread, so a
+slow or unreachable Mongo never holds up the caller. Batches that can not be shipped are spooled to a local
+file and replayed once the collection is reachable again.
+Nothing connects at import: the worker, the Mongo client and the formatter are created by the first record.
+Set REGIE_LOG_SINK=none to keep the records in the process, REGIE_LOG_HOST to ship them to another Mongo.
 """
 
+# Records waiting to be shipped, beyond this the backpressure policy applies
+QUEUE_CAPACITY = 10000
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.5
+# One spool per process, {pid} is filled in when the worker starts
+SPOOL_PATH = os.path.join(tempfile.gettempdir(), 'regie_log_spool.{pid}.jsonl')
+MAX_SPOOL_BYTES = 64 * 1024 * 1024
+# drop: records that find the queue full are counted and dropped, block: the caller waits up to BLOCK_TIMEOUT
+DROP, BLOCK = 'drop', 'block'
+BLOCK_TIMEOUT = 0.05
+# After a failed shipment batches go straight to the spool for this many seconds before the sink is tried again
+RETRY_INTERVAL = 5
+_STOP = object()
+
+
+def mongo_sink(collection='log', db='mongolog', host='localhost', port=None, timeout_ms=2000):
+    """ The collection the records are shipped to, anything with an insert_many(documents) will do """
+    from pymongo import MongoClient
+    return MongoClient(host=host, port=port, serverSelectionTimeoutMS=timeout_ms)[db][collection]
+
+
+class LazySink:
+    """ A sink created by factory when the first batch is shipped """
+    def __init__(self, factory):
+        self._factory = factory
+        self._sink = None
+
+    def insert_many(self, documents):
+        if self._sink is None:
+            self._sink = self._factory()
+        return self._sink.insert_many(documents)
+
+
+class LogShipper(logging.Handler):
+    """
+    Logging handler that puts the records on a bounded queue and ships them with insert_many from a worker
+    thread. A full queue drops the record or blocks the caller for a while, depending on the policy.
+    Spooled records are shipped at least once, a replay that fails half way ships its first part again.
+    Records that can not be formatted, shipped or spooled are counted as dropped. The worker thread is started
+    by the first record.
+    """
+    def __init__(self, sink, capacity=QUEUE_CAPACITY, policy=DROP, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, spool_path=SPOOL_PATH, max_spool_bytes=MAX_SPOOL_BYTES):
+        super().__init__()
+        self.sink = sink
+        self.policy = policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.max_spool_bytes = max_spool_bytes
+        self.formatter = None
+        self.shipped = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.failures = 0
+        self._retry_at = 0
+        self._queue = queue.Queue(maxsize=capacity)
+        self._worker = None
+
+    def emit(self, record):
+        if self._worker is None:
+            self._start()
+        # Done here so that the worker formats the arguments as they were when logged
+        record.msg = record.getMessage()
+        record.args = ()
+        try:
+            if self.policy == BLOCK:
+                self._queue.put(record, timeout=BLOCK_TIMEOUT)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """ Waits until every record queued so far was shipped or spooled """
+        if self._worker is not None and self._worker.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """ Ships what is queued and stops the worker, registered to run at exit """
+        if self._worker is not None and self._worker.is_alive():
+            self._queue.put(_STOP)
+            self._worker.join()
+        super().close()
+
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'shipped': self.shipped, 'dropped': self.dropped,
+                'spooled': self.spooled, 'failures': self.failures}
+
+    def _start(self):
+        # Runs under the handler lock, which logging takes around emit
+        from mongolog.handlers import MongoFormatter
+        self.formatter = MongoFormatter()
+        self.spool_path = self.spool_path.format(pid=os.getpid())
+        self._worker = threading.Thread(target=self._run, name='log-shipper', daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                self._try_replay()
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not _STOP]
+            stopping = len(records) < len(batch)
+            documents = []
+            try:
+                documents = self._format(records)
+                if documents:
+                    self._ship(documents)
+            except Exception:
+                self._count_dropped(len(documents))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _format(self, records):
+        documents = []
+        for record in records:
+            try:
+                documents.append(self.formatter.format(record))
+            except Exception:
+                self._count_dropped(1)
+        return documents
+
+    def _ship(self, documents):
+        if self._try_replay():
+            try:
+                self.sink.insert_many(documents)
+                self.shipped += len(documents)
+                return
+            except Exception:
+                self._failed()
+        self._spool(documents)
+
+    def _try_replay(self):
+        """ Whether the sink is worth trying, replaying the spool first if there is one """
+        if time.monotonic() < self._retry_at:
+            return False
+        try:
+            self._replay()
+            return True
+        except Exception:
+            self._failed()
+            return False
+
+    def _failed(self):
+        self.failures += 1
+        self._retry_at = time.monotonic() + RETRY_INTERVAL
+
+    def _spool(self, documents):
+        try:
+            size = os.path.getsize(self.spool_path) if os.path.exists(self.spool_path) else 0
+            with open(self.spool_path, 'a') as spool:
+                for document in documents:
+                    line = json.dumps(document, default=str) + '\n'
+                    if size + len(line) > self.max_spool_bytes:
+                        self._count_dropped(1)
+                        continue
+                    spool.write(line)
+                    size += len(line)
+                    self.spooled += 1
+        except OSError:
+            self._count_dropped(len(documents))
+
+    def _count_dropped(self, count):
+        with self.lock:
+            self.dropped += count
+
+    def _replay(self):
+        """ Ships the spooled documents, raises if the sink is still unreachable """
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path) as spool:
+            while True:
+                documents = [json.loads(line) for line in islice(spool, self.batch_size)]
+                if not documents:
+                    break
+                self.sink.insert_many(documents)
+                self.shipped += len(documents)
+        os.remove(self.spool_path)
+
 
 log = logging.getLogger('demo')
 log.setLevel(logging.DEBUG)
-# The collection log is created locally using the default local port
-log.addHandler(MongoHandler.to(db='mongolog', collection='log'))
\ No newline at end of file
+if os.environ.get('REGIE_LOG_SINK', 'mongo') == 'none':
+    log.addHandler(logging.NullHandler())
+else:
+    # The collection log is created locally using the default local port
+    shipper = LogShipper(LazySink(lambda: mongo_sink(db='mongolog', collection='log',
+                                                     host=os.environ.get('REGIE_LOG_HOST', 'localhost'))))
+    log.addHandler(shipper)
+    atexit.register(shipper.close)
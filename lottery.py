@@ -0,0 +1,286 @@
+from collections import namedtuple
+from itertools import chain
+import numpy as np
+from sqlalchemy import select, union_all
+from courses import CourseOffering, Section, SectionPreference, student_roster, archived_student_roster
+from persons import Student, StudentTermLoad
+from database import Database
+from enums import RegistrationStatus
+from course_registration import STUDENT_COURSE_LIMIT, MAX_REGISTRATION_ATTEMPTS, contention_stats
+from enrollment_counters import apply_enrollment_changes, overfilled_sections
+from bulk_registration import ID_CHUNK_SIZE
+from prereq_graph import prereq_graph
+from schedule import DEFAULT_MEETING_MINUTES
+from terms import term_states
+from instrumentation import registration_outcomes, request_span
+from logs import log
+
+db_session = Database().get_session()
+unit_of_work = Database().unit_of_work()
+
+"""
+Seat lottery, the allocation mode for terms whose popular sections would otherwise be a first come first served
+rush through the CourseRegChain. Students submit ranked section preferences while the window is open, then
+SeatLottery allocates the whole term in one pass over NumPy arrays of students and preferences.
+Every round takes each student's best preference still open, turns down the ones the student can no longer take
+(course limit, schedule conflict, no seat left) and hands the seats of every section to its contenders in the
+order of a lottery number drawn once per student. Prereqs, restriction holds and sections already on the roster
+are checked once up front. The seats won are written to the student_roster, with their counters, in one
+transaction."""
+
+PENDING = 0
+AllocationResult = namedtuple('AllocationResult', ['student_id', 'section_id', 'rank', 'status'])
+# The preferences, sections and students of a term as arrays, students and sections are referred to by position
+TermDemand = namedtuple('TermDemand', ['student_ids', 'pref_student', 'pref_section', 'pref_rank', 'status',
+                                       'section_ids', 'section_group', 'remaining', 'days', 'start', 'end',
+                                       'load', 'held_days', 'held_start', 'held_end', 'held_count'])
+_statuses = {status.value: status for status in RegistrationStatus}
+
+
+def _minutes(value):
+    return value.hour * 60 + value.minute
+
+
+def _term_sections(year, quarter):
+    return select(Section.id).join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+        where(CourseOffering.year == year).where(CourseOffering.quarter == quarter)
+
+
+@unit_of_work
+def submit_preferences(student_id, year, quarter, section_ids):
+    """ Replaces the student's preferences for the term with the given sections, ranked in the order given """
+    if not term_states.is_open(db_session, year, quarter):
+        raise ValueError(f"{quarter.name} {year} is frozen")
+    section_ids = list(dict.fromkeys(section_ids))
+    in_term = {section_id for section_id, in db_session.execute(
+        _term_sections(year, quarter).where(Section.id.in_(section_ids)))}
+    if len(in_term) != len(section_ids):
+        raise ValueError(f"Sections {sorted(set(section_ids) - in_term)} are not offered in {quarter.name} {year}")
+    db_session.query(SectionPreference).filter(SectionPreference.student_id == student_id). \
+        filter(SectionPreference.section_id.in_(_term_sections(year, quarter))).delete(synchronize_session=False)
+    if section_ids:
+        db_session.execute(SectionPreference.__table__.insert(),
+                           [{'student_id': student_id, 'section_id': section_id, 'rank': rank}
+                            for rank, section_id in enumerate(section_ids, start=1)])
+
+
+def _conflicts(demand, students, sections):
+    """ Whether each section meets on a day and at a time of a section its student already holds """
+    days = demand.days[sections][:, None]
+    return (((demand.held_days[students] & days) != 0) &
+            (demand.held_start[students] < demand.end[sections][:, None]) &
+            (demand.start[sections][:, None] < demand.held_end[students])).any(axis=1)
+
+
+def allocate_seats(demand, lottery, course_limit=STUDENT_COURSE_LIMIT):
+    """
+    Decides every pending preference of the demand in place, lottery holds the draw of every student, lower draws
+    win. Returns the status array. Each round decides at least one preference of every student still waiting, so
+    there are as many rounds as the longest list of preferences.
+    """
+    status = demand.status
+    pending = status == PENDING
+    while pending.any():
+        waiting = np.flatnonzero(pending)
+        # Preferences are ordered by student and rank, so the first pending one of each student is their best
+        first = waiting[np.unique(demand.pref_student[waiting], return_index=True)[1]]
+        students = demand.pref_student[first]
+        sections = demand.pref_section[first]
+
+        turned_down = np.zeros(len(first), dtype=status.dtype)
+        # In the CourseRegChain's order, the later checks take precedence
+        turned_down[_conflicts(demand, students, sections)] = RegistrationStatus.schedule_conflict.value
+        turned_down[demand.remaining[sections] <= 0] = RegistrationStatus.section_full.value
+        turned_down[demand.load[students] >= course_limit] = RegistrationStatus.course_limit.value
+        status[first] = turned_down
+
+        contenders = first[turned_down == PENDING]
+        contended = demand.pref_section[contenders]
+        order = np.lexsort((lottery[demand.pref_student[contenders]], contended))
+        ordered_sections = contended[order]
+        place = np.arange(len(order)) - np.searchsorted(ordered_sections, ordered_sections)
+        won = place < demand.remaining[ordered_sections]
+        winners = contenders[order[won]]
+        status[contenders[order[~won]]] = RegistrationStatus.section_full.value
+        status[winners] = RegistrationStatus.enrolled.value
+
+        # A student wins at most one preference per round, so the students are all different
+        students = demand.pref_student[winners]
+        sections = demand.pref_section[winners]
+        np.subtract.at(demand.remaining, sections, 1)
+        column = demand.held_count[students]
+        demand.held_days[students, column] = demand.days[sections]
+        demand.held_start[students, column] = demand.start[sections]
+        demand.held_end[students, column] = demand.end[sections]
+        demand.held_count[students] += 1
+        demand.load[students] += 1
+
+        pending = status == PENDING
+        # The other sections of a course offering and type the student just got are alternatives that lapse
+        groups = demand.section_group.max() + 1
+        taken = students.astype(np.int64) * groups + demand.section_group[sections]
+        lapsed = pending & np.isin(demand.pref_student.astype(np.int64) * groups +
+                                   demand.section_group[demand.pref_section], taken)
+        status[lapsed] = RegistrationStatus.already_enrolled.value
+        pending &= ~lapsed
+    return status
+
+
+class SeatLottery:
+    """
+    Allocates the seats of a term to the students who submitted preferences for it, see allocate_seats.
+    A seed makes the draw, and so the allocation, reproducible. Preferences stay on record after the allocation,
+    running it again only fills the seats that became free.
+    """
+    def __init__(self, session=None, seed=None, course_limit=STUDENT_COURSE_LIMIT):
+        self._session = session or db_session
+        self._random = np.random.default_rng(seed)
+        self._course_limit = course_limit
+
+    def allocate(self, year, quarter):
+        """
+        Allocates and writes the seats of the term and returns an AllocationResult for every preference.
+        Should registrations outside of the lottery take the seats it counted on, the allocation is rolled back and
+        run again from the new counts, up to MAX_REGISTRATION_ATTEMPTS times. Raises ValueError for a frozen term.
+        """
+        if not term_states.is_open(self._session, year, quarter):
+            raise ValueError(f"{quarter.name} {year} is frozen")
+        with request_span('lottery', year=year, quarter=quarter.name) as span:
+            for attempt in range(1, MAX_REGISTRATION_ATTEMPTS + 1):
+                demand = self.load_demand(year, quarter)
+                status = allocate_seats(demand, self._random.permutation(len(demand.student_ids)),
+                                        self._course_limit)
+                winners = np.flatnonzero(status == RegistrationStatus.enrolled.value)
+                rows = list(zip(demand.student_ids[demand.pref_student[winners]].tolist(),
+                                demand.section_ids[demand.pref_section[winners]].tolist()))
+                if self._write(rows, (year, quarter)):
+                    break
+                contention_stats.record_conflict()
+                contention_stats.record_retry()
+            else:
+                log.error(f"Seat lottery gave up after {MAX_REGISTRATION_ATTEMPTS} seat conflicts")
+                raise RuntimeError("Seat lottery kept conflicting with concurrent registrations")
+            if span is not None:
+                span.attributes.update(preferences=len(status), enrolled=len(rows))
+        codes, counts = np.unique(status, return_counts=True)
+        for code, count in zip(codes.tolist(), counts.tolist()):
+            registration_outcomes.inc(_statuses[code].name, amount=count)
+        log.debug(f"Seat lottery of {quarter.name} {year} enrolled {len(rows)} of {len(status)} preferences")
+        return [AllocationResult(student_id, section_id, rank, _statuses[code]) for student_id, section_id, rank, code
+                in zip(demand.student_ids[demand.pref_student].tolist(),
+                       demand.section_ids[demand.pref_section].tolist(), demand.pref_rank.tolist(), status.tolist())]
+
+    def load_demand(self, year, quarter):
+        """ Reads the term's preferences, sections and the state of the students who submitted them """
+        session = self._session
+        term_sections = _term_sections(year, quarter)
+        rows = session.query(SectionPreference.student_id, SectionPreference.section_id, SectionPreference.rank). \
+            filter(SectionPreference.section_id.in_(term_sections)). \
+            order_by(SectionPreference.student_id, SectionPreference.rank).all()
+        preferences = np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=3 * len(rows)).reshape(-1, 3)
+        bidders = select(SectionPreference.student_id).where(SectionPreference.section_id.in_(term_sections))
+        student_ids, pref_student = np.unique(preferences[:, 0], return_inverse=True)
+
+        sections = session.query(Section.id, Section.course_offering_id, Section.type, Section.size_limit,
+                                 Section.enrolled_count, Section.days, Section.time, Section.end_time,
+                                 CourseOffering.course_id). \
+            join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+            filter(CourseOffering.year == year).filter(CourseOffering.quarter == quarter).order_by(Section.id).all()
+        section_ids = np.array([row[0] for row in sections], dtype=np.int64)
+        _, section_group = np.unique(np.array([(row[1], row[2].value if row[2] else 0) for row in sections],
+                                              dtype=np.int64).reshape(-1, 2), axis=0, return_inverse=True)
+        section_group = section_group.reshape(-1)
+        remaining = np.array([max(0, (size_limit or 0) - (enrolled or 0))
+                              for _, _, _, size_limit, enrolled, _, _, _, _ in sections], dtype=np.int64)
+        meets = [bool(days) and start is not None for _, _, _, _, _, days, start, _, _ in sections]
+        days = np.array([row[5] if meet else 0 for row, meet in zip(sections, meets)], dtype=np.int64)
+        start = np.array([_minutes(row[6]) if meet else 0 for row, meet in zip(sections, meets)], dtype=np.int64)
+        end = np.array([(_minutes(row[7]) if row[7] is not None else _minutes(row[6]) + DEFAULT_MEETING_MINUTES)
+                        if meet else 0 for row, meet in zip(sections, meets)], dtype=np.int64)
+        pref_section = np.searchsorted(section_ids, preferences[:, 1])
+        status = np.full(len(preferences), PENDING, dtype=np.int8)
+
+        holds = np.zeros(len(student_ids), dtype=bool)
+        for student_id, hold in session.query(Student.id, Student.restriction_hold).filter(Student.id.in_(bidders)):
+            holds[np.searchsorted(student_ids, student_id)] = bool(hold)
+        status[holds[pref_student]] = RegistrationStatus.restriction_hold.value
+        self._check_prereqs(preferences, pref_student, student_ids, sections, pref_section, status, bidders)
+
+        load = np.zeros(len(student_ids), dtype=np.int64)
+        for student_id, course_count in session.query(StudentTermLoad.student_id, StudentTermLoad.course_count). \
+                filter(StudentTermLoad.year == year).filter(StudentTermLoad.quarter == quarter). \
+                filter(StudentTermLoad.student_id.in_(bidders)):
+            load[np.searchsorted(student_ids, student_id)] = course_count
+        held_days, held_start, held_end = (np.zeros((len(student_ids), self._course_limit), dtype=np.int64)
+                                           for _ in range(3))
+        held_count = np.zeros(len(student_ids), dtype=np.int64)
+        enrolled = []
+        groups = section_group.max() + 1 if len(section_group) else 1
+        # The whole roster of the term, which is no larger than its seats, joins faster than the bidders' part of it
+        for student_id, section_id in session.query(student_roster.c.student_id, student_roster.c.section_id). \
+                join(Section, Section.id == student_roster.c.section_id). \
+                join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+                filter(CourseOffering.year == year).filter(CourseOffering.quarter == quarter):
+            student, section = np.searchsorted(student_ids, student_id), np.searchsorted(section_ids, section_id)
+            if student == len(student_ids) or student_ids[student] != student_id:
+                continue
+            enrolled.append(student * groups + section_group[section])
+            if held_count[student] < self._course_limit:
+                column = held_count[student]
+                held_days[student, column], held_start[student, column], held_end[student, column] = \
+                    days[section], start[section], end[section]
+                held_count[student] += 1
+        # Holding a section of an offering and type rules out its alternatives as well
+        status[np.isin(pref_student.astype(np.int64) * groups + section_group[pref_section], enrolled)] = \
+            RegistrationStatus.already_enrolled.value
+        return TermDemand(student_ids, pref_student, pref_section, preferences[:, 2], status, section_ids,
+                          section_group, remaining, days, start, end, np.maximum(load, held_count), held_days,
+                          held_start, held_end, held_count)
+
+    def _check_prereqs(self, preferences, pref_student, student_ids, sections, pref_section, status, bidders):
+        """ Turns down the preferences for courses whose prereqs are not on the student's live or archived roster """
+        course_ids = [row[8] for row in sections]
+        prereq_graph.ensure_courses(self._session, set(course_ids))
+        required = np.array([prereq_graph.required_mask(course_id) != 0 for course_id in course_ids], dtype=bool)
+        checked = np.flatnonzero(required[pref_section] & (status == PENDING))
+        if not len(checked):
+            return
+        taken = {}
+        rows = union_all(select(student_roster.c.student_id, CourseOffering.course_id).
+                         join(Section, Section.id == student_roster.c.section_id).
+                         join(CourseOffering, Section.course_offering_id == CourseOffering.id).
+                         where(student_roster.c.student_id.in_(bidders)),
+                         select(archived_student_roster.c.student_id, archived_student_roster.c.course_id).
+                         where(archived_student_roster.c.student_id.in_(bidders)))
+        for student_id, course_id in self._session.execute(rows):
+            taken[student_id] = taken.get(student_id, 0) | prereq_graph.bit(course_id)
+        for index in checked.tolist():
+            if not prereq_graph.satisfied(course_ids[pref_section[index]],
+                                          taken.get(int(student_ids[pref_student[index]]), 0)):
+                status[index] = RegistrationStatus.missing_prereq.value
+
+    def _write(self, rows, term):
+        """ Writes the seats won with their counters, returns False if that would oversell a section """
+        session = self._session
+        try:
+            for start in range(0, len(rows), ID_CHUNK_SIZE):
+                chunk = rows[start:start + ID_CHUNK_SIZE]
+                session.execute(student_roster.insert(), [{'student_id': student_id, 'section_id': section_id}
+                                                          for student_id, section_id in chunk])
+                apply_enrollment_changes(session, [(student_id, section_id, 1) for student_id, section_id in chunk],
+                                         terms={section_id: term for _, section_id in chunk})
+            # The counter updates hold the section rows until commit, so this sees every concurrent enrolment
+            won = sorted({section_id for _, section_id in rows})
+            for start in range(0, len(won), ID_CHUNK_SIZE):
+                if overfilled_sections(session, won[start:start + ID_CHUNK_SIZE]):
+                    session.rollback()
+                    return False
+            session.commit()
+        except Exception:
+            session.rollback()
+            log.error("Seat lottery failed, no enrollments were written")
+            raise
+        finally:
+            # Relationship collections loaded before the insert would otherwise still show the old rosters
+            session.expire_all()
+        return True
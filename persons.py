@@ -1,13 +1,18 @@
 from sqlalchemy import Column, Integer, String, Table, Boolean, ForeignKey, create_engine, Time, Enum, UniqueConstraint
 from sqlalchemy.orm import relationship, backref
 from database import Database
-from enums import DegreeProgram, Department, StudentType
+from enums import DegreeProgram, Department, StudentType, Quarter
 from courses import student_roster, instructor_roster
 
 Base = Database().get_base()
 db_session = Database().get_session()
 
 
+def student_key(student_id):
+    """ The replica_reads key of what a student registered for """
+    return 'student', student_id
+
+
 class Student(Base):
     """
     Student class representing student in the model.
@@ -79,4 +84,33 @@ class Advisor(Base):
                f"department: {self.department}"
 
 
+class StudentTermLoad(Base):
+    """
+    Denormalized number of sections a student is enrolled in for a given year and quarter.
+    Kept up to date by enrollment_counters whenever the student_roster changes.
+    """
+    __tablename__ = 'student_term_load'
+    student_id = Column(Integer, ForeignKey('student.id'), primary_key=True)
+    year = Column(Integer, primary_key=True)
+    quarter = Column(Enum(Quarter), primary_key=True)
+    course_count = Column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"student_id: {self.student_id}, year: {self.year}, quarter: {self.quarter}, " \
+               f"course_count: {self.course_count}"
 
+
+class InstructorLoad(Base):
+    """
+    Materialized view of the students enrolled in the sections an instructor teaches per term, kept by
+    enrollment_views from the event log
+    """
+    __tablename__ = 'instructor_load'
+    instructor_id = Column(Integer, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    quarter = Column(Enum(Quarter), primary_key=True)
+    enrolled = Column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"instructor_id: {self.instructor_id}, year: {self.year}, quarter: {self.quarter}, " \
+               f"enrolled: {self.enrolled}"
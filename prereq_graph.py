@@ -0,0 +1,223 @@
+import threading
+import time
+from sqlalchemy import event, select, union_all
+from sqlalchemy.orm import Session
+from courses import Course, CourseOffering, Section, prereqs, student_roster, archived_student_roster
+from database import Database
+from logs import log
+
+"""
+The prerequisite graph of the catalog with its transitive closure precomputed.
+Courses that are a prerequisite of another course get a bit, so the closure of a course and the courses a
+student has taken are both bitsets and checking a registration is a single subset test.
+The courses a student has taken are those on the live roster and those of the archived terms. Their bitset is
+kept for STUDENT_MASK_TTL seconds and dropped when a transaction of this process changes the student's roster."""
+
+# How long the courses a student has taken are trusted, bounds how late roster changes of other processes show
+STUDENT_MASK_TTL = 5.0
+# Students whose taken courses are kept, beyond this the cache starts over
+MAX_STUDENT_MASKS = 100000
+# The session.info entry holding the ids of the students whose roster the transaction changed
+CHANGED_STUDENTS = 'prereq_changed_students'
+
+
+class PrereqCycleError(Exception):
+    """ Raised when a course would end up being its own (transitive) prerequisite """
+
+
+class PrereqGraph:
+    """
+    In-process prerequisite graph, loaded from the prereqs table on first use and kept up to date by
+    CourseBuilder.create_new_course. Courses created by other processes are picked up when first checked.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._direct = {}
+        self._closure = {}
+        self._bits = {}
+        # student id: (bitset of the courses taken, time.monotonic() when read)
+        self._students = {}
+        # Bumped whenever taken courses are forgotten, a read that started before is not kept
+        self._generation = 0
+
+    def reset(self):
+        """ Forgets the graph, it is loaded again on the next check """
+        with self._lock:
+            self._loaded = False
+            self._direct = {}
+            self._closure = {}
+            self._bits = {}
+            self.forget_students()
+
+    def forget_students(self, student_ids=None):
+        """ Drops the cached taken courses of the students, of every student when student_ids is None """
+        with self._lock:
+            self._generation += 1
+            if student_ids is None:
+                self._students = {}
+            else:
+                for student_id in student_ids:
+                    self._students.pop(student_id, None)
+
+    def load(self, session):
+        """ (Re)builds the graph and its closure from the course and prereqs tables """
+        direct = {course_id: set() for course_id, in session.query(Course.id)}
+        for course_id, prereq_id in session.query(prereqs.c.course_id, prereqs.c.prereq_id):
+            direct.setdefault(course_id, set()).add(prereq_id)
+        with self._lock:
+            self._direct = {course_id: frozenset(prereq_ids) for course_id, prereq_ids in direct.items()}
+            self._bits = {}
+            self.forget_students()
+            for prereq_ids in self._direct.values():
+                for prereq_id in prereq_ids:
+                    self._bit(prereq_id)
+            self._closure = self._close_all()
+            self._loaded = True
+        log.debug(f"Prerequisite graph loaded with {len(direct)} courses and {len(self._bits)} prerequisites")
+
+    def check_acyclic(self, course_id, prereq_ids):
+        """ Raises PrereqCycleError if giving course_id these prereqs would close a cycle """
+        with self._lock:
+            course_bit = self._bits.get(course_id, 0)
+            for prereq_id in prereq_ids:
+                if prereq_id == course_id or self._closure.get(prereq_id, 0) & course_bit:
+                    raise PrereqCycleError(f"Course {course_id} would be its own prerequisite through {prereq_id}")
+
+    def add_course(self, course_id, prereq_ids):
+        """ Adds a course, or replaces the prereqs of one, and updates the closure """
+        prereq_ids = frozenset(prereq_ids)
+        with self._lock:
+            self.check_acyclic(course_id, prereq_ids)
+            existed = course_id in self._direct
+            self._direct[course_id] = prereq_ids
+            for prereq_id in prereq_ids:
+                self._direct.setdefault(prereq_id, frozenset())
+                self._bit(prereq_id)
+            if existed:
+                # Courses that depend on this one inherit the change, so every closure is recomputed
+                self._closure = self._close_all()
+            else:
+                self._close(course_id, self._closure, set())
+
+    def closure(self, course_id):
+        """ The ids of every direct and transitive prerequisite of the course """
+        mask = self._closure.get(course_id, 0)
+        return {prereq_id for prereq_id, bit in self._bits.items() if mask & bit}
+
+    def required_mask(self, course_id):
+        return self._closure.get(course_id, 0)
+
+    def completed_mask(self, course_ids):
+        """ The bitset of the given taken courses, courses that are nobody's prerequisite have no bit """
+        mask = 0
+        for course_id in course_ids:
+            mask |= self._bits.get(course_id, 0)
+        return mask
+
+    def bit(self, course_id):
+        return self._bits.get(course_id, 0)
+
+    def satisfied(self, course_id, completed_mask):
+        return self._closure.get(course_id, 0) & ~completed_mask == 0
+
+    def has_prereqs(self, session, student_id, course_id):
+        """ Whether the student has taken every transitive prerequisite of the course """
+        self._ensure_course(session, course_id)
+        required = self._closure[course_id]
+        if not required:
+            return True
+        return required & ~self.student_mask(session, student_id) == 0
+
+    def student_mask(self, session, student_id):
+        """ The bitset of the courses the student has taken, read at most every STUDENT_MASK_TTL seconds """
+        cached = self._students.get(student_id)
+        if cached is not None and time.monotonic() - cached[1] < STUDENT_MASK_TTL:
+            return cached[0]
+        generation = self._generation
+        taken = union_all(select(CourseOffering.course_id).
+                          join(Section, Section.course_offering_id == CourseOffering.id).
+                          join(student_roster, student_roster.c.section_id == Section.id).
+                          where(student_roster.c.student_id == student_id),
+                          select(archived_student_roster.c.course_id).
+                          where(archived_student_roster.c.student_id == student_id))
+        taken_ids = [taken_id for taken_id, in session.execute(taken)]
+        with self._lock:
+            mask = self.completed_mask(taken_ids)
+            # Not kept when a roster change or a new prerequisite bit came in meanwhile
+            if generation == self._generation:
+                if len(self._students) >= MAX_STUDENT_MASKS:
+                    self._students = {}
+                self._students[student_id] = (mask, time.monotonic())
+        return mask
+
+    def ensure_courses(self, session, course_ids):
+        for course_id in course_ids:
+            self._ensure_course(session, course_id)
+
+    def _ensure_course(self, session, course_id):
+        if not self._loaded:
+            self.load(session)
+        if course_id not in self._direct:
+            prereq_ids = [prereq_id for prereq_id, in session.query(prereqs.c.prereq_id).
+                          filter(prereqs.c.course_id == course_id)]
+            self.ensure_courses(session, prereq_ids)
+            self.add_course(course_id, prereq_ids)
+
+    def _bit(self, course_id):
+        if course_id not in self._bits:
+            self._bits[course_id] = 1 << len(self._bits)
+            # Masks read before lack the new bit
+            self.forget_students()
+        return self._bits[course_id]
+
+    def _close_all(self):
+        """ Computes every closure into a new dict, so readers never see a half built one """
+        closure = {}
+        for course_id in self._direct:
+            self._close(course_id, closure, set())
+        return closure
+
+    def _close(self, course_id, closure, visiting):
+        if course_id in closure:
+            return closure[course_id]
+        if course_id in visiting:
+            raise PrereqCycleError(f"Course {course_id} is its own prerequisite")
+        visiting.add(course_id)
+        mask = 0
+        for prereq_id in self._direct.get(course_id, ()):
+            mask |= self._bits[prereq_id] | self._close(prereq_id, closure, visiting)
+        visiting.discard(course_id)
+        closure[course_id] = mask
+        return mask
+
+
+def archived_courses(session, student_ids):
+    """ The (student id, course id) of the courses the students took in archived terms """
+    return session.query(archived_student_roster.c.student_id, archived_student_roster.c.course_id). \
+        filter(archived_student_roster.c.student_id.in_(list(student_ids))).distinct()
+
+
+def changed_students(session, student_ids):
+    """ Records that the session's transaction changed the roster of the students, see STUDENT_MASK_TTL """
+    session.info.setdefault(CHANGED_STUDENTS, set()).update(student_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_committed(session):
+    # Also called when a savepoint is released, the outer transaction may still roll back then
+    if session.in_nested_transaction():
+        return
+    prereq_graph.forget_students(session.info.pop(CHANGED_STUDENTS, ()))
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_rolled_back(session, previous_transaction):
+    # Masks read inside the transaction saw its changes, the outer transaction's changes stay recorded
+    changed = session.info.get(CHANGED_STUDENTS, set()) if previous_transaction.nested else \
+        session.info.pop(CHANGED_STUDENTS, ())
+    prereq_graph.forget_students(list(changed))
+
+
+prereq_graph = PrereqGraph()
+Database().on_configure(prereq_graph.reset)
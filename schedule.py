@@ -0,0 +1,126 @@
+import heapq
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import time as time_of_day
+from courses import CourseOffering, Section, student_roster
+from enums import Weekday
+
+"""
+Meeting times of sections as intervals on the minutes of a week, a per-student interval index that tells
+whether a section clashes with what the student is enrolled in, and a sweep over a whole term that reports every
+clash in O(n log n)."""
+
+DAY_MINUTES = 24 * 60
+# Length of the meetings of sections that have a start time but no end time
+DEFAULT_MEETING_MINUTES = 80
+# Registrar style day letters, R is Thursday and U Sunday
+DAY_LETTERS = {'M': Weekday.monday, 'T': Weekday.tuesday, 'W': Weekday.wednesday, 'R': Weekday.thursday,
+               'F': Weekday.friday, 'S': Weekday.saturday, 'U': Weekday.sunday}
+
+
+def parse_days(value):
+    """ The Weekday flags of "MWF", "TR" and the like, integers are taken as flags already """
+    if not value:
+        return Weekday(0)
+    if isinstance(value, int):
+        return Weekday(value)
+    days = Weekday(0)
+    for letter in value.upper():
+        days |= DAY_LETTERS[letter]
+    return days
+
+
+def parse_time(value):
+    """ A datetime.time from "HH:MM", None and time values are returned as they are """
+    if value is None or isinstance(value, time_of_day):
+        return value
+    hour, minute = value.split(':')[:2]
+    return time_of_day(int(hour), int(minute))
+
+
+def meetings(days, start, end=None):
+    """ The (start, end) minutes of the week of every meeting, none without days or a start time """
+    if not days or start is None:
+        return []
+    start_minute = start.hour * 60 + start.minute
+    end_minute = end.hour * 60 + end.minute if end is not None else start_minute + DEFAULT_MEETING_MINUTES
+    return [(day * DAY_MINUTES + start_minute, day * DAY_MINUTES + end_minute)
+            for day in range(7) if days & (1 << day)]
+
+
+class ScheduleIndex:
+    """
+    The meetings of one student's sections in a term, sorted by start with the running maximum of their ends.
+    Whether a meeting overlaps any of them is a binary search for the meetings that start before it ends,
+    followed by a look at the latest end among those.
+    """
+    def __init__(self):
+        self._meetings = []
+        self._max_ends = []
+
+    def add(self, section_id, days, start, end=None):
+        for meeting_start, meeting_end in meetings(days, start, end):
+            meeting = (meeting_start, meeting_end, section_id)
+            index = bisect_left(self._meetings, meeting)
+            self._meetings.insert(index, meeting)
+            self._max_ends.insert(index, max(self._max_ends[index - 1], meeting_end) if index else meeting_end)
+            # The maxima after it only grow up to its end, and stop changing at the first that reaches it
+            for later in range(index + 1, len(self._max_ends)):
+                if self._max_ends[later] >= meeting_end:
+                    break
+                self._max_ends[later] = meeting_end
+
+    def conflict(self, days, start, end=None, section_id=None):
+        """ The id of an indexed section that meets at the same time, None if there is none """
+        for meeting_start, meeting_end in meetings(days, start, end):
+            # Back from the last meeting that starts before this one ends, while any of them ends after it starts
+            index = bisect_left(self._meetings, (meeting_end,)) - 1
+            while index >= 0 and self._max_ends[index] > meeting_start:
+                _, other_end, other_id = self._meetings[index]
+                if other_end > meeting_start and other_id != section_id:
+                    return other_id
+                index -= 1
+        return None
+
+    def __len__(self):
+        return len(self._meetings)
+
+
+def student_schedule(session, student_id, year, quarter):
+    """ The ScheduleIndex of the sections the student is enrolled in for the term """
+    schedule = ScheduleIndex()
+    rows = session.query(Section.id, Section.days, Section.time, Section.end_time). \
+        join(student_roster, student_roster.c.section_id == Section.id). \
+        join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+        filter(student_roster.c.student_id == student_id). \
+        filter(CourseOffering.year == year).filter(CourseOffering.quarter == quarter)
+    for section_id, days, start, end in rows:
+        schedule.add(section_id, days, start, end)
+    return schedule
+
+
+def find_term_conflicts(session, year, quarter):
+    """
+    Every pair of sections of the term that a student is enrolled in and that meet at the same time,
+    as (student id, lower section id, higher section id). Sweeps each student's meetings in
+    order of start, keeping the ends of the meetings still running on a heap.
+    """
+    rows = session.query(student_roster.c.student_id, Section.id, Section.days, Section.time, Section.end_time). \
+        join(Section, Section.id == student_roster.c.section_id). \
+        join(CourseOffering, Section.course_offering_id == CourseOffering.id). \
+        filter(CourseOffering.year == year).filter(CourseOffering.quarter == quarter)
+    by_student = defaultdict(list)
+    for student_id, section_id, days, start, end in rows:
+        by_student[student_id].extend((meeting_start, meeting_end, section_id)
+                                      for meeting_start, meeting_end in meetings(days, start, end))
+    conflicts = set()
+    for student_id, student_meetings in by_student.items():
+        running = []
+        for meeting_start, meeting_end, section_id in sorted(student_meetings):
+            while running and running[0][0] <= meeting_start:
+                heapq.heappop(running)
+            for _, other_id in running:
+                if other_id != section_id:
+                    conflicts.add((student_id, min(other_id, section_id), max(other_id, section_id)))
+            heapq.heappush(running, (meeting_end, section_id))
+    return sorted(conflicts)
@@ -0,0 +1,116 @@
+import threading
+from array import array
+from collections import defaultdict
+from sqlalchemy import or_
+from courses import Course
+from database import Database, IdGaps
+from logs import log
+
+"""
+In-process trigram index over the course names, codes and descriptions.
+A text filter is answered by intersecting the posting lists of its trigrams and verifying the few candidates,
+the same case-insensitive substring match as LIKE '%text%', without the full table scan."""
+
+FIELDS = ('name', 'course_code', 'description')
+# Beyond this many matches an IN list costs more than the scan it replaces
+MAX_ID_FILTER = 5000
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class CourseSearchIndex:
+    """
+    Trigram index of the catalog, loaded from the course table on first use and kept up to date by CourseBuilder.
+    Every lookup first catches up with courses that other processes inserted, by querying above the highest id seen
+    and in the ids below it that were skipped while their transactions had not committed yet.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._watermark = 0
+        self._gaps = IdGaps()
+        self._texts = {}
+        self._postings = defaultdict(lambda: array('q'))
+
+    def reset(self):
+        with self._lock:
+            self._loaded = False
+            self._watermark = 0
+            self._gaps = IdGaps()
+            self._texts = {}
+            self._postings = defaultdict(lambda: array('q'))
+
+    def refresh(self, session):
+        """ Loads the index on first use, afterwards only the courses above the watermark and in its gaps """
+        with self._lock:
+            horizon = self._settled_before()
+            unread = Course.id > self._watermark
+            missing = self._gaps.criterion(Course.id)
+            rows = session.query(Course.id, Course.name, Course.course_code, Course.description). \
+                filter(unread if missing is None else or_(unread, missing)).order_by(Course.id).all()
+            added = sum(self._add(course_id, name, course_code, description)
+                        for course_id, name, course_code, description in rows)
+            self._gaps.update(self._watermark, [row[0] for row in rows], horizon)
+            self._watermark = max([self._watermark] + [row[0] for row in rows])
+            if not self._loaded:
+                self._loaded = True
+                log.debug(f"Course search index loaded with {added} courses")
+
+    @staticmethod
+    def _settled_before():
+        return Database().settled_before()
+
+    def add_course(self, course_id, name, course_code, description):
+        """ Indexes a course, returns False if it was indexed already """
+        with self._lock:
+            return self._add(course_id, name, course_code, description)
+
+    def _add(self, course_id, name, course_code, description):
+        if course_id in self._texts:
+            return False
+        texts = tuple(str(value).lower() if value is not None else '' for value in (name, course_code, description))
+        self._texts[course_id] = texts
+        for field, text in enumerate(texts):
+            for trigram in trigrams(text):
+                self._postings[(field, trigram)].append(course_id)
+        return True
+
+    def search(self, text, fields=FIELDS):
+        """ The ids of the courses where any of the fields contains text, ignoring case """
+        text = text.lower()
+        field_numbers = [FIELDS.index(field) for field in fields]
+        matches = set()
+        for field in field_numbers:
+            query_trigrams = trigrams(text)
+            if query_trigrams:
+                postings = sorted((self._postings.get((field, trigram), ()) for trigram in query_trigrams), key=len)
+                candidates = set(postings[0])
+                for posting in postings[1:]:
+                    if not candidates:
+                        break
+                    candidates.intersection_update(posting)
+            else:
+                # Shorter than a trigram, every course is a candidate
+                candidates = self._texts.keys()
+            matches.update(course_id for course_id in candidates if text in self._texts[course_id][field])
+        return matches
+
+    def __len__(self):
+        return len(self._texts)
+
+
+def text_filter(text, fields=FIELDS):
+    """
+    The criterion for a text filter on the catalog: an id list from the index, or the LIKE filters when
+    the text matches too many courses for an id list to pay off.
+    """
+    ids = course_search_index.search(text, fields)
+    if len(ids) > MAX_ID_FILTER:
+        return or_(*(getattr(Course, field).like('%' + text + '%') for field in fields))
+    return Course.id.in_(sorted(ids))
+
+
+course_search_index = CourseSearchIndex()
+Database().on_configure(course_search_index.reset)
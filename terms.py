@@ -0,0 +1,220 @@
+import sys
+import threading
+import time
+import weakref
+from collections import namedtuple
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from courses import Course, CourseOffering, Section, SectionFill, SectionPreference, Term, WaitlistEntry, \
+    student_roster, instructor_roster, archived_course_offering, archived_section, archived_student_roster, \
+    archived_instructor_roster
+from persons import StudentTermLoad
+from database import Database
+from enums import Quarter, TermStatus
+from catalog_cache import catalog_cache, CatalogChange
+from prereq_graph import prereq_graph
+from waitlist import waitlists
+from logs import log
+
+db_session = Database().get_session()
+unit_of_work = Database().unit_of_work()
+
+"""
+The lifecycle of terms. A finished term is frozen first, which stops registrations, drops and lotteries for it,
+then archived: its course offerings, sections and rosters move to the archive tables in one transaction, so the
+live tables and their indexes only hold the terms in use. Archived terms are read through the read-only
+functions of this module, and prereq checks see the courses of archived rosters through the prereq_graph.
+Running this module archives the term given as `python terms.py 2023 fall`, freezing it first."""
+
+# How long other processes can take to notice that a term was frozen
+TERM_STATUS_TTL = 5.0
+# The quarters of a year in the order they are taught, Quarter's values start with fall
+QUARTER_ORDER = {Quarter.winter: 0, Quarter.spring: 1, Quarter.summer: 2, Quarter.fall: 3}
+SECTION_COLUMNS = ('id', 'course_offering_id', 'location', 'type', 'time', 'end_time', 'days', 'size_limit',
+                   'enrolled_count')
+
+ArchiveResult = namedtuple('ArchiveResult', ['offerings', 'sections', 'enrollments'])
+ArchivedSectionRecord = namedtuple('ArchivedSectionRecord', ['id', 'course_id', 'course_code', 'location', 'type',
+                                                             'time', 'end_time', 'days', 'size_limit',
+                                                             'enrolled_count', 'instructor_ids'])
+ArchivedEnrollment = namedtuple('ArchivedEnrollment', ['year', 'quarter', 'course_id', 'section_id'])
+
+
+class TermStates:
+    """
+    The status of every term that is not open, read with one query and again after ttl seconds, so that the
+    registration checks see what other processes froze. Changes made in this process show at once.
+    """
+    def __init__(self, ttl=TERM_STATUS_TTL):
+        self._lock = threading.Lock()
+        self._ttl = ttl
+        self._statuses = None
+        self._loaded_at = 0.0
+
+    def clear(self):
+        with self._lock:
+            self._statuses = None
+
+    def status(self, session, year, quarter):
+        statuses = self._statuses
+        if statuses is None or time.monotonic() - self._loaded_at > self._ttl:
+            statuses = {(term_year, term_quarter): status for term_year, term_quarter, status
+                        in session.query(Term.year, Term.quarter, Term.status)}
+            with self._lock:
+                self._statuses, self._loaded_at = statuses, time.monotonic()
+        return statuses.get((year, quarter), TermStatus.open)
+
+    def is_open(self, session, year, quarter):
+        return self.status(session, year, quarter) is TermStatus.open
+
+
+term_states = TermStates()
+Database().on_configure(term_states.clear)
+# Primary engines whose MySQL auto-increment counters were raised past the archived ids
+_reserved_engines = weakref.WeakSet()
+
+
+@event.listens_for(Engine, 'engine_connect')
+def _reserve_archived_ids(connection, branch=False):
+    """
+    MySQL before 8.0 sets the auto-increment counter of a table to its largest id on a restart, which would hand
+    the ids of archived sections and offerings out again, so the first connection of the primary raises the
+    counters past them
+    """
+    if branch or connection.dialect.name != 'mysql' or connection.engine in _reserved_engines or \
+            connection.engine is not Database().get_engine():
+        return
+    _reserved_engines.add(connection.engine)
+    for live, archive in ((Section.__table__, archived_section), (CourseOffering.__table__, archived_course_offering)):
+        try:
+            largest = connection.execute(select(func.max(archive.c.id))).scalar()
+            if largest is not None:
+                connection.exec_driver_sql(f"ALTER TABLE {live.name} AUTO_INCREMENT = {largest + 1}")
+        except DBAPIError as error:
+            log.error(f"Could not raise the ids of {live.name} past the archived ones: {error}")
+
+
+def freeze_term(year, quarter):
+    """ Stops every roster change for the term, other processes stop within TERM_STATUS_TTL seconds """
+    with unit_of_work:
+        term = db_session.query(Term).filter(Term.year == year).filter(Term.quarter == quarter).first()
+        if term is None:
+            db_session.add(Term(year=year, quarter=quarter, status=TermStatus.frozen))
+        elif term.status is TermStatus.archived:
+            raise ValueError(f"{quarter.name} {year} is archived already")
+        else:
+            term.status = TermStatus.frozen
+    term_states.clear()
+    log.debug(f"{quarter.name} {year} frozen")
+
+
+def archive_term(year, quarter):
+    """
+    Moves the course offerings, sections and rosters of a frozen term to the archive tables in one transaction,
+    along with dropping its waitlists, lottery preferences, term loads and section fill views.
+    Returns the ArchiveResult counts.
+    Raises ValueError for a term that is not frozen.
+    """
+    offering_ids = select(CourseOffering.id).where(CourseOffering.year == year). \
+        where(CourseOffering.quarter == quarter)
+    section_ids = select(Section.id).where(Section.course_offering_id.in_(offering_ids))
+    with unit_of_work as session:
+        term = session.query(Term).filter(Term.year == year).filter(Term.quarter == quarter). \
+            with_for_update().first()
+        if term is None or term.status is not TermStatus.frozen:
+            status = TermStatus.open if term is None else term.status
+            raise ValueError(f"Only frozen terms can be archived, {quarter.name} {year} is {status.name}")
+        archived_ids = [section_id for section_id, in session.execute(section_ids)]
+        offerings = session.execute(archived_course_offering.insert().from_select(
+            ['id', 'course_id', 'year', 'quarter'],
+            select(CourseOffering.id, CourseOffering.course_id, CourseOffering.year, CourseOffering.quarter).
+            where(CourseOffering.id.in_(offering_ids)))).rowcount
+        session.execute(archived_section.insert().from_select(
+            SECTION_COLUMNS, select(*[Section.__table__.c[column] for column in SECTION_COLUMNS]).
+            where(Section.course_offering_id.in_(offering_ids))))
+        enrollments = session.execute(archived_student_roster.insert().from_select(
+            ['student_id', 'section_id', 'course_id', 'year', 'quarter'],
+            select(student_roster.c.student_id, student_roster.c.section_id, CourseOffering.course_id,
+                   CourseOffering.year, CourseOffering.quarter).
+            join(Section, Section.id == student_roster.c.section_id).
+            join(CourseOffering, Section.course_offering_id == CourseOffering.id).
+            where(CourseOffering.year == year).where(CourseOffering.quarter == quarter))).rowcount
+        session.execute(archived_instructor_roster.insert().from_select(
+            ['instructor_id', 'section_id'], select(instructor_roster.c.instructor_id, instructor_roster.c.section_id).
+            where(instructor_roster.c.section_id.in_(section_ids))))
+
+        for table, column in ((WaitlistEntry.__table__, WaitlistEntry.__table__.c.section_id),
+                              (SectionFill.__table__, SectionFill.__table__.c.section_id),
+                              (SectionPreference.__table__, SectionPreference.__table__.c.section_id),
+                              (student_roster, student_roster.c.section_id),
+                              (instructor_roster, instructor_roster.c.section_id)):
+            session.execute(table.delete().where(column.in_(section_ids)))
+        session.execute(Section.__table__.delete().where(Section.__table__.c.course_offering_id.in_(offering_ids)))
+        session.execute(CourseOffering.__table__.delete().where(CourseOffering.__table__.c.year == year).
+                        where(CourseOffering.__table__.c.quarter == quarter))
+        session.execute(StudentTermLoad.__table__.delete().where(StudentTermLoad.__table__.c.year == year).
+                        where(StudentTermLoad.__table__.c.quarter == quarter))
+        term.status = TermStatus.archived
+        session.flush()
+        # Objects of the moved rows loaded before would otherwise still show up
+        session.expire_all()
+    term_states.clear()
+    waitlists.forget(archived_ids)
+    prereq_graph.forget_students()
+    catalog_cache.invalidate(CatalogChange(quarter=quarter))
+    result = ArchiveResult(offerings, len(archived_ids), enrollments)
+    log.debug(f"{quarter.name} {year} archived: {result}")
+    return result
+
+
+def archived_sections(year, quarter, session=None):
+    """ The ArchivedSectionRecords of an archived term, ordered by course code and id, read on a replica """
+    session = session or db_session
+    with Database().replica_reads():
+        rows = session.execute(select(archived_section.c.id, Course.id, Course.course_code,
+                                      archived_section.c.location, archived_section.c.type, archived_section.c.time,
+                                      archived_section.c.end_time, archived_section.c.days,
+                                      archived_section.c.size_limit, archived_section.c.enrolled_count).
+                               join(archived_course_offering,
+                                    archived_course_offering.c.id == archived_section.c.course_offering_id).
+                               join(Course, Course.id == archived_course_offering.c.course_id).
+                               where(archived_course_offering.c.year == year).
+                               where(archived_course_offering.c.quarter == quarter).
+                               order_by(Course.course_code, archived_section.c.id)).all()
+        instructors = {}
+        for instructor_id, section_id in session.execute(
+                select(archived_instructor_roster.c.instructor_id, archived_instructor_roster.c.section_id).
+                join(archived_section, archived_section.c.id == archived_instructor_roster.c.section_id).
+                join(archived_course_offering, archived_course_offering.c.id == archived_section.c.course_offering_id).
+                where(archived_course_offering.c.year == year).where(archived_course_offering.c.quarter == quarter)):
+            instructors.setdefault(section_id, []).append(instructor_id)
+    return [ArchivedSectionRecord(*row, sorted(instructors.get(row[0], []))) for row in rows]
+
+
+def archived_roster(student_id, session=None):
+    """ The ArchivedEnrollments of the student, oldest term first, read on a replica """
+    session = session or db_session
+    with Database().replica_reads():
+        rows = session.execute(select(archived_student_roster.c.year, archived_student_roster.c.quarter,
+                                      archived_student_roster.c.course_id, archived_student_roster.c.section_id).
+                               where(archived_student_roster.c.student_id == student_id)).all()
+    return sorted((ArchivedEnrollment(*row) for row in rows), key=lambda row: (row.year, QUARTER_ORDER[row.quarter],
+                                                                               row.section_id))
+
+
+def archived_students(section_id, session=None):
+    """ The ids of the students of an archived section """
+    session = session or db_session
+    with Database().replica_reads():
+        return sorted(student_id for student_id, in session.execute(
+            select(archived_student_roster.c.student_id).where(archived_student_roster.c.section_id == section_id)))
+
+
+if __name__ == '__main__':
+    archive_year, archive_quarter = int(sys.argv[1]), Quarter[sys.argv[2]]
+    if term_states.is_open(db_session, archive_year, archive_quarter):
+        freeze_term(archive_year, archive_quarter)
+        # Registrations other processes let through before they noticed the freeze commit meanwhile
+        time.sleep(TERM_STATUS_TTL)
+    archive_term(archive_year, archive_quarter)
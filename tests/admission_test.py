@@ -0,0 +1,140 @@
+import random
+import unittest
+from collections import Counter
+from persons import Student
+from database import Database
+from enums import StudentType, DegreeProgram, RegistrationStatus
+from admission import AdmissionController, TimeTickets, TokenBucket, FairQueue
+from stand_in import StandInDatabaseTestCase
+
+
+class SimulatedClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class CrowdMember:
+    def __init__(self, student_id, student_type=StudentType.full_time, degree_program=DegreeProgram.mpcs):
+        self.id = student_id
+        self.type = student_type
+        self.degree_program = degree_program
+
+
+class TestAdmissionControl(unittest.TestCase):
+    """ Time tickets, rate limits and fairness under a simulated clock """
+
+    def setUp(self) -> None:
+        self.clock = SimulatedClock()
+        self.registered = []
+
+    def _register(self, student_id, section_id):
+        self.registered.append(student_id)
+        return RegistrationStatus.enrolled
+
+    def _controller(self, **settings):
+        return AdmissionController(register=self._register, clock=self.clock, **settings)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=3, clock=self.clock)
+        self.assertEqual([bucket.try_take() for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(bucket.wait_time(), 0.1)
+        self.clock.advance(0.25)
+        self.assertEqual([bucket.try_take() for _ in range(3)], [True, True, False])
+
+    def test_fair_queue_round_robin(self):
+        queue = FairQueue(capacity=5)
+        for item in ['a1', 'a2', 'a3']:
+            self.assertTrue(queue.put('a', item))
+        for item in ['b1', 'b2']:
+            self.assertTrue(queue.put('b', item))
+        self.assertFalse(queue.put('b', 'b3'))
+        self.assertEqual([queue.get() for _ in range(6)], ['a1', 'b1', 'a2', 'b2', 'a3', None])
+
+    def test_time_tickets(self):
+        tickets = TimeTickets(default=100)
+        tickets.set(StudentType.full_time, DegreeProgram.mpcs, 10)
+        controller = self._controller(tickets=tickets)
+        early = controller.submit(CrowdMember(1, degree_program=DegreeProgram.ba), 1)
+        self.assertIs(early.result(), RegistrationStatus.not_open)
+        self.assertIs(controller.submit(CrowdMember(2), 1).result(), RegistrationStatus.not_open)
+        self.clock.advance(10)
+        on_time = controller.submit(CrowdMember(2), 1)
+        self.assertFalse(on_time.done())
+        controller.drain()
+        self.assertIs(on_time.result(), RegistrationStatus.enrolled)
+        self.assertEqual(controller.stats()['not_open'], 2)
+
+    def test_full_queue_turns_requests_away(self):
+        controller = self._controller(capacity=2)
+        futures = [controller.submit(CrowdMember(student_id), 1) for student_id in range(3)]
+        self.assertIs(futures[2].result(), RegistrationStatus.queue_full)
+        self.assertEqual(controller.stats()['depth'], 2)
+
+    def test_stats_of_students_without_a_cohort(self):
+        controller = self._controller()
+        controller.submit(CrowdMember(1, student_type=None, degree_program=None), 1)
+        controller.submit(CrowdMember(2, degree_program=None), 1)
+        self.assertEqual(controller.stats()['depths'], {'None/None': 1, 'full_time/None': 1})
+
+    def test_simulated_crowd(self):
+        """ A crowd arriving at once is drained at the bucket's rate, every cohort getting its turn """
+        controller = self._controller(rate=100, burst=10, capacity=500)
+        crowd = random.Random(3)
+        members = [CrowdMember(student_id, *crowd.choice([(StudentType.full_time, DegreeProgram.mpcs)] * 8 +
+                                                         [(StudentType.part_time, DegreeProgram.ba)]))
+                   for student_id in range(600)]
+        futures = [controller.submit(member, 1) for member in members]
+        self.assertEqual(Counter(future.result() for future in futures if future.done()),
+                         {RegistrationStatus.queue_full: 100})
+        steps = 0
+        while controller.stats()['depth']:
+            self.assertLessEqual(controller.drain(), 10)
+            self.clock.advance(0.1)
+            steps += 1
+        # Ten a step, give or take the float drift of the simulated clock
+        self.assertTrue(50 <= steps <= 52, steps)
+        stats = controller.stats()
+        self.assertEqual((stats['admitted'], stats['processed'], stats['max_depth']), (500, 500, 500))
+        self.assertAlmostEqual(stats['wait_p99_ms'], 4900, delta=150)
+        # The small cohort alternates with the large one instead of waiting behind it
+        small = [position for position, student_id in enumerate(self.registered)
+                 if members[student_id].type is StudentType.part_time]
+        self.assertLessEqual(small[-1], 2 * len(small))
+
+    def test_small_cohort_is_not_starved(self):
+        controller = self._controller(rate=1, burst=4)
+        for student_id in range(100):
+            controller.submit(CrowdMember(student_id), 1)
+        controller.submit(CrowdMember(1000, StudentType.part_time, DegreeProgram.macss), 1)
+        controller.drain()
+        self.assertEqual(self.registered, [0, 1000, 1, 2])
+        self.assertEqual(controller.stats()['depths'], {'full_time/mpcs': 97})
+
+
+class TestAdmittedRegistration(StandInDatabaseTestCase):
+    """ Worker threads drain the queue into the registration chain """
+
+    def test_workers_register_admitted_students(self):
+        section_id, = self._create_sections(1, 3, name="Admitted")
+        student_ids = self._create_students(5, "Admitted")
+        with Database().unit_of_work() as session:
+            students = [CrowdMember(student.id, student.type, student.degree_program)
+                        for student in session.query(Student).filter(Student.id.in_(student_ids))]
+        controller = AdmissionController(rate=50, burst=2).start(workers=2)
+        try:
+            futures = [controller.submit(student, section_id) for student in students]
+            statuses = Counter(future.result(timeout=30) for future in futures)
+        finally:
+            controller.stop()
+        self.assertEqual(statuses, {RegistrationStatus.enrolled: 3, RegistrationStatus.section_full: 2})
+        self.assertEqual(controller.stats()['processed'], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
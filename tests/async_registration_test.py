@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+from database import Database
+from enums import Department, RegistrationStatus
+from controllers import CourseViewer
+from course_registration import RetryingRegistration
+from async_registration import AsyncCourseViewer, AsyncRetryingRegistration
+from stand_in import StandInDatabaseTestCase
+
+
+class TestAsyncRegistration(StandInDatabaseTestCase):
+    """ Walks the same requests through the sync and the async chains on two identical catalogs """
+
+    def _catalog(self, name):
+        intro, = self._create_sections(1, 2, name=f"{name}Intro")
+        advanced, = self._create_sections(1, 30, name=f"{name}Advanced", prereqs=[self._course_of(intro)])
+        electives = [self._create_sections(1, 30, name=f"{name}Elective{i}")[0] for i in range(2)]
+        students = self._create_students(3, name)
+        held, = self._create_students(1, f"{name}Held", restriction_hold=True)
+        first, second, third = students
+        return [(first, advanced), (first, intro), (first, advanced), (first, electives[0]),
+                (first, electives[1]), (second, intro), (third, intro), (held, electives[0]), (first, -1)]
+
+    def test_async_chain_matches_sync_chain(self):
+        sync_requests = self._catalog("Sync")
+        async_requests = self._catalog("Async")
+        registration = RetryingRegistration()
+        sync_statuses = [registration.register(*request) for request in sync_requests]
+
+        async def register_all():
+            async_registration = AsyncRetryingRegistration()
+            statuses = [await async_registration.register(*request) for request in async_requests]
+            await Database().close_async_engine()
+            return statuses
+
+        self.assertEqual(asyncio.run(register_all()), sync_statuses)
+        self.assertEqual(sync_statuses,
+                         [RegistrationStatus.missing_prereq, RegistrationStatus.enrolled,
+                          RegistrationStatus.enrolled, RegistrationStatus.enrolled,
+                          RegistrationStatus.course_limit, RegistrationStatus.enrolled,
+                          RegistrationStatus.section_full, RegistrationStatus.restriction_hold,
+                          RegistrationStatus.not_found])
+
+    def test_async_viewer_matches_sync_viewer(self):
+        intro, = self._create_sections(1, 30, name="ViewedIntro")
+        self._create_sections(2, 30, name="Viewed", prereqs=[self._course_of(intro)])
+        filters = {'name': f"Viewed {self.tag}", 'dept': Department.mpcs}
+        with Database().unit_of_work():
+            sync_rows = [(row.Course.id, row.Section.id) for row in CourseViewer().view_courses(**filters)]
+
+        async def view():
+            rows = await AsyncCourseViewer().view_courses(**filters)
+            await Database().close_async_engine()
+            return rows
+
+        rows = asyncio.run(view())
+        self.assertEqual(len(sync_rows), 2)
+        self.assertEqual(sorted((row.Course.id, row.Section.id) for row in rows), sorted(sync_rows))
+        # The relationships were loaded before the session closed
+        for course, offering, section in rows:
+            self.assertEqual([prereq.id for prereq in course.prereqs], [self._course_of(intro).id])
+            self.assertEqual(len(offering.sections), 2)
+            self.assertEqual(len(section.instructor), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+from persons import Student, Instructor, Advisor
+from controllers import bulk_get_or_create, get_or_create, person_ids, _counting_statements
+from database import Database
+from enums import Department, DegreeProgram, StudentType
+from stand_in import StandInDatabaseTestCase
+
+
+class TestBulkGetOrCreate(StandInDatabaseTestCase):
+    """ bulk_get_or_create resolves batches of persons with a constant number of statements """
+
+    def _students(self, count, first_name, preferred_name=""):
+        return [{'first_name': first_name, 'last_name': f"Bulk{i}", 'preferred_name': preferred_name or self.tag,
+                 'department': Department.mpcs, 'type': StudentType.full_time,
+                 'degree_program': DegreeProgram.mpcs} for i in range(count)]
+
+    def test_instances_in_input_order(self):
+        session = Database().get_session()
+        existing = get_or_create(session, Student, first_name="BulkOrder", last_name="Bulk1",
+                                 preferred_name=self.tag, department=Department.mpcs)
+        rows = self._students(3, "BulkOrder")
+        students = bulk_get_or_create(session, Student, [rows[2], rows[1], rows[0], rows[2]])
+        self.assertEqual([student.last_name for student in students], ["Bulk2", "Bulk1", "Bulk0", "Bulk2"])
+        self.assertIs(students[0], students[3])
+        self.assertEqual(students[1].id, existing.id)
+        self.assertEqual(students[0].degree_program, DegreeProgram.mpcs)
+        self.assertFalse(students[0].restriction_hold)
+        self.assertEqual(session.query(Student).filter(Student.first_name == "BulkOrder").count(), 3)
+
+    def test_constant_statements_per_batch(self):
+        session = Database().get_session()
+        counts = {}
+        statements = []
+        for count in (5, 200):
+            person_ids.clear()
+            with _counting_statements(session, counts):
+                bulk_get_or_create(session, Student, self._students(count, f"BulkCount{count}"))
+            statements.append(counts['statements'])
+        self.assertEqual(statements[0], statements[1])
+
+        with _counting_statements(session, counts):
+            students = bulk_get_or_create(session, Student, self._students(200, "BulkCount200"))
+        self.assertEqual(counts['statements'], 1)
+        self.assertEqual(len({student.id for student in students}), 200)
+
+    def test_null_keys_are_not_duplicated(self):
+        session = Database().get_session()
+        rows = [{'first_name': "BulkNull", 'last_name': self.tag, 'preferred_name': None,
+                 'department': Department.mpcs}]
+        first, = bulk_get_or_create(session, Instructor, rows)
+        person_ids.clear()
+        again, = bulk_get_or_create(session, Instructor, rows)
+        self.assertEqual(first.id, again.id)
+        self.assertEqual(session.query(Instructor).filter(Instructor.first_name == "BulkNull").count(), 1)
+
+    def test_stale_cache_entries_are_resolved_again(self):
+        session = Database().get_session()
+        rows = [{'first_name': "BulkStale", 'last_name': self.tag, 'preferred_name': "Stale",
+                 'department': Department.mpcs}]
+        advisor, = bulk_get_or_create(session, Advisor, rows)
+        session.delete(advisor)
+        session.commit()
+        replaced, = bulk_get_or_create(session, Advisor, rows)
+        self.assertEqual(replaced.first_name, "BulkStale")
+        self.assertEqual(session.query(Advisor).filter(Advisor.first_name == "BulkStale").count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+from sqlalchemy import event
+from courses import Section
+from persons import Student
+from database import Database
+from enums import RegistrationStatus
+from course_registration import RetryingRegistration, CourseRegModification
+from cart import Cart
+from stand_in import StandInDatabaseTestCase
+
+
+class TestCartCheckout(StandInDatabaseTestCase):
+    """ Carts of adds and drops are applied together or not at all """
+
+    def setUp(self) -> None:
+        self.registration = RetryingRegistration()
+
+    def _roster(self, student_id):
+        with Database().unit_of_work() as session:
+            return sorted(section.id for section in session.query(Student).get(student_id).enrolled_courses)
+
+    def _enrolled_count(self, section_id):
+        with Database().unit_of_work() as session:
+            return session.query(Section.enrolled_count).filter(Section.id == section_id).scalar()
+
+    def test_swap_keeps_the_seat_until_the_add_succeeds(self):
+        held, = self._create_sections(1, 1, name="SwapHeld")
+        wanted, = self._create_sections(1, 1, name="SwapWanted")
+        student_id, rival_id = self._create_students(2, "Swapper")
+        self.assertEqual(self.registration.register(student_id, held), RegistrationStatus.enrolled)
+        self.assertEqual(self.registration.register(rival_id, wanted), RegistrationStatus.enrolled)
+
+        with Database().unit_of_work() as session:
+            result = CourseRegModification(session.query(Student).get(student_id)). \
+                swap_course(session.query(Section).get(wanted), session.query(Section).get(held))
+        self.assertFalse(result.committed)
+        self.assertEqual(result.rejected, {wanted: RegistrationStatus.section_full})
+        self.assertEqual(self._roster(student_id), [held])
+        self.assertEqual(self._enrolled_count(held), 1)
+
+        self.assertTrue(Cart(rival_id).drop(wanted).checkout().committed)
+        with Database().unit_of_work() as session:
+            result = CourseRegModification(session.query(Student).get(student_id)). \
+                swap_course(session.query(Section).get(wanted), session.query(Section).get(held))
+        self.assertEqual((result.committed, result.added, result.dropped), (True, [wanted], [held]))
+        self.assertEqual(self._roster(student_id), [wanted])
+        self.assertEqual((self._enrolled_count(held), self._enrolled_count(wanted)), (0, 1))
+
+    def test_drops_make_room_under_the_course_limit(self):
+        sections = self._create_sections(4, 5, name="CartLimit")
+        student_id, = self._create_students(1, "CartLimit")
+        self.assertTrue(Cart(student_id).add(sections[0]).add(sections[1]).add(sections[2]).checkout().committed)
+        self.assertEqual(Cart(student_id).add(sections[3]).checkout().rejected,
+                         {sections[3]: RegistrationStatus.course_limit})
+        result = Cart(student_id).drop(sections[0]).add(sections[3]).checkout()
+        self.assertTrue(result.committed)
+        self.assertEqual(self._roster(student_id), sorted(sections[1:]))
+
+    def test_one_bad_line_rejects_the_cart(self):
+        sections = self._create_sections(2, 5, name="CartBad")
+        held_student, = self._create_students(1, "CartHeld", restriction_hold=True)
+        student_id, = self._create_students(1, "CartBad")
+        result = Cart(student_id).add(sections[0]).drop(sections[1]).checkout()
+        self.assertEqual(result.rejected, {sections[1]: RegistrationStatus.not_enrolled})
+        self.assertEqual(Cart(held_student).add(sections[0]).checkout().rejected,
+                         {sections[0]: RegistrationStatus.restriction_hold})
+        self.assertEqual(self._roster(student_id), [])
+        self.assertEqual(self._enrolled_count(sections[0]), 0)
+
+    def test_round_trips_do_not_grow_with_the_cart(self):
+        sections = self._create_sections(6, 5, name="CartTrips")
+        first, second = self._create_students(2, "CartTrips")
+        for student_id, cart_sections in ((first, sections[:3]), (second, sections[3:])):
+            self.assertTrue(Cart(student_id).add(cart_sections[0]).checkout().committed)
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        engine = Database().get_engine()
+        counts = []
+        for student_id, cart_sections in ((first, sections[:3]), (second, sections[3:])):
+            cart = Cart(student_id).drop(cart_sections[0]).add(cart_sections[1])
+            if student_id == second:
+                cart.add(cart_sections[2])
+            event.listen(engine, 'before_cursor_execute', count)
+            try:
+                self.assertTrue(cart.checkout().committed)
+            finally:
+                event.remove(engine, 'before_cursor_execute', count)
+            counts.append(len(statements))
+            statements.clear()
+        self.assertEqual(counts[0], counts[1])
+
+    def test_dropped_seat_goes_to_the_waitlist(self):
+        section_id, = self._create_sections(1, 1, name="CartWaitlist")
+        holder, waiting = self._create_students(2, "CartWaitlist")
+        self.assertEqual(self.registration.register(holder, section_id), RegistrationStatus.enrolled)
+        self.assertEqual(self.registration.register(waiting, section_id, waitlist=True),
+                         RegistrationStatus.waitlisted)
+        self.assertTrue(Cart(holder).drop(section_id).checkout().committed)
+        self.assertEqual(self._roster(waiting), [section_id])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import time
+import unittest
+from database import Database
+from controllers import CourseBuilder, CourseViewer, get_or_create
+from catalog_cache import CatalogCache, CatalogChange, catalog_cache, catalog_key
+from enums import Department, Quarter, SectionType
+from persons import Instructor
+from stand_in import StandInDatabaseTestCase
+
+
+class TestCatalogCache(unittest.TestCase):
+    """ Eviction, expiry and invalidation of the cache on its own """
+
+    def test_least_recently_used_is_evicted(self):
+        cache = CatalogCache(max_entries=2)
+        for dept in (Department.mpcs, Department.cmsc):
+            cache.get_or_load(catalog_key(dept=dept), lambda: (dept,))
+        cache.get_or_load(catalog_key(dept=Department.mpcs), lambda: ())
+        cache.get_or_load(catalog_key(dept=Department.busn), lambda: ())
+        self.assertEqual(cache.get_or_load(catalog_key(dept=Department.mpcs), lambda: ()), (Department.mpcs,))
+        self.assertEqual(cache.snapshot()['evictions'], 1)
+        self.assertEqual(cache.snapshot()['hits'], 2)
+
+    def test_entries_expire(self):
+        cache = CatalogCache(ttl=0.01)
+        cache.get_or_load(catalog_key(), lambda: (1,))
+        time.sleep(0.02)
+        self.assertEqual(cache.get_or_load(catalog_key(), lambda: (2,)), (2,))
+        self.assertEqual(cache.snapshot()['misses'], 2)
+
+    def test_memory_ceiling(self):
+        cache = CatalogCache(max_bytes=1)
+        cache.get_or_load(catalog_key(), lambda: ())
+        self.assertEqual(len(cache), 0)
+
+    def test_keys_are_normalized(self):
+        self.assertEqual(catalog_key(name="OOP", course_code=51210), catalog_key(name="oop", course_code="51210"))
+
+    def test_invalidation_is_limited_to_matching_filters(self):
+        cache = CatalogCache()
+        keys = [catalog_key(dept=Department.mpcs), catalog_key(dept=Department.cmsc),
+                catalog_key(name="objects", quarter=Quarter.fall), catalog_key(quarter=Quarter.spring),
+                catalog_key(keyword="patterns"), catalog_key()]
+        for key in keys:
+            cache.get_or_load(key, lambda: ())
+        cache.invalidate(CatalogChange("Advanced Objects", "MPCS51211", "Design patterns", Department.mpcs,
+                                       Quarter.fall, SectionType.lecture, ()))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.snapshot()['invalidations'], 4)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_load_overlapping_an_invalidation_is_not_stored(self):
+        cache = CatalogCache()
+
+        def load():
+            cache.invalidate()
+            return ()
+
+        cache.get_or_load(catalog_key(), load)
+        self.assertEqual(len(cache), 0)
+
+
+class TestCourseViewerCache(StandInDatabaseTestCase):
+    """ CourseViewer.view_catalog against the writes of the CourseBuilder """
+
+    def setUp(self) -> None:
+        catalog_cache.reset()
+
+    def test_catalog_rows_are_detached_records(self):
+        section_id, = self._create_sections(1, 30, name="Detached")
+        with Database().unit_of_work():
+            row, = CourseViewer().view_catalog(name=f"Detached {self.tag}")
+        self.assertEqual(row.Section.id, section_id)
+        with self.assertRaises(AttributeError):
+            row.Course.name = "Renamed"
+        with Database().unit_of_work():
+            self.assertIs(CourseViewer().view_catalog(name=f"Detached {self.tag}")[0], row)
+        self.assertEqual(catalog_cache.snapshot()['hits'], 1)
+
+    def test_builder_writes_invalidate(self):
+        self._create_sections(1, 30, name="Growing")
+        filters = {'name': "Growing", 'quarter': Quarter.fall}
+        unrelated = {'name': "Unrelated"}
+        with Database().unit_of_work():
+            self.assertEqual(len(CourseViewer().view_catalog(**filters)), 1)
+            CourseViewer().view_catalog(**unrelated)
+        section_id, = self._create_sections(1, 30, name="Growing Again")
+        self.assertEqual(catalog_cache.snapshot()['invalidations'], 1)
+        with Database().unit_of_work():
+            self.assertEqual(len(CourseViewer().view_catalog(**filters)), 2)
+
+        instructor = get_or_create(Database().get_session(), Instructor, first_name="Ada", last_name=self.tag,
+                                   preferred_name="Ada", department=Department.mpcs)
+        with Database().unit_of_work():
+            self.assertEqual(CourseViewer().view_catalog(instructor=instructor), ())
+        CourseBuilder.assign_instructors(section_id, [instructor])
+        with Database().unit_of_work():
+            row, = CourseViewer().view_catalog(instructor=instructor)
+        self.assertEqual(row.Section.instructor_ids, (instructor.id,))
+
+    def test_rolled_back_build_is_not_kept(self):
+        self._create_sections(1, 30, name="Base")
+        name = f"TestCourseViewerCache %s {self.tag}"
+        filters = {'dept': Department.mpcs, 'quarter': Quarter.spring}
+        instructor = get_or_create(Database().get_session(), Instructor, first_name="Mark", last_name="Shacklette",
+                                   preferred_name="Mark", department=Department.mpcs)
+        with self.assertRaises(RuntimeError):
+            with Database().unit_of_work():
+                CourseBuilder().create_new_course(name % "Phantom", "Rolled back", f"P{self.tag}", Department.mpcs,
+                                                  []). \
+                    create_new_course_offering(2023, Quarter.spring). \
+                    create_new_section("Ryerson 277", [instructor], SectionType.lecture, "16:30")
+                # Read inside the transaction, with its rows
+                self.assertIn(name % "Phantom", {row.Course.name for row in CourseViewer().view_catalog(**filters)})
+                raise RuntimeError("abandoned")
+        with Database().unit_of_work():
+            self.assertNotIn(name % "Phantom", {row.Course.name for row in CourseViewer().view_catalog(**filters)})
+            self.assertEqual(CourseViewer().view_catalog(**filters), CourseViewer().view_course_records(**filters))
+
+
+if __name__ == '__main__':
+    unittest.main()
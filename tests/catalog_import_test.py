@@ -0,0 +1,86 @@
+import csv
+import json
+import os
+import tempfile
+import unittest
+from datetime import time as time_of_day
+from courses import Course, CourseOffering, Section
+from persons import Instructor
+from controllers import get_or_create
+from database import Database
+from enums import Department
+from catalog_import import CatalogImporter
+from prereq_graph import prereq_graph
+from stand_in import StandInDatabaseTestCase
+
+FIELDS = ['course_code', 'name', 'description', 'department', 'prereqs', 'year', 'quarter', 'location', 'type',
+          'time', 'size_limit', 'instructors']
+
+
+class TestCatalogImport(StandInDatabaseTestCase):
+    """ Imports small CSV and JSONL catalogs in chunks smaller than the files """
+
+    def setUp(self) -> None:
+        get_or_create(Database().get_session(), Instructor, first_name="Mark", last_name="Shacklette",
+                      preferred_name="Mark", department=Department.mpcs)
+        self.paths = []
+
+    def tearDown(self) -> None:
+        for path in self.paths:
+            os.remove(path)
+
+    def _write(self, suffix, rows):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, 'w', newline='') as file:
+            if suffix == '.csv':
+                writer = csv.DictWriter(file, FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                file.writelines(json.dumps(row) + '\n' for row in rows)
+        self.paths.append(path)
+        return path
+
+    def _row(self, code, location, prereqs="", instructors="Mark Shacklette", name=None):
+        return {'course_code': f"{code}{self.tag}", 'name': name or f"Imported {code} {self.tag}",
+                'description': "Imported", 'department': 'mpcs', 'prereqs': prereqs, 'year': 2024,
+                'quarter': 'winter', 'location': location, 'type': 'lecture', 'time': '17:30', 'size_limit': 25,
+                'instructors': instructors}
+
+    def test_import_csv_then_jsonl(self):
+        rows = [self._row("A", "Ryerson 251"), self._row("A", "Ryerson 276"),
+                self._row("B", "Ryerson 251", prereqs=f"A{self.tag}"),
+                self._row("C", "Ryerson 251", prereqs=f"A{self.tag};Z{self.tag}", instructors="Nobody Here"),
+                self._row("D", "Ryerson 251", name=f"Imported A {self.tag}"),
+                self._row("A", "Ryerson 251"), {'course_code': "bad"}]
+        report = CatalogImporter(chunk_size=2, commit_interval=3).import_files([self._write('.csv', rows)])
+        self.assertEqual(report.rows, 7)
+        self.assertEqual((report.courses, report.offerings, report.sections), (3, 3, 4))
+        # course D reuses the name of course A and the last A section is listed twice
+        self.assertEqual(report.duplicates, 2)
+        # the unknown prereq Z, the unknown instructor and the bad row
+        self.assertEqual(report.errors, 3)
+
+        db_session = Database().get_session()
+        course_b = db_session.query(Course).filter(Course.course_code == f"B{self.tag}").one()
+        course_c = db_session.query(Course).filter(Course.course_code == f"C{self.tag}").one()
+        self.assertEqual([prereq.course_code for prereq in course_c.prereqs], [f"A{self.tag}"])
+        self.assertEqual([prereq.course_code for prereq in course_b.prereqs], [f"A{self.tag}"])
+        sections = db_session.query(Section).join(CourseOffering). \
+            filter(CourseOffering.course_id == course_b.id).all()
+        self.assertEqual([(section.time, section.size_limit) for section in sections], [(time_of_day(17, 30), 25)])
+        self.assertEqual([instructor.last_name for instructor in sections[0].instructor], ["Shacklette"])
+        db_session.commit()
+
+        more = [self._row("A", "Ryerson 277"), self._row("E", "Ryerson 251", prereqs=f"B{self.tag}")]
+        report = CatalogImporter().import_files([self._write('.jsonl', more)])
+        self.assertEqual((report.courses, report.offerings, report.sections, report.duplicates), (1, 1, 2, 0))
+        with Database().unit_of_work() as session:
+            course_e = session.query(Course).filter(Course.course_code == f"E{self.tag}").one()
+            course_a = session.query(Course).filter(Course.course_code == f"A{self.tag}").one()
+            self.assertFalse(prereq_graph.has_prereqs(session, -1, course_e.id))
+            self.assertIn(course_a.id, prereq_graph.closure(course_e.id))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func
+from courses import Section, student_roster
+from database import Database
+from enums import RegistrationStatus
+from course_registration import RetryingRegistration, contention_stats
+from stand_in import StandInDatabaseTestCase
+
+
+class TestConcurrentRegistration(StandInDatabaseTestCase):
+    """ Registers students from a growing number of threads and measures the throughput """
+    THREAD_COUNTS = (1, 2, 4, 8)
+    POOL_SIZE = max(THREAD_COUNTS)
+    STUDENTS_PER_RUN = 40
+    SECTIONS = 4
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.throughput = {}
+        cls.section_ids = cls._create_sections(cls.SECTIONS, len(cls.THREAD_COUNTS) * cls.STUDENTS_PER_RUN)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        print("registrations/s by thread count: " +
+              ", ".join(f"{threads}: {rate:.0f}" for threads, rate in sorted(cls.throughput.items())))
+        super().tearDownClass()
+
+    def test_registration_throughput_by_thread_count(self):
+        db_session = Database().get_session()
+        for threads in self.THREAD_COUNTS:
+            student_ids = self._create_students(self.STUDENTS_PER_RUN, f"Thread{threads}")
+            requests = [(student_id, self.section_ids[(i + offset) % self.SECTIONS])
+                        for i, student_id in enumerate(student_ids) for offset in (0, 1)]
+            registration = RetryingRegistration()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                statuses = list(pool.map(lambda request: registration.register(*request), requests))
+            self.throughput[threads] = len(requests) / (time.perf_counter() - started)
+            self.assertEqual(statuses, [RegistrationStatus.enrolled] * len(requests))
+
+        roster_count = db_session.query(func.count()).select_from(student_roster). \
+            filter(student_roster.c.section_id.in_(self.section_ids)).scalar()
+        counted = db_session.query(func.sum(Section.enrolled_count)).filter(Section.id.in_(self.section_ids)).scalar()
+        self.assertEqual(roster_count, len(self.THREAD_COUNTS) * self.STUDENTS_PER_RUN * 2)
+        self.assertEqual(counted, roster_count)
+
+
+class TestLastSeatsStress(StandInDatabaseTestCase):
+    """
+    Fires thousands of parallel requests at a single 30 seat section, exactly 30 of them may succeed.
+    REGIE_STRESS_REQUESTS and REGIE_STRESS_THREADS scale the crowd.
+    """
+    SEATS = 30
+    REQUESTS = int(os.environ.get('REGIE_STRESS_REQUESTS', 2000))
+    POOL_SIZE = int(os.environ.get('REGIE_STRESS_THREADS', 16))
+
+    def test_section_is_never_oversold(self):
+        section_id, = self._create_sections(1, self.SEATS)
+        student_ids = self._create_students(self.REQUESTS, "Crowd")
+        registration = RetryingRegistration()
+        contention_stats.reset()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.POOL_SIZE) as pool:
+            statuses = list(pool.map(lambda student_id: registration.register(student_id, section_id), student_ids))
+        elapsed = time.perf_counter() - started
+        stats = contention_stats.snapshot()
+        print(f"{self.REQUESTS} requests in {elapsed:.1f}s ({self.REQUESTS / elapsed:.0f}/s), "
+              f"{stats['conflicts']} seat conflicts, {stats['retries']} retries")
+
+        db_session = Database().get_session()
+        roster_count = db_session.query(func.count()).select_from(student_roster). \
+            filter(student_roster.c.section_id == section_id).scalar()
+        self.assertEqual(statuses.count(RegistrationStatus.enrolled), self.SEATS)
+        self.assertEqual(statuses.count(RegistrationStatus.section_full), self.REQUESTS - self.SEATS)
+        self.assertEqual(roster_count, self.SEATS)
+        self.assertEqual(db_session.query(Section.enrolled_count).filter(Section.id == section_id).scalar(),
+                         self.SEATS)
+
+
+if __name__ == '__main__':
+    unittest.main()
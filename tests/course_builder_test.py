@@ -0,0 +1,26 @@
+import unittest
+from courses import Course
+from database import Database
+from enums import Department
+from controllers import CourseBuilder
+from stand_in import StandInDatabaseTestCase
+
+
+class TestCourseBuilder(StandInDatabaseTestCase):
+    """ Failed steps of the builder are logged and leave the caller's unit of work usable """
+
+    def test_duplicate_in_an_outer_unit_of_work(self):
+        code = f"B{self.tag}"
+        with Database().unit_of_work() as session:
+            first = CourseBuilder().create_new_course(f"Builder {self.tag}", "First", code, Department.mpcs, [])
+            duplicate = CourseBuilder().create_new_course(f"Builder again {self.tag}", "Second", code,
+                                                          Department.mpcs, [])
+            self.assertIsNone(duplicate.course_id)
+            # The outer transaction goes on and commits the first course
+            self.assertEqual(session.query(Course).filter(Course.course_code == code).count(), 1)
+        self.assertEqual(Database().get_session().query(Course.id).filter(Course.course_code == code).scalar(),
+                         first.course_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import unittest
+from sqlalchemy import event
+from courses import Course, Section
+from database import Database
+from enums import Department
+from persons import Instructor, Student
+from controllers import CourseViewer, CourseBuilder, get_or_create
+from course_registration import RetryingRegistration
+from catalog_cache import CatalogRow
+from stand_in import StandInDatabaseTestCase
+
+
+class TestCourseViewerQueries(StandInDatabaseTestCase):
+    """ Catalog reads run the same number of queries however many rows they return """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.small = cls._create_sections(1, 10, name="ViewerSmall")
+        cls.large = cls._create_sections(6, 10, name="ViewerLarge")
+        prereq = cls._course_of(cls.small[0])
+        cls._create_sections(2, 10, name="ViewerWithPrereq", prereqs=[prereq])
+
+    def _statements(self, work):
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        engine = Database().get_engine()
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            work()
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        return len(statements)
+
+    def test_records_use_a_fixed_number_of_queries(self):
+        viewer = CourseViewer()
+        counts = []
+        for name in ("ViewerSmall", "ViewerLarge", "Viewer"):
+            with Database().unit_of_work():
+                records = viewer.view_course_records(course_code=None, dept=Department.mpcs, name=name)
+            self.assertTrue(all(isinstance(record, CatalogRow) for record in records))
+            counts.append(viewer.query_count)
+        self.assertEqual(len(set(counts)), 1)
+        self.assertLessEqual(counts[0], 4)
+
+    def test_records_match_view_courses(self):
+        with Database().unit_of_work() as session:
+            rows = CourseViewer().view_courses(name=f"ViewerWithPrereq {self.tag}")
+            expected = {(course.course_code, offering.id, section.id, tuple(prereq.id for prereq in course.prereqs),
+                         tuple(instructor.id for instructor in section.instructor))
+                        for course, offering, section in rows}
+            session.expunge_all()
+            records = CourseViewer().view_course_records(name=f"ViewerWithPrereq {self.tag}")
+            self.assertFalse([entity for entity in session.identity_map.values()
+                              if isinstance(entity, (Course, Section))])
+        self.assertEqual({(record.Course.course_code, record.CourseOffering.id, record.Section.id,
+                           record.Course.prereq_ids, record.Section.instructor_ids) for record in records}, expected)
+        self.assertEqual(len(expected), 2)
+        self.assertIs(records[0].Course, records[1].Course)
+
+    def test_rendering_view_courses_runs_no_lazy_loads(self):
+        def render(name):
+            with Database().unit_of_work():
+                for course, offering, section in CourseViewer().view_courses(name=name):
+                    [prereq.name for prereq in course.prereqs]
+                    [instructor.first_name for instructor in section.instructor]
+                    [other.id for other in offering.sections]
+
+        self.assertEqual(self._statements(lambda: render("ViewerSmall")),
+                         self._statements(lambda: render("ViewerLarge")))
+
+
+
+class TestCatalogPages(StandInDatabaseTestCase):
+    """ Keyset pages and streams walk the same rows as a full read """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.first = cls._create_sections(3, 10, name="PagedFirst")
+        prereq = cls._course_of(cls.first[0])
+        cls.second = cls._create_sections(4, 10, name="PagedSecond", prereqs=[prereq])
+        db_session = Database().get_session()
+        co_teacher = get_or_create(db_session, Instructor, first_name="Borja", last_name="Sotomayor",
+                                   preferred_name="Borja", department=Department.mpcs)
+        mark = db_session.query(Instructor).filter(Instructor.first_name == "Mark").first()
+        CourseBuilder.assign_instructors(cls.second[0], [mark, co_teacher])
+        cls.instructor_ids = tuple(sorted((mark.id, co_teacher.id)))
+        # Sorts first, with a page boundary among its sections
+        uncoded = cls._course_of(cls._create_sections(4, 10, name="PagedUncoded")[0])
+        db_session.query(Course).filter(Course.id == uncoded.id).update({Course.course_code: None})
+        db_session.commit()
+
+    def _all(self):
+        with Database().unit_of_work():
+            return sorted(CourseViewer().view_course_records(name="Paged"),
+                          key=lambda record: (record.Course.course_code or '', record.Section.id))
+
+    def test_pages_follow_the_cursor(self):
+        pages = []
+        cursor = None
+        while True:
+            with Database().unit_of_work():
+                page = CourseViewer().view_courses_page(cursor=cursor, limit=3, name="Paged")
+            pages.append(page.rows)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual([len(rows) for rows in pages], [3, 3, 3, 2])
+        self.assertEqual([record for rows in pages for record in rows], self._all())
+        with self.assertRaises(ValueError):
+            CourseViewer().view_courses_page(cursor="not a cursor")
+
+    def test_stream_matches_full_read(self):
+        with Database().unit_of_work():
+            streamed = list(CourseViewer().iter_courses(chunk_size=2, name="Paged"))
+        self.assertEqual(streamed, self._all())
+        co_taught, = [record for record in streamed if record.Section.id == self.second[0]]
+        self.assertEqual(co_taught.Section.instructor_ids, self.instructor_ids)
+        self.assertEqual(co_taught.Course.prereq_ids, (self._course_of(self.first[0]).id,))
+
+    def test_roster_pages_and_stream(self):
+        student_id, = self._create_students(1, "Paged")
+        registration = RetryingRegistration()
+        for section_id in (self.first[1], self.second[2]):
+            registration.register(student_id, section_id)
+        with Database().unit_of_work() as session:
+            student = session.query(Student).get(student_id)
+            first_page = CourseViewer().view_roster_page(student, limit=1)
+            second_page = CourseViewer().view_roster_page(student, cursor=first_page.next_cursor, limit=1)
+            streamed = list(CourseViewer().iter_roster(student))
+        self.assertIsNone(second_page.next_cursor)
+        self.assertEqual([record.Section.id for record in first_page.rows + second_page.rows],
+                         [record.Section.id for record in streamed])
+        self.assertEqual(sorted(record.Section.id for record in streamed), sorted((self.first[1], self.second[2])))
+
+
+if __name__ == '__main__':
+    unittest.main()
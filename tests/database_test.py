@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta, time as time_of_day
+from courses import Section
+from persons import Student, Instructor, student_key
+from database import Database, IdGaps, environment_settings, PROFILES
+from enums import Quarter, Department, StudentType, DegreeProgram, SectionType, RegistrationStatus
+from controllers import CourseBuilder, CourseViewer, get_or_create
+from course_registration import RetryingRegistration
+from catalog_cache import CATALOG_KEY
+
+
+class TestEngineProfiles(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.previous_settings = Database().get_settings()
+
+    def tearDown(self) -> None:
+        Database().configure(**self.previous_settings)
+
+    def test_environment_picks_the_profile_and_overrides(self):
+        self.assertEqual(environment_settings({}), PROFILES['development'])
+        settings = environment_settings({'REGIE_DB_PROFILE': 'production', 'REGIE_DB_URL': 'sqlite://',
+                                         'REGIE_DB_ECHO': 'true', 'REGIE_DB_POOL_SIZE': '3'})
+        self.assertEqual(settings, dict(PROFILES['production'], url='sqlite://', echo=True, pool_size=3))
+
+    def test_engine_is_created_on_first_use(self):
+        Database().configure(profile='test')
+        self.assertIsNone(Database()._engine)
+        self.assertEqual(Database().get_session().execute("select 1").scalar(), 1)
+        self.assertEqual(str(Database().get_engine().url), 'sqlite://')
+        Database().get_session().remove()
+
+    def test_environment_lists_replicas(self):
+        settings = environment_settings({'REGIE_DB_REPLICA_URLS': 'sqlite:///a.db,sqlite:///b.db',
+                                         'REGIE_DB_STICKY_SECONDS': '2.5'})
+        self.assertEqual((settings['replica_urls'], settings['sticky_seconds']),
+                         (('sqlite:///a.db', 'sqlite:///b.db'), 2.5))
+
+
+class TestReplicaRouting(unittest.TestCase):
+    """ Reads go to a replica SQLite file that only sees the primary's rows once they are copied over """
+
+    def setUp(self) -> None:
+        self.previous_settings = Database().get_settings()
+        self.files = []
+        for _ in range(2):
+            handle, path = tempfile.mkstemp(suffix='.db')
+            os.close(handle)
+            self.files.append(path)
+        self.primary, self.replica = self.files
+        self._configure(sticky_seconds=60)
+        Database().get_base().metadata.create_all(bind=Database().get_engine())
+        Database().get_base().metadata.create_all(bind=Database().get_replica_engine())
+
+    def tearDown(self) -> None:
+        Database().configure(**self.previous_settings)
+        for path in self.files:
+            os.remove(path)
+
+    def _configure(self, sticky_seconds):
+        Database().configure(url='sqlite:///' + self.primary, replica_urls=('sqlite:///' + self.replica,),
+                             sticky_seconds=sticky_seconds, echo=False, pool_size=2, max_overflow=0)
+
+    def _replicate(self):
+        with sqlite3.connect(self.primary) as source, sqlite3.connect(self.replica) as target:
+            source.backup(target)
+
+    def _create_section(self):
+        db_session = Database().get_session()
+        instructor = get_or_create(db_session, Instructor, first_name="Mark", last_name="Shacklette",
+                                   preferred_name="Mark", department=Department.mpcs)
+        builder = CourseBuilder().create_new_course("Replicated Systems", "Lag", "R1", Department.mpcs, []). \
+            create_new_course_offering(2023, Quarter.fall). \
+            create_new_section("Ryerson 277", [instructor], SectionType.lecture, time_of_day(9))
+        section_id = db_session.query(Section.id).filter(Section.course_offering_id == builder.course_offering_id). \
+            scalar()
+        student = Student(first_name="Lagging", last_name="Reader", preferred_name="R", type=StudentType.full_time,
+                          degree_program=DegreeProgram.mpcs, department=Department.mpcs)
+        db_session.add(student)
+        db_session.commit()
+        return section_id, student.id
+
+    def _catalog(self):
+        with Database().unit_of_work():
+            return CourseViewer().view_course_records(course_code="R1")
+
+    def test_catalog_reads_lag_until_replicated(self):
+        self._configure(sticky_seconds=0)
+        self._create_section()
+        self.assertEqual(self._catalog(), ())
+        self._replicate()
+        self.assertEqual([row.Course.course_code for row in self._catalog()], ["R1"])
+
+    def test_reads_stick_to_the_primary_after_writes(self):
+        section_id, student_id = self._create_section()
+        self.assertTrue(Database().is_sticky(CATALOG_KEY))
+        self.assertEqual(len(self._catalog()), 1)
+
+        self._replicate()
+        self.assertFalse(Database().is_sticky(student_key(student_id)))
+        self.assertEqual(RetryingRegistration().register(student_id, section_id), RegistrationStatus.enrolled)
+        self.assertTrue(Database().is_sticky(student_key(student_id)))
+        with Database().unit_of_work() as session:
+            student = session.query(Student).get(student_id)
+            self.assertEqual([section.id for _, _, section in CourseViewer().view_roster(student)], [section_id])
+
+    def test_writes_in_replica_reads_go_to_the_primary(self):
+        with Database().unit_of_work() as session:
+            with Database().replica_reads():
+                session.add(Student(first_name="Written", last_name="Primary", preferred_name="W",
+                                    type=StudentType.part_time, degree_program=DegreeProgram.ba,
+                                    department=Department.mpcs))
+                session.flush()
+                self.assertEqual(session.query(Student).filter(Student.first_name == "Written").count(), 0)
+        counts = []
+        for path in self.files:
+            with sqlite3.connect(path) as connection:
+                counts.append(connection.execute("select count(*) from student").fetchone()[0])
+        self.assertEqual(counts, [1, 0])
+
+
+class TestIdGaps(unittest.TestCase):
+    """ Skipped ids are kept until they turn up or every transaction open when they were skipped has ended """
+
+    def test_gaps_shrink_and_settle(self):
+        gaps = IdGaps()
+        start = datetime(2024, 9, 1)
+        gaps.update(0, [2, 5, 6], (start, start))
+        self.assertEqual(len(gaps), 2)
+        gaps.update(6, [3], (start, start + timedelta(seconds=1)))
+        self.assertEqual(len(gaps), 2)
+        # Stamped with the time read before that catch-up, a transaction open since may still commit
+        gaps.update(6, [1], (start + timedelta(seconds=1), start + timedelta(seconds=2)))
+        self.assertEqual(len(gaps), 1)
+        gaps.update(6, [], (start + timedelta(seconds=2), start + timedelta(seconds=2)))
+        self.assertEqual(len(gaps), 0)
+        self.assertIsNone(gaps.criterion(Section.id))
+
+    def test_sqlite_has_no_gaps(self):
+        gaps = IdGaps()
+        gaps.update(0, [2, 5], (datetime.max, datetime(2024, 9, 1)))
+        self.assertEqual(len(gaps), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
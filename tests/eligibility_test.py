@@ -0,0 +1,93 @@
+import unittest
+from datetime import time as time_of_day
+from courses import Section
+from persons import Student
+from database import Database
+from enums import Quarter, RegistrationStatus
+from controllers import CourseViewer
+from course_registration import CourseRegChain, RetryingRegistration
+from eligibility import eligible_sections
+from stand_in import StandInDatabaseTestCase
+
+
+def walk_chain(student_id, section_ids):
+    """ What the CourseRegChain decides for each section, every decision rolled back """
+    decisions = {}
+    with Database().unit_of_work() as session:
+        student = session.get(Student, student_id)
+        for section_id in section_ids:
+            savepoint = session.begin_nested()
+            decisions[section_id] = CourseRegChain().chain1.handle_request(student, session.get(Section, section_id))
+            savepoint.rollback()
+    return decisions
+
+
+class TestEligibility(StandInDatabaseTestCase):
+    """ The eligibility of every section agrees with what the CourseRegChain decides for it """
+
+    def _statuses(self, student_id, section_ids):
+        eligibility = eligible_sections(student_id, 2023, Quarter.fall)
+        statuses = dict(eligibility.blocked)
+        statuses.update(dict.fromkeys(eligibility.eligible, RegistrationStatus.enrolled))
+        return {section_id: statuses[section_id] for section_id in section_ids}
+
+    def test_agrees_with_the_chain(self):
+        intro, = self._create_sections(1, 5, name="EligibleIntro")
+        advanced, = self._create_sections(1, 5, name="EligibleAdvanced", prereqs=[self._course_of(intro)])
+        full, = self._create_sections(1, 0, name="EligibleFull")
+        morning, = self._create_sections(1, 5, name="EligibleMorning", time_=time_of_day(9),
+                                         end_time=time_of_day(10, 20), days="MWF")
+        clash, = self._create_sections(1, 5, name="EligibleClash", time_=time_of_day(10), days="F")
+        late, = self._create_sections(1, 5, name="EligibleLate", time_=time_of_day(23), days="M")
+        after_midnight, = self._create_sections(1, 5, name="EligibleAfterMidnight", time_=time_of_day(0, 10),
+                                                end_time=time_of_day(1), days="T")
+        open_, = self._create_sections(1, 5, name="EligibleOpen", time_=time_of_day(13), days="TR")
+        sections = [intro, advanced, full, morning, clash, after_midnight, open_]
+        student_id, = self._create_students(1, "Eligible")
+        held, = self._create_students(1, "EligibleHeld", restriction_hold=True)
+        registration = RetryingRegistration()
+        self.assertEqual(registration.register(student_id, morning), RegistrationStatus.enrolled)
+        self.assertEqual(registration.register(student_id, late), RegistrationStatus.enrolled)
+
+        statuses = self._statuses(student_id, sections)
+        self.assertEqual(statuses[advanced], RegistrationStatus.missing_prereq)
+        self.assertEqual(statuses[full], RegistrationStatus.section_full)
+        self.assertEqual(statuses[clash], RegistrationStatus.schedule_conflict)
+        self.assertEqual(statuses[after_midnight], RegistrationStatus.schedule_conflict)
+        self.assertEqual(statuses[morning], RegistrationStatus.already_enrolled)
+        self.assertEqual(statuses[open_], RegistrationStatus.enrolled)
+        unregistered = [section_id for section_id in sections if section_id != morning]
+        self.assertEqual({section_id: statuses[section_id] for section_id in unregistered},
+                         walk_chain(student_id, unregistered))
+
+        held_statuses = self._statuses(held, sections)
+        self.assertEqual(held_statuses, walk_chain(held, sections))
+        self.assertEqual(held_statuses[open_], RegistrationStatus.restriction_hold)
+
+        self.assertEqual(registration.register(student_id, intro), RegistrationStatus.enrolled)
+        statuses = self._statuses(student_id, sections)
+        self.assertEqual(statuses[advanced], RegistrationStatus.course_limit)
+        self.assertEqual(set(statuses.values()), {RegistrationStatus.course_limit})
+        self.assertEqual(statuses, walk_chain(student_id, sections))
+
+    def test_seats_and_catalog_changes(self):
+        section_id, = self._create_sections(1, 1, name="EligibleSeats")
+        student_id, rival_id = self._create_students(2, "EligibleSeats")
+        self.assertIn(section_id, eligible_sections(student_id, 2023, Quarter.fall).eligible)
+        RetryingRegistration().register(rival_id, section_id)
+        self.assertEqual(eligible_sections(student_id, 2023, Quarter.fall).blocked[section_id],
+                         RegistrationStatus.section_full)
+
+        added, = self._create_sections(1, 5, name="EligibleAdded")
+        with Database().unit_of_work() as session:
+            eligibility = CourseViewer().view_eligible_sections(session.get(Student, student_id), 2023, Quarter.fall)
+        self.assertIn(added, eligibility.eligible)
+
+    def test_unknown_student(self):
+        section_id, = self._create_sections(1, 5, name="EligibleUnknown")
+        eligibility = eligible_sections(-1, 2023, Quarter.fall)
+        self.assertEqual((eligibility.eligible, eligibility.blocked[section_id]), ([], RegistrationStatus.not_found))
+
+
+if __name__ == '__main__':
+    unittest.main()
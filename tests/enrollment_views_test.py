@@ -0,0 +1,165 @@
+import unittest
+from datetime import datetime
+from sqlalchemy import func
+from courses import Section, EnrollmentEvent, EventGap, student_roster, instructor_roster
+from persons import Student
+from database import Database
+from enums import Department, Quarter, RegistrationStatus
+from course_registration import CourseRegModification, RetryingRegistration
+from terms import archive_term, freeze_term
+from enrollment_views import EnrollmentViewConsumer, backfill_events, department_totals, instructor_load, \
+    lag, read_views, rebuild_views, replay, section_fill
+from stand_in import StandInDatabaseTestCase
+
+
+class OpenTransactionsConsumer(EnrollmentViewConsumer):
+    """ A consumer on a database that cannot tell when the transactions that took the missing ids ended """
+    @staticmethod
+    def _settled_before():
+        return None
+
+
+class TestEnrollmentViews(StandInDatabaseTestCase):
+    """ The views kept from the enrollment event log agree with the roster, and with a replay of the log """
+
+    @staticmethod
+    def _last_event_id():
+        return Database().get_session().query(func.max(EnrollmentEvent.id)).scalar() or 0
+
+    def _assert_views_match(self, section_ids):
+        session = Database().get_session()
+        counts = {section_id: count for section_id, count in session.query(Section.id, Section.enrolled_count).
+                  filter(Section.id.in_(section_ids))}
+        self.assertEqual(section_fill(section_ids), counts)
+        self.assertEqual(read_views(), replay())
+
+    def test_enroll_drop_and_swap_are_logged_and_applied(self):
+        first, second, third = self._create_sections(3, 5, name="ViewsSwap")
+        student_id, other_id = self._create_students(2, "ViewsSwap")
+        registration = RetryingRegistration()
+        before = self._last_event_id()
+        self.assertEqual(registration.register(student_id, first), RegistrationStatus.enrolled)
+        self.assertEqual(registration.register(other_id, first), RegistrationStatus.enrolled)
+        self.assertEqual(registration.register(student_id, second), RegistrationStatus.enrolled)
+        enrolled = self._last_event_id()
+        with Database().unit_of_work() as session:
+            student = session.get(Student, student_id)
+            CourseRegModification(student).drop_course(session.get(Section, first))
+        with Database().unit_of_work() as session:
+            student = session.get(Student, student_id)
+            self.assertTrue(CourseRegModification(student).swap_course(session.get(Section, third),
+                                                                       session.get(Section, second)).committed)
+        deltas = [(section_id, delta) for section_id, delta in Database().get_session().
+                  query(EnrollmentEvent.section_id, EnrollmentEvent.delta).filter(EnrollmentEvent.id > before).
+                  order_by(EnrollmentEvent.id)]
+        self.assertEqual(deltas, [(first, 1), (first, 1), (second, 1), (first, -1), (second, -1), (third, 1)])
+
+        EnrollmentViewConsumer().catch_up()
+        self._assert_views_match([first, second, third])
+        self.assertEqual(section_fill([first, second, third]), {first: 1, second: 0, third: 1})
+        self.assertEqual(department_totals(2023, Quarter.fall)[Department.mpcs], replay().department_totals[
+            (Department.mpcs, 2023, Quarter.fall)])
+        instructor_id, = {instructor_id for instructor_id, in Database().get_session().
+                          query(instructor_roster.c.instructor_id).filter(instructor_roster.c.section_id == first)}
+        self.assertEqual(instructor_load(2023, Quarter.fall)[instructor_id],
+                         Database().get_session().query(func.count()).select_from(student_roster).
+                         join(instructor_roster, instructor_roster.c.section_id == student_roster.c.section_id).
+                         filter(instructor_roster.c.instructor_id == instructor_id).scalar())
+
+        as_enrolled = replay(through_event=enrolled)
+        self.assertEqual((as_enrolled.section_fill[(first,)], as_enrolled.section_fill[(second,)]), (2, 1))
+        self.assertNotIn((third,), as_enrolled.section_fill)
+        self.assertEqual(replay(as_of=datetime(2000, 1, 1)).section_fill, {})
+
+    def test_turned_down_registrations_are_not_logged(self):
+        full, = self._create_sections(1, 0, name="ViewsFull")
+        student_id, = self._create_students(1, "ViewsFull")
+        before = self._last_event_id()
+        self.assertEqual(RetryingRegistration().register(student_id, full), RegistrationStatus.section_full)
+        self.assertEqual(self._last_event_id(), before)
+
+    def test_catch_up_after_restart(self):
+        section_ids = self._create_sections(4, 5, name="ViewsRestart")
+        student_ids = self._create_students(4, "ViewsRestart")
+        registration = RetryingRegistration()
+        for student_id, section_id in zip(student_ids, section_ids):
+            registration.register(student_id, section_id)
+        consumer = EnrollmentViewConsumer(batch_size=2)
+        self.assertEqual(consumer.consume(), 2)
+        # A new consumer goes on from the saved checkpoint and applies nothing twice
+        EnrollmentViewConsumer(batch_size=2).catch_up()
+        self.assertEqual(consumer.consume(), 0)
+        self._assert_views_match(section_ids)
+
+        rebuild_views()
+        self.assertEqual(read_views().section_fill, {})
+        EnrollmentViewConsumer().catch_up()
+        self._assert_views_match(section_ids)
+
+    def test_gaps_are_applied_when_they_commit(self):
+        section_id, = self._create_sections(1, 5, name="ViewsGap")
+        student_id, = self._create_students(1, "ViewsGap")
+        EnrollmentViewConsumer().catch_up()
+        last = self._last_event_id()
+
+        def log_event(event_id):
+            session = Database().get_session()
+            session.add(EnrollmentEvent(id=event_id, student_id=student_id, section_id=section_id, year=2023,
+                                        quarter=Quarter.fall, delta=1))
+            session.commit()
+
+        # Ids taken by transactions that stay open however long it takes, then one of them commits
+        log_event(last + 3)
+        consumer = OpenTransactionsConsumer()
+        self.assertEqual(consumer.catch_up(), 1)
+        self.assertEqual(lag(), 0)
+        log_event(last + 1)
+        self.assertEqual(lag(), 1)
+        self.assertEqual(consumer.catch_up(), 1)
+        self.assertEqual(consumer.catch_up(), 0)
+        self.assertEqual(section_fill([section_id]), {section_id: 2})
+        self.assertEqual(Database().get_session().query(EventGap).count(), 1)
+
+        # Once they have all ended, the id still missing belonged to one that rolled back
+        self.assertEqual(EnrollmentViewConsumer().catch_up(), 0)
+        self.assertEqual(Database().get_session().query(EventGap).count(), 0)
+
+    def test_views_survive_archival(self):
+        term = (2018, Quarter.winter)
+        section_id, = self._create_sections(1, 5, name="ViewsArchive", term=term)
+        student_id, late_id = self._create_students(2, "ViewsArchive")
+        registration = RetryingRegistration()
+        self.assertEqual(registration.register(student_id, section_id), RegistrationStatus.enrolled)
+        EnrollmentViewConsumer().catch_up()
+        # Applied only after the term is archived
+        self.assertEqual(registration.register(late_id, section_id), RegistrationStatus.enrolled)
+        freeze_term(*term)
+        archive_term(*term)
+        EnrollmentViewConsumer().catch_up()
+
+        views = replay()
+        self.assertEqual(read_views(), views)
+        self.assertEqual(department_totals(*term), {Department.mpcs: 2})
+        self.assertEqual(views.department_totals[(Department.mpcs, *term)], 2)
+        self.assertEqual(sum(instructor_load(*term).values()), 2)
+        self.assertNotIn((section_id,), views.section_fill)
+
+    def test_backfill_of_a_roster_older_than_the_log(self):
+        section_ids = self._create_sections(2, 5, name="ViewsBackfill")
+        student_ids = self._create_students(2, "ViewsBackfill")
+        registration = RetryingRegistration()
+        for student_id in student_ids:
+            registration.register(student_id, section_ids[0])
+        session = Database().get_session()
+        session.query(EnrollmentEvent).delete()
+        session.commit()
+        rebuild_views()
+
+        self.assertEqual(backfill_events(), session.query(func.count()).select_from(student_roster).scalar())
+        self.assertEqual(backfill_events(), 0)
+        EnrollmentViewConsumer().catch_up()
+        self._assert_views_match(section_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import asyncio
+import unittest
+from urllib.request import urlopen
+from enums import RegistrationStatus
+from course_registration import RetryingRegistration
+from instrumentation import Registry, registry, tracer, handler_seconds, registration_outcomes, request_queries, \
+    query_seconds, serve_metrics
+from stand_in import StandInDatabaseTestCase
+
+
+class TestMetrics(unittest.TestCase):
+    """ Counters and histograms render in the Prometheus text format """
+
+    def test_render(self):
+        metrics = Registry()
+        counter = metrics.counter('test_outcomes_total', "Outcomes", labels=('status',))
+        histogram = metrics.histogram('test_seconds', "Latency", labels=('path',), buckets=(0.1, 1.0))
+        counter.inc('enrolled')
+        counter.inc('enrolled')
+        counter.inc('say "full"\n')
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value, 'rush')
+        self.assertEqual(metrics.render().splitlines(), [
+            '# HELP test_outcomes_total Outcomes',
+            '# TYPE test_outcomes_total counter',
+            'test_outcomes_total{status="enrolled"} 2',
+            'test_outcomes_total{status="say \\"full\\"\\n"} 1',
+            '# HELP test_seconds Latency',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{path="rush",le="0.1"} 1',
+            'test_seconds_bucket{path="rush",le="1.0"} 2',
+            'test_seconds_bucket{path="rush",le="+Inf"} 3',
+            'test_seconds_sum{path="rush"} 5.55',
+            'test_seconds_count{path="rush"} 3'])
+        self.assertIs(metrics.counter('test_outcomes_total', "Outcomes"), counter)
+
+
+class TestRegistrationInstrumentation(StandInDatabaseTestCase):
+    """ Registrations are timed per handler, counted per status and recorded as spans with their queries """
+
+    def setUp(self) -> None:
+        registry.reset()
+        tracer.reset()
+
+    def tearDown(self) -> None:
+        registry.enabled = True
+
+    def test_registration_spans_and_metrics(self):
+        section_id, = self._create_sections(1, 1, name="Instrumented")
+        student_id, rival_id = self._create_students(2, "Instrumented")
+        registry.reset()
+        tracer.reset()
+        registration = RetryingRegistration()
+        self.assertEqual(registration.register(student_id, section_id), RegistrationStatus.enrolled)
+        self.assertEqual(registration.register(rival_id, section_id), RegistrationStatus.section_full)
+
+        self.assertEqual(registration_outcomes.value('enrolled'), 1)
+        self.assertEqual(registration_outcomes.value('section_full'), 1)
+        self.assertEqual(handler_seconds.count('StudentRestrictionHandler'), 1)
+        self.assertEqual(handler_seconds.count('StudentCourseLimitHandler'), 2)
+        self.assertEqual(request_queries.count('registration'), 2)
+        self.assertGreater(query_seconds.count('primary', 'select'), 0)
+
+        spans = tracer.finished_spans()
+        requests = [span for span in spans if span['name'] == 'registration']
+        self.assertEqual([span['attributes']['student_id'] for span in requests], [student_id, rival_id])
+        first = requests[0]
+        handlers = [span for span in spans if span['trace_id'] == first['trace_id'] and span['name'] == 'handler']
+        self.assertEqual(len(handlers), 5)
+        self.assertTrue(all(span['attributes']['status'] == 'enrolled' for span in handlers))
+        self.assertGreater(first['queries'], 0)
+        self.assertGreaterEqual(first['queries'], max(span['queries'] for span in handlers))
+        self.assertIn('regie_registration_outcomes_total{status="enrolled"} 1', registry.render())
+
+    def test_async_chain_is_instrumented(self):
+        from async_registration import AsyncRetryingRegistration
+        from database import Database
+        section_id, = self._create_sections(1, 5, name="AsyncInstrumented")
+        student_id, = self._create_students(1, "AsyncInstrumented")
+        registry.reset()
+
+        async def register():
+            try:
+                return await AsyncRetryingRegistration().register(student_id, section_id)
+            finally:
+                await Database().close_async_engine()
+        self.assertEqual(asyncio.run(register()), RegistrationStatus.enrolled)
+        self.assertEqual(registration_outcomes.value('enrolled'), 1)
+        self.assertEqual(handler_seconds.count('AsyncStudentRestrictionHandler'), 1)
+
+    def test_disabled(self):
+        section_id, = self._create_sections(1, 5, name="Uninstrumented")
+        student_id, = self._create_students(1, "Uninstrumented")
+        registry.reset()
+        tracer.reset()
+        registry.enabled = False
+        self.assertEqual(RetryingRegistration().register(student_id, section_id), RegistrationStatus.enrolled)
+        self.assertEqual(registration_outcomes.value('enrolled'), 0)
+        self.assertEqual(tracer.finished_spans(), [])
+
+    def test_serve_metrics(self):
+        server = serve_metrics(port=0)
+        try:
+            registration_outcomes.inc('enrolled')
+            with urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+                self.assertIn('regie_registration_outcomes_total{status="enrolled"} 1', response.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
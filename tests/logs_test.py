@@ -0,0 +1,123 @@
+import logging
+import os
+import tempfile
+import threading
+import unittest
+import logs
+from logs import LogShipper, BLOCK
+
+
+class StandInSink:
+    """ Collects the shipped batches, raises while down and waits while paused """
+    def __init__(self):
+        self.batches = []
+        self.down = False
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+    def insert_many(self, documents):
+        self.resumed.wait()
+        if self.down:
+            raise ConnectionError("sink unreachable")
+        self.batches.append(list(documents))
+
+    def messages(self):
+        return [document['msg'] for batch in self.batches for document in batch]
+
+
+class TestLogShipper(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.sink = StandInSink()
+        handle, self.spool_path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        os.remove(self.spool_path)
+        self.retry_interval = logs.RETRY_INTERVAL
+        logs.RETRY_INTERVAL = 0
+        self.log = logging.getLogger(f'shipped.{self.id()}')
+        self.log.propagate = False
+        self.log.setLevel(logging.DEBUG)
+
+    def tearDown(self) -> None:
+        logs.RETRY_INTERVAL = self.retry_interval
+        self.shipper.close()
+        self.log.removeHandler(self.shipper)
+        if os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
+
+    def _attach(self, **options):
+        self.shipper = LogShipper(self.sink, spool_path=self.spool_path, **options)
+        self.log.addHandler(self.shipper)
+
+    def test_records_are_shipped_in_batches(self):
+        self._attach(batch_size=100)
+        for number in range(1000):
+            self.log.debug("record %d", number)
+        self.shipper.flush()
+        self.assertEqual(self.sink.messages(), [f"record {number}" for number in range(1000)])
+        self.assertLessEqual(max(len(batch) for batch in self.sink.batches), 100)
+
+    def test_unreachable_sink_spools_and_replays(self):
+        self._attach()
+        self.sink.down = True
+        for number in range(10):
+            self.log.debug("spooled %d", number)
+        self.shipper.flush()
+        self.assertEqual(self.shipper.stats()['spooled'], 10)
+        self.assertTrue(os.path.exists(self.spool_path))
+        self.sink.down = False
+        self.log.debug("after the outage")
+        self.shipper.flush()
+        self.assertEqual(self.sink.messages(), [f"spooled {number}" for number in range(10)] + ["after the outage"])
+        self.assertFalse(os.path.exists(self.spool_path))
+
+    def test_records_that_fail_are_dropped(self):
+        self._attach()
+        self.log.debug("first")
+        self.shipper.flush()
+        format_record = self.shipper.formatter.format
+        self.shipper.formatter.format = lambda record: 1 / 0 if record.msg == "unformattable" else format_record(record)
+        self.log.debug("unformattable")
+        self.log.debug("second")
+        self.shipper.flush()
+        self.assertEqual(self.sink.messages(), ["first", "second"])
+
+        # Nowhere to spool to either
+        self.shipper.spool_path = os.path.join(self.spool_path, 'missing', 'spool.jsonl')
+        self.sink.down = True
+        self.log.debug("lost")
+        self.shipper.flush()
+        self.assertEqual(self.shipper.stats()['dropped'], 2)
+        self.assertTrue(self.shipper._worker.is_alive())
+
+    def test_spool_is_per_process(self):
+        self.shipper = LogShipper(self.sink)
+        self.log.addHandler(self.shipper)
+        self.log.debug("first")
+        self.assertIn(str(os.getpid()), self.shipper.spool_path)
+
+    def test_full_queue_drops(self):
+        self._attach(capacity=2)
+        self.sink.resumed.clear()
+        for number in range(10):
+            self.log.debug("record %d", number)
+        self.assertGreaterEqual(self.shipper.stats()['dropped'], 7)
+        self.sink.resumed.set()
+
+    def test_full_queue_blocks_for_a_while(self):
+        self._attach(capacity=2, policy=BLOCK)
+        self.log.debug("first")
+        self.shipper.flush()
+        self.assertEqual(self.shipper.stats()['dropped'], 0)
+        self.assertEqual(self.sink.messages(), ["first"])
+
+    def test_close_ships_what_is_queued(self):
+        self._attach(flush_interval=60)
+        for number in range(5):
+            self.log.debug("record %d", number)
+        self.shipper.close()
+        self.assertEqual(len(self.sink.messages()), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
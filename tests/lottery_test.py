@@ -0,0 +1,106 @@
+import unittest
+from datetime import time as time_of_day
+import numpy as np
+from courses import Section
+from database import Database
+from enums import Quarter, RegistrationStatus
+from course_registration import RetryingRegistration
+from lottery import SeatLottery, TermDemand, allocate_seats, submit_preferences
+from stand_in import StandInDatabaseTestCase
+
+
+class TestSeatLottery(StandInDatabaseTestCase):
+    """ The lottery fills sections up to their size limit, in order of preference, under the chain's checks """
+
+    def _allocate(self, student_ids, seed=3):
+        results = SeatLottery(seed=seed).allocate(2023, Quarter.fall)
+        return {(result.student_id, result.section_id): result.status for result in results
+                if result.student_id in student_ids}
+
+    def _enrolled_count(self, section_id):
+        with Database().unit_of_work() as session:
+            return session.query(Section.enrolled_count).filter(Section.id == section_id).scalar()
+
+    def test_oversubscribed_section(self):
+        popular, = self._create_sections(1, 2, name="LotteryPopular")
+        fallback, = self._create_sections(1, 10, name="LotteryFallback")
+        students = self._create_students(5, "Lottery")
+        for student_id in students:
+            submit_preferences(student_id, 2023, Quarter.fall, [popular, fallback])
+
+        statuses = self._allocate(students)
+        winners = [student_id for student_id in students
+                   if statuses[(student_id, popular)] is RegistrationStatus.enrolled]
+        self.assertEqual(len(winners), 2)
+        losers = {(student_id, popular): RegistrationStatus.section_full for student_id in students
+                  if student_id not in winners}
+        for student_id in students:
+            self.assertEqual(statuses[(student_id, fallback)], RegistrationStatus.enrolled)
+            self.assertEqual(statuses[(student_id, popular)],
+                             losers.get((student_id, popular), RegistrationStatus.enrolled))
+        self.assertEqual((self._enrolled_count(popular), self._enrolled_count(fallback)), (2, 5))
+
+        # Running it again only fills seats that became free
+        statuses = self._allocate(students)
+        self.assertEqual({key: status for key, status in statuses.items()
+                          if status is not RegistrationStatus.already_enrolled}, losers)
+        self.assertEqual((self._enrolled_count(popular), self._enrolled_count(fallback)), (2, 5))
+
+    def test_alternatives_of_an_offering(self):
+        first, second = self._create_sections(2, 5, name="LotteryAlternatives")
+        student_id, = self._create_students(1, "LotteryAlternatives")
+        submit_preferences(student_id, 2023, Quarter.fall, [first, second])
+        self.assertEqual(self._allocate([student_id]), {(student_id, first): RegistrationStatus.enrolled,
+                                                        (student_id, second): RegistrationStatus.already_enrolled})
+
+    def test_registration_checks(self):
+        intro, = self._create_sections(1, 5, name="LotteryIntro")
+        advanced, = self._create_sections(1, 5, name="LotteryAdvanced", prereqs=[self._course_of(intro)])
+        morning, = self._create_sections(1, 5, name="LotteryMorning", time_=time_of_day(9),
+                                         end_time=time_of_day(10, 20), days="MWF")
+        clash, = self._create_sections(1, 5, name="LotteryClash", time_=time_of_day(10), end_time=time_of_day(11),
+                                       days="WF")
+        others = [self._create_sections(1, 5, name=f"LotteryLoad{number}")[0] for number in range(4)]
+        held, = self._create_students(1, "LotteryHeld", restriction_hold=True)
+        student_id, = self._create_students(1, "LotteryChecks")
+        submit_preferences(held, 2023, Quarter.fall, [intro])
+        submit_preferences(student_id, 2023, Quarter.fall, [advanced, morning, clash] + others)
+
+        statuses = self._allocate([held, student_id])
+        self.assertEqual(statuses[(held, intro)], RegistrationStatus.restriction_hold)
+        self.assertEqual(statuses[(student_id, advanced)], RegistrationStatus.missing_prereq)
+        self.assertEqual(statuses[(student_id, morning)], RegistrationStatus.enrolled)
+        self.assertEqual(statuses[(student_id, clash)], RegistrationStatus.schedule_conflict)
+        self.assertEqual([statuses[(student_id, section_id)] for section_id in others],
+                         [RegistrationStatus.enrolled] * 2 + [RegistrationStatus.course_limit] * 2)
+        self.assertEqual(RetryingRegistration().register(student_id, others[2]), RegistrationStatus.course_limit)
+
+    def test_submit_preferences(self):
+        first, second = self._create_sections(2, 5, name="LotterySubmit")
+        student_id, = self._create_students(1, "LotterySubmit")
+        submit_preferences(student_id, 2023, Quarter.fall, [first, second])
+        submit_preferences(student_id, 2023, Quarter.fall, [second])
+        demand = SeatLottery().load_demand(2023, Quarter.fall)
+        mine = demand.student_ids[demand.pref_student] == student_id
+        self.assertEqual(demand.section_ids[demand.pref_section[mine]].tolist(), [second])
+        self.assertEqual(demand.pref_rank[mine].tolist(), [1])
+        with self.assertRaises(ValueError):
+            submit_preferences(student_id, 2024, Quarter.fall, [first])
+
+    def test_lower_draws_win(self):
+        # Three students want the single seat of section 0 first and section 1 second
+        students, limit = 3, 3
+        demand = TermDemand(np.array([10, 11, 12]), np.repeat(np.arange(students), 2), np.tile([0, 1], students),
+                            np.tile([1, 2], students), np.zeros(2 * students, dtype=np.int8), np.array([100, 101]),
+                            np.array([0, 1]), np.array([1, 5]), *(np.zeros(2, dtype=np.int64) for _ in range(3)),
+                            np.zeros(students, dtype=np.int64),
+                            *(np.zeros((students, limit), dtype=np.int64) for _ in range(3)),
+                            np.zeros(students, dtype=np.int64))
+        status = allocate_seats(demand, np.array([2, 0, 1]), limit)
+        full, enrolled = RegistrationStatus.section_full, RegistrationStatus.enrolled
+        self.assertEqual([RegistrationStatus(code) for code in status[0::2]], [full, enrolled, full])
+        self.assertTrue((status[1::2] == RegistrationStatus.enrolled.value).all())
+        self.assertEqual(demand.remaining.tolist(), [0, 2])
+
+if __name__ == '__main__':
+    unittest.main()
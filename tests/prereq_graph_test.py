@@ -0,0 +1,80 @@
+import unittest
+from courses import Section, student_roster
+from persons import Student
+from database import Database
+from enums import RegistrationStatus
+from prereq_graph import PrereqGraph, PrereqCycleError, prereq_graph
+from course_registration import CourseRegModification, RetryingRegistration
+from stand_in import StandInDatabaseTestCase
+
+
+class TestPrereqGraph(unittest.TestCase):
+    def setUp(self) -> None:
+        # 1 <- 2 <- 3 and 1 <- 4, course 5 has no prereqs
+        self.graph = PrereqGraph()
+        self.graph.add_course(1, [])
+        self.graph.add_course(2, [1])
+        self.graph.add_course(3, [2])
+        self.graph.add_course(4, [1])
+        self.graph.add_course(5, [])
+
+    def test_transitive_closure(self):
+        self.assertEqual(self.graph.closure(3), {1, 2})
+        self.assertEqual(self.graph.closure(4), {1})
+        self.assertEqual(self.graph.closure(5), set())
+
+    def test_subset_check(self):
+        self.assertTrue(self.graph.satisfied(3, self.graph.completed_mask([1, 2, 5])))
+        self.assertFalse(self.graph.satisfied(3, self.graph.completed_mask([2])))
+        self.assertTrue(self.graph.satisfied(5, self.graph.completed_mask([])))
+
+    def test_cycle_detection(self):
+        with self.assertRaises(PrereqCycleError):
+            self.graph.add_course(1, [3])
+        with self.assertRaises(PrereqCycleError):
+            self.graph.add_course(6, [6])
+        self.assertEqual(self.graph.closure(1), set())
+
+    def test_changed_prereqs_propagate_to_dependents(self):
+        self.graph.add_course(1, [5])
+        self.assertEqual(self.graph.closure(3), {1, 2, 5})
+
+
+class TestTransitivePrereqRegistration(StandInDatabaseTestCase):
+    def test_missing_transitive_prereq_blocks_registration(self):
+        basics, = self._create_sections(1, 30, name="Basics")
+        intermediate, = self._create_sections(1, 30, name="Intermediate", prereqs=[self._course_of(basics)])
+        advanced, = self._create_sections(1, 30, name="Expert", prereqs=[self._course_of(intermediate)])
+        student, = self._create_students(1, "Prereq")
+        registration = RetryingRegistration()
+        self.assertEqual(registration.register(student, advanced), RegistrationStatus.missing_prereq)
+        self.assertEqual(registration.register(student, basics), RegistrationStatus.enrolled)
+        self.assertEqual(registration.register(student, advanced), RegistrationStatus.missing_prereq)
+        self.assertEqual(registration.register(student, intermediate), RegistrationStatus.enrolled)
+        self.assertEqual(registration.register(student, advanced), RegistrationStatus.enrolled)
+
+    def test_taken_courses_are_cached_until_the_roster_changes(self):
+        basics, = self._create_sections(1, 30, name="CachedBasics")
+        advanced, = self._create_sections(1, 30, name="CachedAdvanced", prereqs=[self._course_of(basics)])
+        student, = self._create_students(1, "PrereqCached")
+        course_id = self._course_of(advanced).id
+        session = Database().get_session()
+        self.assertEqual(RetryingRegistration().register(student, basics), RegistrationStatus.enrolled)
+        self.assertTrue(prereq_graph.has_prereqs(session, student, course_id))
+
+        # A roster change behind the graph's back is not seen until the cached courses are forgotten
+        session.execute(student_roster.delete().where(student_roster.c.student_id == student))
+        session.commit()
+        self.assertTrue(prereq_graph.has_prereqs(session, student, course_id))
+        prereq_graph.forget_students([student])
+        self.assertFalse(prereq_graph.has_prereqs(session, student, course_id))
+
+        self.assertEqual(RetryingRegistration().register(student, basics), RegistrationStatus.enrolled)
+        self.assertTrue(prereq_graph.has_prereqs(session, student, course_id))
+        with Database().unit_of_work() as session:
+            CourseRegModification(session.get(Student, student)).drop_course(session.get(Section, basics))
+        self.assertFalse(prereq_graph.has_prereqs(Database().get_session(), student, course_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
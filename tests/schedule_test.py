@@ -0,0 +1,97 @@
+import random
+import unittest
+from datetime import time as time_of_day
+from database import Database
+from courses import student_roster
+from enums import Quarter, RegistrationStatus, Weekday
+from course_registration import RetryingRegistration
+from bulk_registration import BulkCourseRegistration
+from schedule import ScheduleIndex, parse_days, meetings, find_term_conflicts
+from stand_in import StandInDatabaseTestCase
+
+
+class TestScheduleIndex(unittest.TestCase):
+    """ Overlap lookups on the meetings of a week """
+
+    def test_parse_days(self):
+        self.assertEqual(parse_days("MWF"), Weekday.monday | Weekday.wednesday | Weekday.friday)
+        self.assertEqual(parse_days("tr"), Weekday.tuesday | Weekday.thursday)
+        self.assertEqual(parse_days(None), Weekday(0))
+
+    def test_meetings_without_days_or_time(self):
+        self.assertEqual(meetings(0, time_of_day(9)), [])
+        self.assertEqual(meetings(Weekday.monday, None), [])
+        self.assertEqual(meetings(Weekday.tuesday, time_of_day(9), time_of_day(10)), [(1 * 1440 + 540, 1440 + 600)])
+
+    def test_conflicts(self):
+        schedule = ScheduleIndex()
+        schedule.add(1, parse_days("MWF"), time_of_day(9), time_of_day(10, 20))
+        schedule.add(2, parse_days("TR"), time_of_day(13), time_of_day(14, 20))
+        schedule.add(3, parse_days("M"), time_of_day(8), time_of_day(17))
+        self.assertEqual(len(schedule), 6)
+        self.assertEqual(schedule.conflict(parse_days("W"), time_of_day(10), time_of_day(11)), 1)
+        self.assertEqual(schedule.conflict(parse_days("R"), time_of_day(14), time_of_day(15)), 2)
+        # Meetings that only touch do not clash
+        self.assertIsNone(schedule.conflict(parse_days("WF"), time_of_day(10, 20), time_of_day(11)))
+        self.assertIsNone(schedule.conflict(parse_days("S"), time_of_day(9), time_of_day(10)))
+        self.assertIn(schedule.conflict(parse_days("M"), time_of_day(9, 30), time_of_day(10)), (1, 3))
+        self.assertIsNone(schedule.conflict(parse_days("TR"), time_of_day(13), time_of_day(14), section_id=2))
+
+    def test_agrees_with_a_scan(self):
+        generator = random.Random(7)
+        schedule, added = ScheduleIndex(), []
+        for section_id in range(1, 60):
+            start = time_of_day(generator.randrange(8, 20), generator.choice((0, 30)))
+            days, end = parse_days(generator.choice(("MWF", "TR", "M", "S"))), time_of_day(start.hour + 1, 20)
+            clashing = {other_id for other_id, other_meetings in added for meeting in meetings(days, start, end)
+                        for other in other_meetings if other[0] < meeting[1] and meeting[0] < other[1]}
+            found = schedule.conflict(days, start, end)
+            if clashing:
+                self.assertIn(found, clashing)
+            else:
+                self.assertIsNone(found)
+            schedule.add(section_id, days, start, end)
+            added.append((section_id, meetings(days, start, end)))
+
+
+class TestScheduleConflicts(StandInDatabaseTestCase):
+    """ Registrations that clash with a student's schedule are turned down """
+
+    def test_chain_rejects_overlapping_section(self):
+        morning, = self._create_sections(1, 5, name="Morning", time_=time_of_day(9), end_time=time_of_day(10, 20),
+                                         days="MWF")
+        overlapping, = self._create_sections(1, 5, name="Overlapping", time_=time_of_day(10),
+                                             end_time=time_of_day(11), days="F")
+        afternoon, = self._create_sections(1, 5, name="Afternoon", time_=time_of_day(13), days="MWF")
+        student_id, = self._create_students(1, "Busy")
+        registration = RetryingRegistration()
+        self.assertEqual([registration.register(student_id, section_id)
+                          for section_id in (morning, overlapping, afternoon)],
+                         [RegistrationStatus.enrolled, RegistrationStatus.schedule_conflict,
+                          RegistrationStatus.enrolled])
+
+    def test_bulk_matches_chain_and_term_sweep(self):
+        first, = self._create_sections(1, 5, name="BulkFirst", time_=time_of_day(15), end_time=time_of_day(16),
+                                       days="TR")
+        second, = self._create_sections(1, 5, name="BulkSecond", time_=time_of_day(15, 30),
+                                        end_time=time_of_day(17), days="R")
+        unscheduled, = self._create_sections(1, 5, name="BulkUnscheduled", time_=time_of_day(15, 30))
+        student_id, other_id = self._create_students(2, "BulkBusy")
+        with Database().unit_of_work() as session:
+            results = BulkCourseRegistration(session).register([(student_id, first), (student_id, second),
+                                                                (student_id, unscheduled)])
+        self.assertEqual([result.status for result in results],
+                         [RegistrationStatus.enrolled, RegistrationStatus.schedule_conflict,
+                          RegistrationStatus.enrolled])
+
+        # A clash written past the checks is still found by the sweep over the term
+        with Database().unit_of_work() as session:
+            session.execute(student_roster.insert(), [{'student_id': other_id, 'section_id': first},
+                                                      {'student_id': other_id, 'section_id': second}])
+        with Database().unit_of_work() as session:
+            conflicts = find_term_conflicts(session, 2023, Quarter.fall)
+        self.assertIn((other_id, min(first, second), max(first, second)), conflicts)
+        self.assertNotIn(student_id, {conflict[0] for conflict in conflicts})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+from datetime import datetime
+from sqlalchemy import func
+from courses import Course
+from database import Database
+from controllers import CourseViewer
+from search_index import CourseSearchIndex, course_search_index
+from stand_in import StandInDatabaseTestCase
+
+
+class OpenTransactionsIndex(CourseSearchIndex):
+    """ An index on a database that cannot tell when the transactions that took the skipped ids ended """
+    @staticmethod
+    def _settled_before():
+        return None, datetime.utcnow()
+
+
+class TestCourseSearchIndex(unittest.TestCase):
+    """ Checks the index against the LIKE '%text%' semantics it replaces """
+
+    def setUp(self) -> None:
+        self.index = CourseSearchIndex()
+        self.index.add_course(1, "Object Oriented Programming", "MPCS51410", "Patterns and refactoring")
+        self.index.add_course(2, "Introduction to Programming", "MPCS50101", "Python for beginners")
+        self.index.add_course(3, "Algorithms", "MPCS55001", None)
+
+    def test_substring_ignores_case(self):
+        self.assertEqual(self.index.search("programming", ('name',)), {1, 2})
+        self.assertEqual(self.index.search("ORIENTED", ('name',)), {1})
+        self.assertEqual(self.index.search("rithm", ('name',)), {3})
+
+    def test_candidates_are_verified(self):
+        # Every trigram of "abcde" is in the name, the text itself is not
+        self.index.add_course(4, "abcd bcde", "X1", None)
+        self.assertEqual(self.index.search("abcde", ('name',)), set())
+        self.assertEqual(self.index.search("abcd b", ('name',)), {4})
+
+    def test_short_queries_scan(self):
+        self.assertEqual(self.index.search("Al", ('name',)), {3})
+        self.assertEqual(self.index.search("", ('name',)), {1, 2, 3})
+
+    def test_keyword_spans_fields(self):
+        self.assertEqual(self.index.search("51410"), {1})
+        self.assertEqual(self.index.search("python"), {2})
+        self.assertEqual(self.index.search("python", ('name',)), set())
+
+    def test_courses_are_indexed_once(self):
+        self.assertFalse(self.index.add_course(3, "Algorithms", "MPCS55001", None))
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.search("algo"), {3})
+
+
+class TestCourseViewerSearch(StandInDatabaseTestCase):
+    """ The viewer answers name and keyword lookups through the index """
+
+    def test_view_courses_by_name_and_keyword(self):
+        self._create_sections(2, 30, name="Searchable")
+        self._create_sections(1, 30, name="Other")
+        with Database().unit_of_work():
+            rows = CourseViewer().view_courses(name=f"searchable {self.tag}")
+            self.assertEqual(len(rows), 2)
+            rows = CourseViewer().view_courses(keyword=f"COther{self.tag}")
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(CourseViewer().view_courses(name=f"Missing {self.tag}"), [])
+
+    def test_courses_of_other_processes_are_picked_up(self):
+        section_id, = self._create_sections(1, 30, name="Elsewhere")
+        course_id = self._course_of(section_id).id
+        course_search_index.reset()
+        with Database().unit_of_work():
+            rows = CourseViewer().view_courses(name=f"Elsewhere {self.tag}")
+        self.assertEqual([row.Course.id for row in rows], [course_id])
+
+    def test_courses_committed_out_of_order_are_picked_up(self):
+        index = OpenTransactionsIndex()
+        session = Database().get_session()
+        last_id = session.query(func.max(Course.id)).scalar() or 0
+        session.add(Course(id=last_id + 2, name=f"Early {self.tag}", course_code=f"E{self.tag}"))
+        session.commit()
+        with Database().unit_of_work() as session:
+            index.refresh(session)
+        self.assertEqual(index.search(f"early {self.tag}"), {last_id + 2})
+        # Inserted by a transaction that took its id before the early course's but committed after it was read
+        session = Database().get_session()
+        session.add(Course(id=last_id + 1, name=f"Late {self.tag}", course_code=f"L{self.tag}"))
+        session.commit()
+        with Database().unit_of_work() as session:
+            index.refresh(session)
+        self.assertEqual(index.search(f"late {self.tag}"), {last_id + 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
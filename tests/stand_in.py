@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+import uuid
+from datetime import time as time_of_day
+from courses import Course, CourseOffering, Section
+from persons import Student, Instructor
+from controllers import CourseBuilder, get_or_create
+from database import Database
+from enums import Quarter, Department, StudentType, DegreeProgram, SectionType
+
+"""
+Shared set up for the tests that need a database they can point a pool of threads or an event loop at."""
+
+
+class StandInDatabaseTestCase(unittest.TestCase):
+    """
+    Runs its tests against a local stand-in database with a pool sized for the worker threads.
+    Set REGIE_STRESS_DB_URL to run them against MySQL instead of a temporary SQLite file.
+    """
+    POOL_SIZE = 8
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.previous_settings = Database().get_settings()
+        cls.db_file = None
+        url = os.environ.get('REGIE_STRESS_DB_URL')
+        if url is None:
+            handle, cls.db_file = tempfile.mkstemp(suffix='.db')
+            os.close(handle)
+            url = 'sqlite:///' + cls.db_file
+        Database().configure(url=url, echo=False, pool_size=cls.POOL_SIZE, max_overflow=0)
+        Database().get_base().metadata.create_all(bind=Database().get_engine())
+        cls.tag = uuid.uuid4().hex[:8]
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        Database().configure(**cls.previous_settings)
+        if cls.db_file:
+            os.remove(cls.db_file)
+
+    @classmethod
+    def _create_sections(cls, count, size_limit, name="", prereqs=(), time_=time_of_day(16, 30), end_time=None,
+                         days=0, term=(2023, Quarter.fall)):
+        """ Creates a course with count sections of size_limit seats in the term and returns the section ids """
+        db_session = Database().get_session()
+        instructor = get_or_create(db_session, Instructor, first_name="Mark", last_name="Shacklette",
+                                   preferred_name="Mark", department=Department.mpcs)
+        builder = CourseBuilder().create_new_course(f"{cls.__name__} {name} {cls.tag}", "Threads",
+                                                    f"C{name}{cls.tag}", Department.mpcs, list(prereqs)). \
+            create_new_course_offering(*term)
+        for _ in range(count):
+            builder.create_new_section("Ryerson 277", [instructor], SectionType.lecture, time_, end_time, days)
+        section_ids = [section_id for section_id, in db_session.query(Section.id).
+                       filter(Section.course_offering_id == builder.course_offering_id)]
+        db_session.query(Section).filter(Section.id.in_(section_ids)). \
+            update({Section.size_limit: size_limit}, synchronize_session=False)
+        db_session.commit()
+        return section_ids
+
+    @staticmethod
+    def _course_of(section_id):
+        db_session = Database().get_session()
+        return db_session.query(Course).join(CourseOffering).join(Section).filter(Section.id == section_id).one()
+
+    def _create_students(self, count, first_name, restriction_hold=False):
+        db_session = Database().get_session()
+        students = [Student(first_name=first_name, last_name=f"Student{i}", preferred_name=self.tag,
+                            type=StudentType.full_time, degree_program=DegreeProgram.mpcs,
+                            department=Department.mpcs, restriction_hold=restriction_hold)
+                    for i in range(count)]
+        db_session.add_all(students)
+        db_session.flush()
+        student_ids = [student.id for student in students]
+        db_session.commit()
+        return student_ids
@@ -0,0 +1,125 @@
+import unittest
+from courses import CourseOffering, Section, SectionFill, WaitlistEntry, student_roster
+from persons import Student, StudentTermLoad
+from controllers import CourseViewer
+from database import Database
+from enums import Quarter, RegistrationStatus, TermStatus
+from bulk_registration import BulkCourseRegistration
+from cart import Cart
+from course_registration import CourseRegModification, RetryingRegistration
+from eligibility import eligible_sections
+from enrollment_views import EnrollmentViewConsumer, section_fill
+from lottery import submit_preferences
+from terms import ArchiveResult, archive_term, archived_roster, archived_sections, archived_students, freeze_term, \
+    term_states
+from stand_in import StandInDatabaseTestCase
+
+
+class TestTerms(StandInDatabaseTestCase):
+    """ Frozen terms take no roster changes, archived ones move out of the live tables but stay readable """
+
+    def test_archived_roster_is_in_term_order(self):
+        terms = [(2017, Quarter.fall), (2017, Quarter.winter), (2016, Quarter.summer), (2017, Quarter.spring)]
+        section_ids = [self._create_sections(1, 5, name=f"TermOrder{index}", term=term)[0]
+                       for index, term in enumerate(terms)]
+        student_id, = self._create_students(1, "TermOrder")
+        for section_id in section_ids:
+            self.assertEqual(RetryingRegistration().register(student_id, section_id), RegistrationStatus.enrolled)
+        for term in terms:
+            freeze_term(*term)
+            archive_term(*term)
+        self.assertEqual([(row.year, row.quarter) for row in archived_roster(student_id)],
+                         [(2016, Quarter.summer), (2017, Quarter.winter), (2017, Quarter.spring),
+                          (2017, Quarter.fall)])
+
+    def test_frozen_term_takes_no_changes(self):
+        term = (2020, Quarter.winter)
+        section_id, other_id = self._create_sections(2, 5, name="TermFrozen", term=term)
+        student_id, other_student = self._create_students(2, "TermFrozen")
+        registration = RetryingRegistration()
+        self.assertEqual(registration.register(student_id, section_id), RegistrationStatus.enrolled)
+        freeze_term(*term)
+
+        self.assertIs(term_states.status(Database().get_session(), *term), TermStatus.frozen)
+        self.assertEqual(registration.register(other_student, section_id), RegistrationStatus.not_open)
+        self.assertEqual(BulkCourseRegistration().register([(other_student, other_id)])[0].status,
+                         RegistrationStatus.not_open)
+        self.assertEqual(Cart(student_id).drop(section_id).add(other_id).checkout().rejected,
+                         {section_id: RegistrationStatus.not_open, other_id: RegistrationStatus.not_open})
+        self.assertEqual(set(eligible_sections(other_student, *term).blocked.values()), {RegistrationStatus.not_open})
+        with Database().unit_of_work() as session:
+            CourseRegModification(session.get(Student, student_id)).drop_course(session.get(Section, section_id))
+        self.assertEqual(Database().get_session().query(student_roster).
+                         filter(student_roster.c.section_id == section_id).count(), 1)
+        with self.assertRaises(ValueError):
+            submit_preferences(other_student, *term, [other_id])
+
+    def test_archive_moves_the_term(self):
+        term = (2021, Quarter.spring)
+        intro, = self._create_sections(1, 5, name="TermIntro", term=term)
+        full, = self._create_sections(1, 1, name="TermWaitlisted", term=term)
+        advanced, = self._create_sections(1, 5, name="TermAdvanced", prereqs=[self._course_of(intro)])
+        student_id, waiting_id, newcomer_id = self._create_students(3, "TermArchive")
+        registration = RetryingRegistration()
+        self.assertEqual(registration.register(student_id, intro), RegistrationStatus.enrolled)
+        self.assertEqual(registration.register(student_id, full), RegistrationStatus.enrolled)
+        self.assertEqual(registration.register(waiting_id, full, waitlist=True), RegistrationStatus.waitlisted)
+        with self.assertRaises(ValueError):
+            archive_term(*term)
+
+        freeze_term(*term)
+        self.assertEqual(archive_term(*term), ArchiveResult(2, 2, 2))
+        session = Database().get_session()
+        self.assertEqual(session.query(Section).filter(Section.id.in_([intro, full])).count(), 0)
+        self.assertEqual(session.query(CourseOffering).filter(CourseOffering.year == term[0]).count(), 0)
+        self.assertEqual(session.query(WaitlistEntry).filter(WaitlistEntry.section_id == full).count(), 0)
+        self.assertEqual(session.query(StudentTermLoad).filter(StudentTermLoad.year == term[0]).count(), 0)
+        with self.assertRaises(ValueError):
+            archive_term(*term)
+        with self.assertRaises(ValueError):
+            freeze_term(*term)
+
+        records = {record.id: record for record in archived_sections(*term)}
+        self.assertEqual(set(records), {intro, full})
+        self.assertEqual((records[full].size_limit, records[full].enrolled_count), (1, 1))
+        self.assertEqual(len(records[intro].instructor_ids), 1)
+        self.assertEqual([(row.year, row.quarter, row.section_id) for row in archived_roster(student_id)],
+                         [(2021, Quarter.spring, intro), (2021, Quarter.spring, full)])
+        self.assertEqual(archived_students(full), [student_id])
+        with Database().unit_of_work() as session:
+            student = session.get(Student, student_id)
+            self.assertEqual(CourseViewer().view_roster(student), [])
+            self.assertEqual(len(CourseViewer().view_archived_roster(student)), 2)
+
+        # The archived intro still counts as taken for the prereqs of the advanced course
+        self.assertIn(advanced, eligible_sections(student_id, 2023, Quarter.fall).eligible)
+        self.assertEqual(eligible_sections(newcomer_id, 2023, Quarter.fall).blocked[advanced],
+                         RegistrationStatus.missing_prereq)
+        self.assertEqual(BulkCourseRegistration().register([(newcomer_id, advanced)])[0].status,
+                         RegistrationStatus.missing_prereq)
+        self.assertEqual(Cart(newcomer_id).add(advanced).checkout().rejected,
+                         {advanced: RegistrationStatus.missing_prereq})
+        self.assertEqual(registration.register(newcomer_id, advanced), RegistrationStatus.missing_prereq)
+        self.assertEqual(registration.register(student_id, advanced), RegistrationStatus.enrolled)
+
+    def test_archived_ids_are_not_reused(self):
+        term = (2019, Quarter.summer)
+        # The newest section and offering, whose ids SQLite would otherwise hand out again once deleted
+        section_id, = self._create_sections(1, 5, name="TermReuse", term=term)
+        student_id, = self._create_students(1, "TermReuse")
+        self.assertEqual(RetryingRegistration().register(student_id, section_id), RegistrationStatus.enrolled)
+        EnrollmentViewConsumer().catch_up()
+        offering_id = Database().get_session().get(Section, section_id).course_offering_id
+        freeze_term(*term)
+        archive_term(*term)
+        self.assertEqual(Database().get_session().query(SectionFill).
+                         filter(SectionFill.section_id == section_id).count(), 0)
+
+        new_id, = self._create_sections(1, 5, name="TermReuseNew")
+        self.assertGreater(new_id, section_id)
+        self.assertGreater(Database().get_session().get(Section, new_id).course_offering_id, offering_id)
+        self.assertEqual(section_fill([new_id]), {new_id: 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+from datetime import datetime
+from sqlalchemy import func
+from courses import Section, WaitlistEntry
+from persons import Student
+from database import Database
+from enums import RegistrationStatus
+from course_registration import RetryingRegistration, CourseRegModification
+from waitlist import SectionWaitlist, Waitlists, waitlists
+from stand_in import StandInDatabaseTestCase
+
+
+class OpenTransactionsWaitlists(Waitlists):
+    """ Waitlists on a database that cannot tell when the transactions that took the skipped ids ended """
+    @staticmethod
+    def _settled_before():
+        return None, datetime.utcnow()
+
+
+class TestSectionWaitlist(unittest.TestCase):
+    """ The in-memory order of a section's waitlist """
+
+    def test_priority_then_arrival(self):
+        waitlist = SectionWaitlist()
+        joined = datetime(2024, 9, 1)
+        for entry_id, (student_id, priority) in enumerate([(10, 0), (11, 0), (12, 5), (13, 0)], start=1):
+            waitlist.add(entry_id, student_id, priority, joined)
+        self.assertEqual([waitlist.position(student_id) for student_id in (12, 10, 11, 13)], [1, 2, 3, 4])
+        waitlist.remove(10)
+        self.assertEqual(waitlist.position(11), 2)
+        self.assertIsNone(waitlist.position(10))
+        self.assertEqual([waitlist.pop() for _ in range(4)], [(3, 12), (2, 11), (4, 13), None])
+
+
+class TestWaitlistPromotion(StandInDatabaseTestCase):
+    """ Drops hand the freed seats to the next eligible students on the waitlist """
+
+    def setUp(self) -> None:
+        self.registration = RetryingRegistration()
+
+    def _drop(self, student_id, section_ids):
+        with Database().unit_of_work() as session:
+            student = session.query(Student).get(student_id)
+            sections = [session.query(Section).get(section_id) for section_id in section_ids]
+            CourseRegModification(student).drop_courses(sections)
+
+    def _enrolled(self, section_id):
+        with Database().unit_of_work() as session:
+            return sorted(student.id for student in session.query(Section).get(section_id).enrolled_students)
+
+    def test_drop_promotes_next_eligible_student(self):
+        section_id, = self._create_sections(1, 1, name="Waitlisted")
+        first, second, third = self._create_students(3, "Waiting")
+        held, = self._create_students(1, "WaitingHeld", restriction_hold=True)
+        self.assertEqual(self.registration.register(first, section_id), RegistrationStatus.enrolled)
+        self.assertEqual(self.registration.register(second, section_id), RegistrationStatus.section_full)
+        self.assertEqual([self.registration.register(held, section_id, waitlist=True, priority=1),
+                          self.registration.register(second, section_id, waitlist=True),
+                          self.registration.register(third, section_id, waitlist=True)],
+                         [RegistrationStatus.waitlisted] * 3)
+        with Database().unit_of_work() as session:
+            self.assertEqual([waitlists.position(session, section_id, student_id)
+                              for student_id in (held, second, third)], [1, 2, 3])
+
+        self._drop(first, [section_id])
+        # The held student comes first but fails the chain and loses their place
+        self.assertEqual(self._enrolled(section_id), [second])
+        with Database().unit_of_work() as session:
+            self.assertEqual(waitlists.position(session, section_id, third), 1)
+            self.assertIsNone(waitlists.position(session, section_id, held))
+
+    def test_bulk_drops_fill_every_section(self):
+        section_ids = self._create_sections(3, 1, name="BulkWaitlisted")
+        holder, = self._create_students(1, "Holder")
+        waiting = self._create_students(3, "BulkWaiting")
+        for section_id, student_id in zip(section_ids, waiting):
+            self.assertEqual(self.registration.register(holder, section_id), RegistrationStatus.enrolled)
+            self.assertEqual(self.registration.register(student_id, section_id, waitlist=True),
+                             RegistrationStatus.waitlisted)
+        self._drop(holder, section_ids)
+        self.assertEqual([self._enrolled(section_id) for section_id in section_ids],
+                         [[student_id] for student_id in waiting])
+
+    def test_rolled_back_join_is_forgotten(self):
+        section_id, = self._create_sections(1, 1, name="RolledBack")
+        student_id, = self._create_students(1, "RolledBack")
+        with self.assertRaises(RuntimeError):
+            with Database().unit_of_work() as session:
+                waitlists.join(session, student_id, section_id)
+                raise RuntimeError("abandoned")
+        with Database().unit_of_work() as session:
+            self.assertIsNone(waitlists.position(session, section_id, student_id))
+            self.assertEqual(waitlists.length(session, section_id), 0)
+
+    def test_entries_of_other_processes(self):
+        section_id, = self._create_sections(1, 1, name="ElsewhereWaitlisted")
+        first, second = self._create_students(2, "Elsewhere")
+        with Database().unit_of_work() as session:
+            self.assertEqual(waitlists.length(session, section_id), 0)
+        # Joins made through other processes, not mirrored in this one yet
+        session = Database().get_session()
+        session.add_all([WaitlistEntry(section_id=section_id, student_id=student_id) for student_id in (first, second)])
+        session.commit()
+        with Database().unit_of_work() as session:
+            self.assertFalse(waitlists.join(session, first, section_id))
+        with Database().unit_of_work() as session:
+            self.assertEqual(waitlists.position(session, section_id, second), 2)
+            self.assertEqual(waitlists.next_student(session, section_id), first)
+        with Database().unit_of_work() as session:
+            self.assertEqual(waitlists.position(session, section_id, second), 1)
+
+    def test_entries_committed_out_of_order(self):
+        section_id, = self._create_sections(1, 1, name="LateWaitlisted")
+        first, second = self._create_students(2, "Late")
+        mirror = OpenTransactionsWaitlists()
+        session = Database().get_session()
+        last_id = session.query(func.max(WaitlistEntry.id)).scalar() or 0
+        session.add(WaitlistEntry(id=last_id + 2, section_id=section_id, student_id=first))
+        session.commit()
+        with Database().unit_of_work() as session:
+            self.assertEqual(mirror.position(session, section_id, first), 1)
+        # Joined in a transaction that took its id before the first one's but committed after it was read
+        session = Database().get_session()
+        session.add(WaitlistEntry(id=last_id + 1, section_id=section_id, student_id=second, priority=1))
+        session.commit()
+        with Database().unit_of_work() as session:
+            self.assertEqual(mirror.position(session, section_id, second), 1)
+            self.assertEqual(mirror.next_student(session, section_id), second)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import threading
+from sortedcontainers import SortedList
+from sqlalchemy import event, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from courses import WaitlistEntry
+from database import Database, IdGaps
+from logs import log
+
+"""
+Waitlists of full sections. The waitlist_entry table is the record, every section's entries are mirrored in
+memory by a SortedList, which hands out the next student to promote and answers position lookups in
+logarithmic time.
+A section whose waitlist was changed in a transaction that rolls back is forgotten and read again on next use."""
+
+# The sections a session changed the waitlists of, in its session.info
+CHANGED_SECTIONS = 'waitlist_sections'
+
+
+class SectionWaitlist:
+    """
+    The in-memory mirror of one section's waitlist, entries are keyed by (-priority, created_at, id).
+    watermark is the highest entry id read from the table, gaps the ids below it that may still turn up.
+    """
+    def __init__(self):
+        self._ordered = SortedList()
+        self._keys = {}
+        self.watermark = 0
+        self.gaps = IdGaps()
+
+    def add(self, entry_id, student_id, priority, created_at):
+        if student_id in self._keys:
+            return
+        key = (-priority, created_at, entry_id, student_id)
+        self._keys[student_id] = key
+        self._ordered.add(key)
+
+    def remove(self, student_id):
+        key = self._keys.pop(student_id, None)
+        if key is not None:
+            self._ordered.remove(key)
+        return key
+
+    def pop(self):
+        """ The (entry id, student id) that is next in line, None when the waitlist is empty """
+        if not self._ordered:
+            return None
+        key = self._ordered.pop(0)
+        del self._keys[key[3]]
+        return key[2], key[3]
+
+    def position(self, student_id):
+        key = self._keys.get(student_id)
+        return None if key is None else self._ordered.bisect_left(key) + 1
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class Waitlists:
+    """
+    The waitlists of every section, loaded section by section on first use.
+    The entries other processes added since are read above a section's watermark before a promotion, and for a
+    position lookup of a student that is not on the waitlist, with the ones that committed late in the ids the
+    catch-ups skipped. Entries another process removed are noticed when they come up for promotion.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sections = {}
+
+    def reset(self):
+        with self._lock:
+            self._sections = {}
+
+    def forget(self, section_ids):
+        with self._lock:
+            for section_id in section_ids:
+                self._sections.pop(section_id, None)
+
+    def join(self, session, student_id, section_id, priority=0):
+        """ Puts the student on the section's waitlist, returns False if they are on it already """
+        waitlist = self._section(session, section_id)
+        with self._lock:
+            if waitlist.position(student_id) is not None:
+                return False
+            entry = WaitlistEntry(section_id=section_id, student_id=student_id, priority=priority)
+            try:
+                with session.begin_nested():
+                    session.add(entry)
+            except IntegrityError:
+                # Joined through another process
+                return False
+            _changed(session, section_id)
+            waitlist.add(entry.id, student_id, priority, entry.created_at)
+        log.debug(f"Student {student_id} joined the waitlist of section {section_id}")
+        return True
+
+    def leave(self, session, student_id, section_id):
+        """ Takes the student off the section's waitlist, returns False if they were not on it """
+        waitlist = self._section(session, section_id)
+        with self._lock:
+            _changed(session, section_id)
+            waitlist.remove(student_id)
+            return session.query(WaitlistEntry).filter(WaitlistEntry.section_id == section_id). \
+                filter(WaitlistEntry.student_id == student_id).delete(synchronize_session=False) > 0
+
+    def position(self, session, section_id, student_id):
+        """ The 1-based place of the student on the section's waitlist, None if they are not on it """
+        waitlist = self._section(session, section_id)
+        with self._lock:
+            position = waitlist.position(student_id)
+        if position is None:
+            waitlist = self._section(session, section_id, catch_up=True)
+            with self._lock:
+                position = waitlist.position(student_id)
+        return position
+
+    def length(self, session, section_id):
+        return len(self._section(session, section_id))
+
+    def next_student(self, session, section_id):
+        """
+        Takes the next student off the section's waitlist, deleting the entry in the session's transaction.
+        Returns None when nobody is waiting.
+        """
+        waitlist = self._section(session, section_id, catch_up=True)
+        while True:
+            with self._lock:
+                entry = waitlist.pop()
+            if entry is None:
+                return None
+            entry_id, student_id = entry
+            _changed(session, section_id)
+            if session.query(WaitlistEntry).filter(WaitlistEntry.id == entry_id). \
+                    filter(WaitlistEntry.student_id == student_id).delete(synchronize_session=False):
+                return student_id
+
+    def _section(self, session, section_id, catch_up=False):
+        """ The section's waitlist, read on first use and caught up with the entries added since on request """
+        with self._lock:
+            waitlist = self._sections.get(section_id)
+            if waitlist is not None and not catch_up:
+                return waitlist
+            waitlist = self._sections.setdefault(section_id, SectionWaitlist())
+            horizon = self._settled_before()
+            unread = WaitlistEntry.id > waitlist.watermark
+            missing = waitlist.gaps.criterion(WaitlistEntry.id)
+            rows = session.query(WaitlistEntry.id, WaitlistEntry.student_id, WaitlistEntry.priority,
+                                 WaitlistEntry.created_at). \
+                filter(WaitlistEntry.section_id == section_id). \
+                filter(unread if missing is None else or_(unread, missing)).all()
+            for entry_id, student_id, priority, created_at in rows:
+                waitlist.add(entry_id, student_id, priority, created_at)
+            waitlist.gaps.update(waitlist.watermark, [row[0] for row in rows], horizon)
+            waitlist.watermark = max([waitlist.watermark] + [row[0] for row in rows])
+            return waitlist
+
+    @staticmethod
+    def _settled_before():
+        return Database().settled_before()
+
+
+def _changed(session, section_id):
+    session.info.setdefault(CHANGED_SECTIONS, set()).add(section_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _keep_changes(session):
+    # Also called when a savepoint is released, the outer transaction may still roll back then
+    if session.in_nested_transaction():
+        return
+    session.info.pop(CHANGED_SECTIONS, None)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_changes(session, previous_transaction):
+    # A savepoint's rollback leaves the outer transaction's changes to forget if it rolls back too
+    changed = session.info.get(CHANGED_SECTIONS, set()) if previous_transaction.nested else \
+        session.info.pop(CHANGED_SECTIONS, ())
+    waitlists.forget(list(changed))
+
+
+waitlists = Waitlists()
+Database().on_configure(waitlists.reset)